@@ -0,0 +1,130 @@
+# cache of authenticated principals
+## keeps get_current_user off Postgres for the common path
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from uuid import UUID
+
+from app.schemas import User as UserPrincipal
+from app.core.redis import redis_manager, RedisRole
+from app.monitoring import AUTH_CACHE_LOOKUPS
+from app.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# JWT claim holding the self-contained principal, see principal_claims
+USER_CLAIMS_KEY = "usr"
+
+
+class AuthCache:
+    '''
+    Two-level cache of authenticated users keyed by user id
+        L1: in-process TTL + LRU, thread-safe since sync dependencies run in the threadpool
+        L2: optional Redis copy shared between processes, same TTL
+    Entries must be dropped with invalidate() whenever a user's row changes.
+    Other processes only see an invalidation once their L1 entry expires, so keep the TTL short.
+    '''
+    REDIS_KEY_PREFIX = "auth:user:"
+
+    def __init__(self, ttl_seconds: float = 60.0, max_size: int = 10000, use_redis: bool = False):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.use_redis = use_redis
+        self._entries: OrderedDict[UUID, tuple[float, UserPrincipal]] = OrderedDict()  # user id to (expires_at, principal)
+        self._lock = threading.Lock()
+        self._redis = None
+
+    async def _init_redis(self):
+        self._redis = redis_manager.get_client(RedisRole.CACHE)
+
+    def get_local(self, user_id: UUID) -> Optional[UserPrincipal]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return principal
+
+    def put_local(self, principal: UserPrincipal):
+        with self._lock:
+            self._entries[principal.id] = (time.monotonic() + self.ttl_seconds, principal)
+            self._entries.move_to_end(principal.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    async def get(self, user_id: UUID) -> Optional[UserPrincipal]:
+        principal = self.get_local(user_id)
+        AUTH_CACHE_LOOKUPS.labels(layer="local", result="hit" if principal else "miss").inc()
+        if principal is not None or not self.use_redis:
+            return principal
+
+        try:
+            if self._redis is None:
+                await self._init_redis()
+            serialized = await self._redis.get(f"{self.REDIS_KEY_PREFIX}{user_id}")
+        except Exception as e:
+            logger.warning(f"AuthCache: redis get failed: {e}", extra={'user_id': str(user_id)})
+            serialized = None
+        AUTH_CACHE_LOOKUPS.labels(layer="redis", result="hit" if serialized else "miss").inc()
+        if not serialized:
+            return None
+
+        principal = UserPrincipal.model_validate_json(serialized)
+        self.put_local(principal)
+        return principal
+
+    async def put(self, principal: UserPrincipal):
+        self.put_local(principal)
+        if not self.use_redis:
+            return
+        try:
+            if self._redis is None:
+                await self._init_redis()
+            await self._redis.set(
+                f"{self.REDIS_KEY_PREFIX}{principal.id}",
+                principal.model_dump_json(),
+                ex=max(1, int(self.ttl_seconds)),
+            )
+        except Exception as e:
+            logger.warning(f"AuthCache: redis set failed: {e}", extra={'user_id': str(principal.id)})
+
+    async def invalidate(self, user_id: UUID):
+        '''
+        Invalidation hook, call after any change to the user's row
+        '''
+        with self._lock:
+            self._entries.pop(user_id, None)
+        if not self.use_redis:
+            return
+        try:
+            if self._redis is None:
+                await self._init_redis()
+            await self._redis.delete(f"{self.REDIS_KEY_PREFIX}{user_id}")
+        except Exception as e:
+            logger.warning(f"AuthCache: redis delete failed: {e}", extra={'user_id': str(user_id)})
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def principal_claims(user) -> dict:
+    '''
+    Self-contained JWT claims for a user, lets get_current_user skip every cache and DB lookup.
+    Such tokens stay valid until they expire even if the user changes, use with short-lived tokens.
+    '''
+    principal = UserPrincipal.model_validate(user)
+    return {USER_CLAIMS_KEY: principal.model_dump(mode="json", exclude={"id"})}
+
+
+auth_cache = AuthCache(
+    ttl_seconds=float(os.getenv("AUTH_CACHE_TTL_SECONDS", 60)),
+    max_size=int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000)),
+    use_redis=os.getenv("AUTH_CACHE_REDIS", "false").lower() == "true",
+)
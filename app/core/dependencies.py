@@ -1,33 +1,36 @@
-from fastapi import Depends, HTTPException, status, Query
+from fastapi import Depends, HTTPException, WebSocketException, Request, status, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from uuid import UUID
-from typing import Optional
+from typing import Dict, Optional
 import os
 
-from fastapi_limiter.depends import RateLimiter
-
-from app.database import get_db
+from app.database import SessionLocal
 from app.core.security import decode_access_token
+from app.core.auth_cache import auth_cache, USER_CLAIMS_KEY
 from app.crud import user as user_crud
-from app.models import User
+from app.schemas import User as UserPrincipal
+from app.monitoring import AUTH_CACHE_LOOKUPS
+from app.core.rate_limit import RateLimiter
 from app.core.queue import BaseTaskQueueService, RedisTaskQueueService  
-from app.core.storage import StorageService, LocalStorage, S3Storage
+from app.core.storage import StorageService, create_storage_service, get_output_storage_type
 
 security = HTTPBearer()
 
 
-def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    
-    token = credentials.credentials
+def _load_principal(user_id: UUID) -> Optional[UserPrincipal]:
+    db = SessionLocal()
+    try:
+        user = user_crud.get_user(db, user_id)
+        return UserPrincipal.model_validate(user) if user is not None else None
+    finally:
+        db.close()
+
+
+async def _authenticate(token: str, credentials_exception: Exception) -> UserPrincipal:
+    """
+    Resolve the principal of a JWT: self-contained claims, then auth cache, then Postgres
+    """
     payload = decode_access_token(token)
     
     if payload is None:
@@ -38,55 +41,86 @@ def get_current_user(
         raise credentials_exception
     
     try:
-        user = user_crud.get_user(db, UUID(user_id))
+        user_id = UUID(user_id)
     except ValueError:
         raise credentials_exception
-    
+
+    claims = payload.get(USER_CLAIMS_KEY)
+    if claims is not None:
+        AUTH_CACHE_LOOKUPS.labels(layer="token", result="hit").inc()
+        return UserPrincipal(id=user_id, **claims)
+
+    user = await auth_cache.get(user_id)
     if user is None:
-        raise credentials_exception
+        user = await run_in_threadpool(_load_principal, user_id)
+        if user is None:
+            raise credentials_exception
+        await auth_cache.put(user)
     
     return user
 
 
-def get_current_user_from_query(
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+) -> UserPrincipal:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    return await _authenticate(credentials.credentials, credentials_exception)
+
+
+async def get_current_user_from_query(
     token: str = Query(..., description="JWT token for authentication"),
-    db: Session = Depends(get_db)
-) -> User:
+) -> UserPrincipal:
     """Get current user from query parameter token (for SSE)"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
     )
-    
-    payload = decode_access_token(token)
-    
-    if payload is None:
-        raise credentials_exception
-    
-    user_id: str = payload.get("sub")
-    if user_id is None:
-        raise credentials_exception
-    
+    return await _authenticate(token, credentials_exception)
+
+
+async def get_current_user_from_websocket(
+    token: str = Query(..., description="JWT token for authentication"),
+) -> UserPrincipal:
+    """Get current user from query parameter token (for WebSockets), the handshake is refused on failure"""
+    credentials_exception = WebSocketException(
+        code=status.WS_1008_POLICY_VIOLATION,
+        reason="Could not validate credentials",
+    )
+    return await _authenticate(token, credentials_exception)
+
+
+async def get_optional_user(request: Request) -> Optional[UserPrincipal]:
+    """Principal of the bearer or query token if there is a valid one, else None (for rate limiting)"""
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization[:7].lower() == "bearer " else request.query_params.get("token")
+    if not token:
+        return None
     try:
-        user = user_crud.get_user(db, UUID(user_id))
-    except ValueError:
-        raise credentials_exception
-    
-    if user is None:
-        raise credentials_exception
-    
-    return user
+        return await _authenticate(token, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED))
+    except HTTPException:
+        return None
 
 
 strict_rate_limiter = RateLimiter(times=20, seconds=300)
 moderate_rate_limiter = RateLimiter(times=50, seconds=300)
 
 
+async def strict_rate_limit(request: Request, principal: Optional[UserPrincipal] = Depends(get_optional_user)):
+    await strict_rate_limiter.hit(request, principal)
+
+async def moderate_rate_limit(request: Request, principal: Optional[UserPrincipal] = Depends(get_optional_user)):
+    await moderate_rate_limiter.hit(request, principal)
+
+
 def get_strict_rate_limiter():
-    return Depends(strict_rate_limiter)
+    return Depends(strict_rate_limit)
 
 def get_moderate_rate_limiter():
-    return Depends(moderate_rate_limiter)
+    return Depends(moderate_rate_limit)
 
 
 _queue_service: BaseTaskQueueService = None  # Type hint to base class
@@ -114,24 +148,37 @@ async def get_queue_service() -> BaseTaskQueueService:  # Return base class
 
 
 
-_storage_service: StorageService = None  # Type hint to base class
+_storage_services: Dict[str, StorageService] = {}  # storage type to instance
 
 async def get_storage_service(storage_type: Optional[str] = None) -> StorageService:
-    global _storage_service
     if storage_type is None:
         storage_type = os.getenv("STORAGE_TYPE", "local").lower()
     
-    if _storage_service is None:        
-        if storage_type == "local":
-            _storage_service = LocalStorage()
-        elif storage_type == "s3":
-            _storage_service = S3Storage()
-        else:
-            raise ValueError(f"Unsupported storage type: {storage_type}")
+    if storage_type not in _storage_services:
+        _storage_services[storage_type] = create_storage_service(storage_type)
     
-    return _storage_service
+    return _storage_services[storage_type]
 
 
 async def get_s3_storage_service() -> StorageService:
     """Get S3 storage service"""
     return await get_storage_service(storage_type="s3")
+
+
+async def get_output_storage_service() -> StorageService:
+    """Get the storage the worker writes task outputs to"""
+    return await get_storage_service(storage_type=get_output_storage_type())
+
+
+async def start_storage_services():
+    """Open the upload and output storages up front, e.g. the S3 client, called on startup"""
+    for storage_service in (await get_storage_service(), await get_output_storage_service()):
+        await storage_service.start()
+
+
+async def close_storage_services():
+    """Close all storages opened so far, called on shutdown"""
+    storage_services = list(_storage_services.values())
+    _storage_services.clear()
+    for storage_service in storage_services:
+        await storage_service.stop()
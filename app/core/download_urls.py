@@ -0,0 +1,79 @@
+# signed download URLs for image delivery
+## in redirect mode the image endpoints answer with a short-lived URL after the ownership check,
+## so image bytes go from S3 to the client without passing through the API
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import quote, urlencode
+
+from app.core.security import SECRET_KEY
+from app.core.storage import StorageService, LocalStorage
+from app.monitoring import DOWNLOAD_URL_REQUESTS
+
+# proxy: stream images through the API, redirect: 307 to a signed URL of the storage
+IMAGE_DELIVERY_MODE = os.getenv("IMAGE_DELIVERY_MODE", "proxy").lower()
+DOWNLOAD_URL_TTL = int(os.getenv("DOWNLOAD_URL_TTL", 300))
+# a cached URL is handed out while at least this share of its lifetime is left
+DOWNLOAD_URL_MIN_REMAINING = float(os.getenv("DOWNLOAD_URL_MIN_REMAINING", 0.5))
+# where LocalStorage files are served from with a signature, see app.router.api.images.get_signed_image
+LOCAL_DOWNLOAD_PATH = os.getenv("LOCAL_DOWNLOAD_PATH", "/api/images/signed")
+
+
+def sign_local_download(file_id: str, expires: int) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"{file_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def verify_local_download(file_id: str, expires: int, signature: str) -> bool:
+    return expires > time.time() and hmac.compare_digest(sign_local_download(file_id, expires), signature)
+
+
+class DownloadUrlCache:
+    '''
+    Signed download URLs by file id, re-signed once less than `min_remaining` of their lifetime is left.
+    Hot objects are signed once per window, and clients keep getting the same URL, so their own cache keeps hitting.
+    S3 objects get presigned GET URLs, LocalStorage files a URL of the API signed with SECRET_KEY;
+    other storages have no URLs and are proxied.
+    '''
+    def __init__(self, ttl_seconds: int = DOWNLOAD_URL_TTL, min_remaining: float = DOWNLOAD_URL_MIN_REMAINING, max_size: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.min_remaining = min_remaining
+        self.max_size = max_size
+        self._entries: OrderedDict[str, Tuple[float, str]] = OrderedDict()  # file id to (expires at, unix time; url)
+
+    async def get(self, storage: StorageService, file_id: str, cache_control: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        '''
+        (url, seconds it stays handed out) for the file, None if the storage cannot sign URLs
+        '''
+        now = time.time()
+        entry = self._entries.get(file_id)
+        if entry is not None and entry[0] - now > self.ttl_seconds * self.min_remaining:
+            self._entries.move_to_end(file_id)
+            DOWNLOAD_URL_REQUESTS.labels(result="cached").inc()
+            return entry[1], self._reusable_for(entry[0], now)
+
+        expires_at = int(now) + self.ttl_seconds
+        url = await storage.presign_read(file_id, self.ttl_seconds, cache_control)
+        if url is None and isinstance(storage, LocalStorage):
+            url = f"{LOCAL_DOWNLOAD_PATH}/{quote(file_id)}?" + urlencode(
+                {'expires': expires_at, 'signature': sign_local_download(file_id, expires_at)}
+            )
+        if url is None:
+            DOWNLOAD_URL_REQUESTS.labels(result="unsupported").inc()
+            return None
+        DOWNLOAD_URL_REQUESTS.labels(result="signed").inc()
+
+        self._entries[file_id] = (expires_at, url)
+        self._entries.move_to_end(file_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return url, self._reusable_for(expires_at, now)
+
+    def _reusable_for(self, expires_at: float, now: float) -> float:
+        '''Seconds until the URL is re-signed, a client may reuse it that long and still have time left to fetch it'''
+        return max(0.0, expires_at - now - self.ttl_seconds * self.min_remaining)
+
+
+download_url_cache = DownloadUrlCache()
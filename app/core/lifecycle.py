@@ -0,0 +1,244 @@
+# storage lifecycle: deletes task files by age and status, keeps local storage within a disk budget
+## runs in the background of the API; one sweep per interval across processes through a Redis lock
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.database import SessionLocal
+from app.models import TaskStatus
+from app.crud import task as task_crud
+from app.core.redis import redis_manager, RedisRole
+from app.core.storage import StorageService, LocalStorage
+from app.core.task_state import task_state_store
+from app.core.variants import all_variant_ids
+from app.core.output_encoding import all_output_file_ids
+from app.logger_config import get_logger
+from app.monitoring import (
+    STORAGE_LIFECYCLE_TASKS_EXPIRED,
+    STORAGE_LIFECYCLE_DELETE_FAILURES,
+    STORAGE_LIFECYCLE_SWEEP_SECONDS,
+    LOCAL_STORAGE_BYTES,
+)
+
+logger = get_logger(__name__)
+
+# hours after which the files of a task in the status are deleted, 0 keeps them
+STORAGE_TTL_HOURS = {
+    TaskStatus.COMPLETED: float(os.getenv("STORAGE_TTL_COMPLETED_HOURS", 24 * 7)),
+    TaskStatus.FAILED: float(os.getenv("STORAGE_TTL_FAILED_HOURS", 24)),
+}
+# bytes local storage may use, 0 for no budget; once over it the oldest finished tasks are evicted down to the target
+LOCAL_STORAGE_MAX_BYTES = int(os.getenv("LOCAL_STORAGE_MAX_BYTES", 0))
+LOCAL_STORAGE_TARGET_RATIO = float(os.getenv("LOCAL_STORAGE_TARGET_RATIO", 0.9))
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", 600))
+STORAGE_SWEEP_BATCH_SIZE = int(os.getenv("STORAGE_SWEEP_BATCH_SIZE", 500))
+STORAGE_LIFECYCLE_ENABLED = os.getenv("STORAGE_LIFECYCLE_ENABLED", "true").lower() == "true"
+
+# tasks of these statuses never lose their files to the disk budget, the worker still needs them
+FINISHED_STATUSES = (TaskStatus.COMPLETED, TaskStatus.FAILED)
+
+
+def _load_expired_tasks(cutoffs, limit: int):
+    db = SessionLocal()
+    try:
+        return task_crud.get_tasks_with_expired_files(db, cutoffs, limit)
+    finally:
+        db.close()
+
+
+def _load_oldest_tasks(limit: int, after):
+    db = SessionLocal()
+    try:
+        return task_crud.get_oldest_tasks_with_files(db, FINISHED_STATUSES, limit, after=after)
+    finally:
+        db.close()
+
+
+def _mark_expired(task_ids, expired_at: datetime) -> int:
+    db = SessionLocal()
+    try:
+        return task_crud.mark_task_files_expired(db, task_ids, expired_at)
+    finally:
+        db.close()
+
+
+class StorageLifecycleService:
+    '''
+    Every `interval` seconds:
+        (1) deletes the input and output files of finished tasks older than their status TTL (STORAGE_TTL_HOURS)
+        (2) if the local storage is over LOCAL_STORAGE_MAX_BYTES, deletes the files of the oldest finished
+            tasks until it is back to LOCAL_STORAGE_TARGET_RATIO of the budget
+    Files are deleted in batches (S3 multi-object delete) and the tasks get files_expired_at set,
+    tasks with a failed delete are left for the next sweep.
+    '''
+    LOCK_KEY = "storage_lifecycle:lock"
+
+    def __init__(
+        self,
+        ttl_hours=STORAGE_TTL_HOURS,
+        max_local_bytes: int = LOCAL_STORAGE_MAX_BYTES,
+        target_ratio: float = LOCAL_STORAGE_TARGET_RATIO,
+        interval: float = STORAGE_SWEEP_INTERVAL,
+        batch_size: int = STORAGE_SWEEP_BATCH_SIZE,
+    ):
+        self.ttl_hours = {status: hours for status, hours in ttl_hours.items() if hours > 0}
+        self.max_local_bytes = max_local_bytes
+        self.target_ratio = target_ratio
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.input_storage: Optional[StorageService] = None
+        self.output_storage: Optional[StorageService] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, input_storage: StorageService, output_storage: StorageService):
+        '''
+        Start sweeping in the background, the storages are the ones uploads and outputs are written to
+        '''
+        self.input_storage = input_storage
+        self.output_storage = output_storage
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self._acquire_lock():
+                    await self.sweep()
+            except Exception as e:
+                logger.error(f"StorageLifecycleService: sweep failed: {e}", exc_info=True)
+
+    async def _acquire_lock(self) -> bool:
+        '''
+        One sweep per interval across processes: the lock is never released, it expires shortly before the next sweep
+        '''
+        try:
+            redis = redis_manager.get_client(RedisRole.CACHE)
+            return bool(await redis.set(self.LOCK_KEY, uuid.uuid4().hex, nx=True, ex=max(1, int(self.interval * 0.9))))
+        except Exception as e:
+            # deletes are idempotent, a duplicate sweep only costs work
+            logger.warning(f"StorageLifecycleService: lock unavailable, sweeping anyway: {e}")
+            return True
+
+    async def sweep(self) -> dict:
+        '''
+        Run both passes once, returns the number of tasks expired per reason
+        '''
+        start_time = time.perf_counter()
+        expired = {'ttl': await self._expire_by_age(), 'budget': await self._enforce_local_budget()}
+        elapsed = time.perf_counter() - start_time
+        STORAGE_LIFECYCLE_SWEEP_SECONDS.observe(elapsed)
+        logger.info("StorageLifecycleService: sweep done", extra={**expired, 'seconds': round(elapsed, 2)})
+        return expired
+
+    async def _expire_by_age(self) -> int:
+        if not self.ttl_hours:
+            return 0
+        now = datetime.now(timezone.utc)
+        cutoffs = {status: now - timedelta(hours=hours) for status, hours in self.ttl_hours.items()}
+        total = 0
+        while True:
+            tasks = await run_in_threadpool(_load_expired_tasks, cutoffs, self.batch_size)
+            if not tasks:
+                break
+            expired = await self._delete_task_files(tasks, reason="ttl")
+            total += expired
+            if len(tasks) < self.batch_size or expired == 0:
+                break  # done, or every delete failed and the same batch would come back
+        return total
+
+    async def _enforce_local_budget(self) -> int:
+        local_storages = self._local_storages()
+        if self.max_local_bytes <= 0 or not local_storages:
+            return 0
+        usage = 0
+        for storage in local_storages:
+            usage += await storage.disk_usage()
+        LOCAL_STORAGE_BYTES.set(usage)
+        if usage <= self.max_local_bytes:
+            return 0
+        to_free = usage - int(self.max_local_bytes * self.target_ratio)
+
+        logger.warning("StorageLifecycleService: local storage over budget", extra={'bytes': usage, 'budget': self.max_local_bytes})
+        total = 0
+        freed = 0
+        after = None
+        while freed < to_free:
+            rows = await run_in_threadpool(_load_oldest_tasks, self.batch_size, after)
+            if not rows:
+                break
+            after = rows[-1][2], rows[-1][0]
+
+            # take the oldest tasks until their local files add up to what has to be freed
+            chosen = []
+            for storage in local_storages:
+                file_ids = [file_id for _, input_id, _ in rows for file_id in self._task_file_ids(storage, input_id)]
+                sizes = await storage.file_sizes(file_ids)
+                for task_id, input_id, _ in rows:
+                    if freed >= to_free:
+                        break
+                    task_bytes = sum(sizes.get(file_id, 0) for file_id in self._task_file_ids(storage, input_id))
+                    if task_bytes:
+                        chosen.append((task_id, input_id))
+                        freed += task_bytes
+            if chosen:
+                total += await self._delete_task_files(list(dict.fromkeys(chosen)), reason="budget")
+            if len(rows) < self.batch_size:
+                break
+        LOCAL_STORAGE_BYTES.set(usage - freed)
+        return total
+
+    def _local_storages(self) -> List[LocalStorage]:
+        storages = []
+        for storage in (self.input_storage, self.output_storage):
+            if isinstance(storage, LocalStorage) and storage not in storages:
+                storages.append(storage)
+        return storages
+
+    def _task_file_ids(self, storage: StorageService, input_id: str) -> List[str]:
+        '''Files of a task held by the storage: its input, its output and every variant the output may have'''
+        file_ids = []
+        if storage is self.input_storage:
+            file_ids.append(input_id)
+        if storage is self.output_storage:
+            # the output in whichever format the task chose, variants are keyed off the PNG output key
+            file_ids.extend(all_output_file_ids(input_id))
+            file_ids.extend(all_variant_ids(StorageService.get_output_id(input_id)))
+        return file_ids
+
+    async def _delete_task_files(self, tasks: Sequence[Tuple], reason: str) -> int:
+        '''
+        Delete the files of (task id, input file id, ...) rows in one batch per storage and record it on the tasks.
+        Returns the number of tasks whose files are all gone.
+        '''
+        storages = dict.fromkeys([self.input_storage, self.output_storage])
+        failed = set()
+        for storage in storages:
+            file_ids = [file_id for task in tasks for file_id in self._task_file_ids(storage, task[1])]
+            failed |= await storage.delete_many(file_ids)
+        if failed:
+            STORAGE_LIFECYCLE_DELETE_FAILURES.inc(len(failed))
+
+        expired_ids = [
+            task[0] for task in tasks
+            if not any(file_id in failed for storage in storages for file_id in self._task_file_ids(storage, task[1]))
+        ]
+        await run_in_threadpool(_mark_expired, expired_ids, datetime.now(timezone.utc))
+        await task_state_store.discard(expired_ids)  # the image endpoints read the cached row, it must show the expiry
+        STORAGE_LIFECYCLE_TASKS_EXPIRED.labels(reason=reason).inc(len(expired_ids))
+        return len(expired_ids)
+
+
+storage_lifecycle = StorageLifecycleService()
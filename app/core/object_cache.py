@@ -0,0 +1,131 @@
+# in-process cache of hot image bytes
+## a task page requests the same few images many times at once, they are read from storage once
+## and served from memory until evicted; stored images never change, so entries are never stale
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from app.core.storage import StorageService, ObjectStream, resolve_range, _iter_bytes, STREAM_CHUNK_SIZE
+from app.logger_config import get_logger
+from app.monitoring import OBJECT_CACHE_REQUESTS, OBJECT_CACHE_BYTES_SAVED, OBJECT_CACHE_BYTES
+
+logger = get_logger(__name__)
+
+IMAGE_MEMORY_CACHE_MAX_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 0 disables the cache
+IMAGE_MEMORY_CACHE_MAX_OBJECT_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_OBJECT_BYTES", 4 * 1024 * 1024))
+
+
+class ObjectCache:
+    '''
+    Size-bounded LRU of whole objects by file id, in front of a storage's open_read.
+    Concurrent misses of the same object share one storage read, objects larger than `max_object_bytes`
+    are streamed from storage and remembered as such, so they are not opened twice again.
+    Only for write-once files such as outputs and their variants, entries are never invalidated;
+    bytes computed from such files, e.g. composites, are cached the same way by key.
+    '''
+    MISSING, OVERSIZED = "missing", "oversized"
+
+    def __init__(self, max_bytes: int = IMAGE_MEMORY_CACHE_MAX_BYTES, max_object_bytes: int = IMAGE_MEMORY_CACHE_MAX_OBJECT_BYTES):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self.size = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._oversized: OrderedDict[str, None] = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def open_read(
+        self, storage: StorageService, file_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Optional[ObjectStream]:
+        '''
+        storage.open_read served from memory when possible, same arguments, result and InvalidRangeError
+        '''
+        if self.max_bytes <= 0:
+            return await storage.open_read(file_id, start, end, chunk_size)
+        if file_id in self._oversized:
+            OBJECT_CACHE_REQUESTS.labels(result="bypass").inc()
+            return await storage.open_read(file_id, start, end, chunk_size)
+
+        content, saved = await self._get(file_id, lambda: self._load(storage, file_id))
+        if content == self.MISSING:
+            return None
+        if content == self.OVERSIZED:
+            return await storage.open_read(file_id, start, end, chunk_size)
+        return self._stream(content, saved, start, end, chunk_size)
+
+    async def open_computed(
+        self, key: str, compute: Callable[[], Awaitable[Optional[bytes]]], start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Optional[ObjectStream]:
+        '''
+        Like open_read for bytes that are computed instead of stored, e.g. composites of mask-only outputs.
+        Concurrent misses share one `compute`, None from it is not cached; results over `max_object_bytes` are served, not kept.
+        '''
+        if self.max_bytes <= 0:
+            content, saved = await compute(), False
+        else:
+            content, saved = await self._get(key, lambda: self._compute(key, compute))
+        if content is None or content == self.MISSING:
+            return None
+        return self._stream(content, saved, start, end, chunk_size)
+
+    async def _get(self, key: str, load: Callable[[], Awaitable[Union[bytes, str]]]) -> Tuple[Union[bytes, str], bool]:
+        '''(content or MISSING/OVERSIZED, whether it was served without a load of its own)'''
+        content = self._entries.get(key)
+        if content is not None:
+            self._entries.move_to_end(key)
+            OBJECT_CACHE_REQUESTS.labels(result="hit").inc()
+            return content, True
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            OBJECT_CACHE_REQUESTS.labels(result="miss").inc()
+            # a task of its own, so a cancelled request does not cancel the read others wait on
+            inflight = self._inflight[key] = asyncio.create_task(load())
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+            saved = False
+        else:
+            OBJECT_CACHE_REQUESTS.labels(result="coalesced").inc()
+            saved = True
+        return await asyncio.shield(inflight), saved
+
+    def _stream(self, content: bytes, saved: bool, start: int, end: Optional[int], chunk_size: int) -> ObjectStream:
+        start, end = resolve_range(len(content), start, end)
+        if saved:
+            OBJECT_CACHE_BYTES_SAVED.inc(end - start + 1)
+        return ObjectStream(_iter_bytes(content[start:end + 1], chunk_size), len(content), start, end)
+
+    async def _load(self, storage: StorageService, file_id: str) -> Union[bytes, str]:
+        stream = await storage.open_read(file_id)
+        if stream is None:
+            return self.MISSING
+        if stream.size > self.max_object_bytes:
+            await stream.aclose()
+            self._oversized[file_id] = None
+            while len(self._oversized) > 10000:
+                self._oversized.popitem(last=False)
+            OBJECT_CACHE_REQUESTS.labels(result="oversized").inc()
+            return self.OVERSIZED
+
+        content = b''.join([chunk async for chunk in stream])
+        self._keep(file_id, content)
+        return content
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable[Optional[bytes]]]) -> Union[bytes, str]:
+        content = await compute()
+        if content is None:
+            return self.MISSING
+        if len(content) > self.max_object_bytes:
+            OBJECT_CACHE_REQUESTS.labels(result="oversized").inc()
+        else:
+            self._keep(key, content)
+        return content
+
+    def _keep(self, key: str, content: bytes):
+        self._entries[key] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+        OBJECT_CACHE_BYTES.set(self.size)
+
+image_object_cache = ObjectCache()
@@ -0,0 +1,142 @@
+# encoding of task outputs, chosen per task through QueueTaskPayload.parameters
+## shared by the worker, which encodes outputs, and the API, which finds, serves and deletes them
+import io
+import os
+from typing import List, NamedTuple, Optional
+
+from PIL import Image
+
+
+class OutputFormat(NamedTuple):
+    pillow_format: str
+    media_type: str
+    suffix: str  # replaces the extension of the input file id
+
+
+OUTPUT_FORMATS = {
+    "png": OutputFormat("PNG", "image/png", ".output.png"),
+    "webp": OutputFormat("WEBP", "image/webp", ".output.webp"),
+    "jpeg": OutputFormat("JPEG", "image/jpeg", ".output.jpg"),
+    # only the single-channel alpha mask, the API composites the image on demand
+    "mask": OutputFormat("PNG", "image/png", ".mask.png"),
+}
+# defaults for tasks that do not choose, pinned into the task's parameters when it is created
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "png").lower()
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", 90))
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.getenv("OUTPUT_PNG_COMPRESS_LEVEL", 6))  # zlib level, 1 is fast PNG
+# tasks from before formats could be chosen, and tasks without pinned parameters, have PNG outputs
+STORED_OUTPUT_FORMAT = "png"
+# composites of mask-only outputs are encoded per request, so with a fast level
+COMPOSITE_PNG_COMPRESS_LEVEL = int(os.getenv("COMPOSITE_PNG_COMPRESS_LEVEL", 1))
+
+
+class OutputEncoding(NamedTuple):
+    format: str  # key of OUTPUT_FORMATS
+    quality: int  # webp and jpeg, for lossless webp the compression effort
+    compress_level: int  # png and mask
+    lossless: bool  # webp
+
+
+def output_encoding(parameters: Optional[dict], default_format: str = STORED_OUTPUT_FORMAT) -> OutputEncoding:
+    '''
+    The output encoding of task parameters:
+        output_format   png, webp, jpeg or mask
+        quality         1-100, webp and jpeg
+        lossless        webp
+        compress_level  0-9, png and mask
+    Missing ones take the OUTPUT_* defaults, the format `default_format`. Raises ValueError for invalid values.
+    '''
+    parameters = parameters or {}
+    fmt = str(parameters.get("output_format", default_format)).lower()
+    fmt = {"jpg": "jpeg"}.get(fmt, fmt)
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"unsupported output_format {fmt}, expected one of {', '.join(OUTPUT_FORMATS)}")
+    quality = parameters.get("quality", OUTPUT_QUALITY)
+    if not isinstance(quality, int) or isinstance(quality, bool) or not 1 <= quality <= 100:
+        raise ValueError("quality must be an integer between 1 and 100")
+    compress_level = parameters.get("compress_level", OUTPUT_PNG_COMPRESS_LEVEL)
+    if not isinstance(compress_level, int) or isinstance(compress_level, bool) or not 0 <= compress_level <= 9:
+        raise ValueError("compress_level must be an integer between 0 and 9")
+    lossless = parameters.get("lossless", False)
+    if not isinstance(lossless, bool):
+        raise ValueError("lossless must be a boolean")
+    return OutputEncoding(fmt, quality, compress_level, lossless)
+
+
+def pin_output_encoding(parameters: Optional[dict]) -> dict:
+    '''
+    Parameters of a new task with its encoding resolved against the current OUTPUT_* defaults,
+    so changing them later does not change where existing outputs are found. Raises ValueError.
+    '''
+    encoding = output_encoding(parameters, default_format=OUTPUT_FORMAT)
+    return {
+        **(parameters or {}),
+        "output_format": encoding.format,
+        "quality": encoding.quality,
+        "compress_level": encoding.compress_level,
+        "lossless": encoding.lossless,
+    }
+
+
+def _stem(input_id: str) -> str:
+    return '.'.join(input_id.split(".")[:-1])  # as StorageService.get_output_id
+
+
+def output_file_id(input_id: str, encoding: OutputEncoding) -> str:
+    '''Storage key of the output, PNG outputs keep the key of StorageService.get_output_id'''
+    return _stem(input_id) + OUTPUT_FORMATS[encoding.format].suffix
+
+
+def all_output_file_ids(input_id: str) -> List[str]:
+    '''Every key the output of the input can have'''
+    return [_stem(input_id) + fmt.suffix for fmt in OUTPUT_FORMATS.values()]
+
+
+def composite_file_id(input_id: str) -> str:
+    '''Cache key of the image composited from a mask-only output, never stored'''
+    return _stem(input_id) + ".composite.png"
+
+
+def encode_image(image: Image.Image, encoding: OutputEncoding) -> bytes:
+    '''Encode the composed image, or for "mask" the mask, in the encoding's format'''
+    fmt = OUTPUT_FORMATS[encoding.format]
+    if fmt.pillow_format == "PNG":
+        options = {"compress_level": encoding.compress_level}
+    elif fmt.pillow_format == "WEBP":
+        options = {"quality": encoding.quality, "lossless": encoding.lossless, "method": 4}
+    else:
+        options = {"quality": encoding.quality}
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt.pillow_format, **options)
+    return buffer.getvalue()
+
+
+def _composite_mode(image: Image.Image) -> str:
+    '''Mode of the worker's output for an input: channels are kept, alpha included, as compose_output does'''
+    if image.mode in ("1", "L", "I", "I;16"):
+        return "L"
+    if image.mode in ("LA", "La"):
+        return "LA"
+    if image.mode in ("RGBA", "RGBa") or (image.mode == "P" and "transparency" in image.info):
+        return "RGBA"
+    return "RGB"
+
+
+def composite_mask(input_content: bytes, mask_content: bytes) -> bytes:
+    '''
+    The final image of a mask-only output as the worker composes it: the input where the mask is opaque,
+    every channel, alpha included, blended to 255 where it is clear (black for grayscale inputs, like compose_output).
+    Encoded as PNG at COMPOSITE_PNG_COMPRESS_LEVEL. CPU bound, run it in a pool.
+    '''
+    with Image.open(io.BytesIO(input_content)) as image, Image.open(io.BytesIO(mask_content)) as mask:
+        mode = _composite_mode(image)
+        image = image.convert(mode)
+        mask = mask.convert("L")
+        if mask.size != image.size:
+            mask = mask.resize(image.size, Image.Resampling.BILINEAR)
+        background = Image.new(mode, image.size, 0 if mode == "L" else (255,) * len(mode))
+        buffer = io.BytesIO()
+        Image.composite(image, background, mask).save(buffer, format="PNG", compress_level=COMPOSITE_PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
@@ -0,0 +1,280 @@
+# fan-out of task events published by the worker
+## one pattern subscription per process instead of one Redis connection per SSE client
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+from app.core.redis import redis_manager, RedisRole
+from app.logger_config import get_logger
+from app.monitoring import TASK_EVENT_SUBSCRIBERS, TASK_EVENT_MESSAGES, TASK_EVENT_DROPPED
+
+logger = get_logger(__name__)
+
+_CLOSED = object()  # queue sentinel, the subscription was closed by the dispatcher
+
+
+class TaskSubscription:
+    '''
+    Events of one task for one local consumer, iterate with `async for`.
+    The queue is bounded; when the consumer falls behind the oldest event is dropped,
+    since every task event carries the full current status.
+    '''
+    def __init__(self, task_id: str, max_queue_size: int):
+        self.task_id = task_id
+        self.task_ids = {task_id}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._waiting = False
+        self.last_active = time.monotonic()
+        self.closed = False
+
+    def put(self, task_id: str, message: str):
+        if self._queue.full():
+            self._queue.get_nowait()
+            TASK_EVENT_DROPPED.labels(reason="backpressure").inc()
+        self._queue.put_nowait(message)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_CLOSED)
+
+    def is_idle(self, idle_timeout: float) -> bool:
+        '''Not waiting for events and not read for idle_timeout seconds: the consumer is stuck or gone'''
+        return not self._waiting and time.monotonic() - self.last_active > idle_timeout
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        self._waiting = True
+        try:
+            message = await self._queue.get()
+        finally:
+            self._waiting = False
+            self.last_active = time.monotonic()
+        if message is _CLOSED:
+            raise StopAsyncIteration
+        return message
+
+
+class TaskSetSubscription:
+    '''
+    Events of a changing set of tasks for one local consumer, e.g. a WebSocket.
+    Only the latest event per task is kept until the consumer takes them with next_batch,
+    so a slow consumer gets coalesced deltas instead of a growing backlog.
+    '''
+    def __init__(self):
+        self.task_ids: Set[str] = set()
+        self._pending: Dict[str, str] = {}  # task id to latest undelivered event
+        # tasks attached before their ownership is confirmed, to their latest event, never handed to next_batch
+        self._unconfirmed: Dict[str, Optional[str]] = {}
+        self._wakeup = asyncio.Event()
+        self._waiting = False
+        self.last_active = time.monotonic()
+        self.closed = False
+
+    def put(self, task_id: str, message: str):
+        if task_id in self._unconfirmed:
+            self._unconfirmed[task_id] = message
+            return
+        if task_id in self._pending:
+            TASK_EVENT_DROPPED.labels(reason="coalesced").inc()
+        self._pending[task_id] = message
+        self._wakeup.set()
+
+    def put_if_absent(self, task_id: str, message: str):
+        '''Queue an event unless one is pending for the task, which is at least as recent'''
+        if task_id not in self._pending:
+            self.put(task_id, message)
+
+    def hold(self, task_ids):
+        '''Keep events of the tasks out of next_batch until they are confirmed or discarded'''
+        for task_id in task_ids:
+            self._unconfirmed.setdefault(task_id, None)
+
+    def confirm(self, task_ids):
+        '''Release held tasks, queueing the latest event that arrived while they were held'''
+        for task_id in task_ids:
+            message = self._unconfirmed.pop(task_id, None)
+            if message is not None:
+                self.put(task_id, message)
+
+    def discard_pending(self, task_id: str):
+        self._pending.pop(task_id, None)
+        self._unconfirmed.pop(task_id, None)
+
+    def close(self):
+        self.closed = True
+        self._wakeup.set()
+
+    def is_idle(self, idle_timeout: float) -> bool:
+        return not self._waiting and time.monotonic() - self.last_active > idle_timeout
+
+    async def next_batch(self, timeout: float, linger: float = 0.0) -> Dict[str, str]:
+        '''
+        Wait up to timeout seconds for events, then up to linger seconds more to batch the ones that follow.
+        Returns the latest event per task, empty on timeout or once closed.
+        '''
+        self._waiting = True
+        try:
+            if not self._pending and not self.closed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if self._pending and linger > 0 and not self.closed:
+                await asyncio.sleep(linger)
+        finally:
+            self._waiting = False
+            self.last_active = time.monotonic()
+
+        self._wakeup.clear()
+        if self.closed:
+            return {}
+        batch, self._pending = self._pending, {}
+        return batch
+
+
+class TaskEventDispatcher:
+    '''
+    Holds a single PSUBSCRIBE on task:* and fans each message out to the
+    in-memory queues of the local subscribers of that task.
+    Reconnects on Redis errors; events published while disconnected are lost.
+    '''
+    CHANNEL_PATTERN = "task:*"
+
+    def __init__(self, max_queue_size: int = 16, idle_timeout: float = 300.0, reconnect_delay: float = 1.0, ready_timeout: float = 5.0):
+        self.max_queue_size = max_queue_size
+        self.idle_timeout = idle_timeout
+        self.reconnect_delay = reconnect_delay
+        self.ready_timeout = ready_timeout
+
+        self._subscribers: Dict[str, Set[TaskSubscription]] = {}  # task id to local subscribers
+        self._ready = asyncio.Event()  # set while the pattern subscription is active
+        self._start_lock = asyncio.Lock()
+        self._listener: Optional[asyncio.Task] = None
+        self._reaper: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._ready.is_set():
+            return
+        async with self._start_lock:
+            if self._listener is None:
+                self._listener = asyncio.create_task(self._listen())
+                self._reaper = asyncio.create_task(self._reap_idle())
+        await asyncio.wait_for(self._ready.wait(), timeout=self.ready_timeout)
+
+    async def stop(self):
+        for task in (self._listener, self._reaper):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*[t for t in (self._listener, self._reaper) if t is not None], return_exceptions=True)
+        self._listener = self._reaper = None
+        self._ready.clear()
+        for subscriptions in list(self._subscribers.values()):
+            for subscription in list(subscriptions):
+                self._remove(subscription)
+
+    @asynccontextmanager
+    async def subscribe(self, task_id: str) -> AsyncIterator[TaskSubscription]:
+        await self.start()
+        subscription = TaskSubscription(task_id, self.max_queue_size)
+        self._subscribers.setdefault(task_id, set()).add(subscription)
+        TASK_EVENT_SUBSCRIBERS.inc()
+        try:
+            yield subscription
+        finally:
+            self._remove(subscription)
+
+    @asynccontextmanager
+    async def subscribe_many(self) -> AsyncIterator[TaskSetSubscription]:
+        '''
+        A subscription to no task yet, change its tasks with add_tasks / remove_tasks
+        '''
+        await self.start()
+        subscription = TaskSetSubscription()
+        TASK_EVENT_SUBSCRIBERS.inc()
+        try:
+            yield subscription
+        finally:
+            self._remove(subscription)
+
+    def add_tasks(self, subscription: TaskSetSubscription, task_ids):
+        for task_id in task_ids:
+            subscription.task_ids.add(task_id)
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+
+    def remove_tasks(self, subscription: TaskSetSubscription, task_ids):
+        for task_id in task_ids:
+            subscription.task_ids.discard(task_id)
+            subscription.discard_pending(task_id)
+            self._unregister(task_id, subscription)
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+    def _unregister(self, task_id: str, subscription):
+        subscriptions = self._subscribers.get(task_id)
+        if not subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[task_id]
+
+    def _remove(self, subscription):
+        if subscription.closed:
+            return
+        for task_id in subscription.task_ids:
+            self._unregister(task_id, subscription)
+        subscription.close()
+        TASK_EVENT_SUBSCRIBERS.dec()
+
+    def _dispatch(self, task_id: str, message: str):
+        TASK_EVENT_MESSAGES.inc()
+        for subscription in self._subscribers.get(task_id, ()):
+            subscription.put(task_id, message)
+
+    async def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                redis_client = redis_manager.get_client(RedisRole.PUBSUB)
+                pubsub = redis_client.pubsub()
+                await pubsub.psubscribe(self.CHANNEL_PATTERN)
+                self._ready.set()
+                logger.info("TaskEventDispatcher: subscribed", extra={'pattern': self.CHANNEL_PATTERN})
+
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    task_id = message['channel'].split(':', 1)[1]
+                    self._dispatch(task_id, message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"TaskEventDispatcher: subscription lost: {e}, reconnecting", exc_info=True)
+                await asyncio.sleep(self.reconnect_delay)
+            finally:
+                self._ready.clear()
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 4)
+            for subscriptions in list(self._subscribers.values()):
+                for subscription in list(subscriptions):
+                    if subscription.is_idle(self.idle_timeout):
+                        logger.warning("TaskEventDispatcher: removing idle subscriber", extra={'task_ids': sorted(subscription.task_ids)[:10]})
+                        TASK_EVENT_DROPPED.labels(reason="idle").inc()
+                        self._remove(subscription)
+
+
+task_event_dispatcher = TaskEventDispatcher()
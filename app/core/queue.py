@@ -5,7 +5,7 @@ from uuid import UUID
 import os 
 from datetime import datetime
 from typing import Any
-from app.core.redis import RedisClient
+from app.core.redis import redis_manager, RedisRole
 from app.logger_config import get_logger
 
 logger = get_logger(__name__)
@@ -43,7 +43,7 @@ class RedisTaskQueueService(BaseTaskQueueService):
         self.timeout = timeout
 
     async def _init_redis(self):
-        self.redis = await RedisClient.get_client(db=int(os.getenv("REDIS_QUEUE_DB", 0)))  # use db 0 for queue
+        self.redis = redis_manager.get_client(RedisRole.QUEUE)  # own pool, BRPOP holds its connection while waiting
 
     async def enqueue(self, task_payload: QueueTaskPayload) -> bool:
         if self.redis is None:
@@ -0,0 +1,135 @@
+# rate limiting with one atomic Redis call per lease of permits
+## most requests are admitted from an in-process bucket of permits leased from the shared Redis window counter
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+
+from app.models import SubscriptionTier
+from app.schemas import User as UserPrincipal
+from app.core.redis import redis_manager, RedisRole
+from app.monitoring import RATE_LIMIT_DECISIONS, RATE_LIMIT_REDIS_LATENCY, route_template
+from app.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+# limit multiplier per subscription tier, anonymous clients get the FREE limit
+TIER_MULTIPLIERS = {
+    SubscriptionTier.FREE: 1,
+    SubscriptionTier.PRO: int(os.getenv("RATE_LIMIT_PRO_MULTIPLIER", 5)),
+}
+# share of a limit a process may lease at once, 0 leases a single permit per Redis call
+RATE_LIMIT_LEASE_FRACTION = float(os.getenv("RATE_LIMIT_LEASE_FRACTION", 0.1))
+
+# KEYS[1]: window counter; ARGV: limit, window in ms, permits wanted
+# returns {permits granted, ms until the window resets}
+LEASE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local wanted = tonumber(ARGV[3])
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local granted = math.min(wanted, limit - used)
+if granted > 0 then
+    if redis.call('INCRBY', KEYS[1], granted) == granted then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+else
+    granted = 0
+end
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl < 0 then
+    ttl = tonumber(ARGV[2])
+end
+return {granted, ttl}
+"""
+
+
+class RateLimiter:
+    '''
+    Fixed window limit of `times` requests per `seconds` per client and route, scaled by subscription tier.
+    Clients are identified by user id when authenticated, else by IP.
+
+    Permits are taken from the Redis window counter in leases of up to `lease_fraction` of the limit
+    with one atomic Lua call, and spent locally until used up or the window resets.
+    Denials are cached locally until the window resets as well, so Redis sees one call per lease, not per request.
+    Leased permits count against the shared limit, so the limit holds across processes;
+    a process may be refused while permits sit unused in another process's lease.
+    '''
+    KEY_PREFIX = "ratelimit:"
+
+    def __init__(self, times: int, seconds: int, lease_fraction: float = RATE_LIMIT_LEASE_FRACTION, max_local_keys: int = 10000):
+        self.times = times
+        self.seconds = seconds
+        self.lease_fraction = lease_fraction
+        self.max_local_keys = max_local_keys
+        self._local: OrderedDict[str, list] = OrderedDict()  # key to [permits left, window reset (monotonic), denied by Redis]
+        self._script = None
+
+    def limit_for(self, principal: Optional[UserPrincipal]) -> int:
+        tier = principal.subscription_tier if principal is not None else SubscriptionTier.FREE
+        return self.times * TIER_MULTIPLIERS.get(tier, 1)
+
+    @staticmethod
+    def identify(request: Request, principal: Optional[UserPrincipal]) -> str:
+        if principal is not None:
+            return f"user:{principal.id}"
+        forwarded = request.headers.get("X-Forwarded-For")
+        ip = forwarded.split(",")[0].strip() if forwarded else (request.client.host if request.client else "unknown")
+        return f"ip:{ip}"
+
+    async def hit(self, request: Request, principal: Optional[UserPrincipal] = None):
+        '''
+        Take one permit for the request, raises 429 with Retry-After when the limit is reached
+        '''
+        key = f"{self.KEY_PREFIX}{self.identify(request, principal)}:{request.method}:{route_template(request.scope)}"
+        now = time.monotonic()
+
+        entry = self._local.get(key)
+        if entry is not None and entry[1] > now:
+            self._local.move_to_end(key)
+            if entry[0] > 0:
+                entry[0] -= 1
+                RATE_LIMIT_DECISIONS.labels(source="local", result="allowed").inc()
+                return
+            if entry[2]:
+                RATE_LIMIT_DECISIONS.labels(source="local", result="denied").inc()
+                self._deny(entry[1] - now)
+
+        limit = self.limit_for(principal)
+        wanted = max(1, int(limit * self.lease_fraction))
+        try:
+            granted, ttl_ms = await self._lease(key, limit, wanted)
+        except Exception as e:
+            # fail open, an unavailable Redis must not take the API down
+            logger.warning(f"RateLimiter: redis lease failed: {e}", extra={'key': key})
+            RATE_LIMIT_DECISIONS.labels(source="redis", result="error").inc()
+            return
+
+        self._local[key] = [max(0, granted - 1), now + ttl_ms / 1000, granted == 0]
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_local_keys:
+            self._local.popitem(last=False)
+
+        if granted > 0:
+            RATE_LIMIT_DECISIONS.labels(source="redis", result="allowed").inc()
+            return
+        RATE_LIMIT_DECISIONS.labels(source="redis", result="denied").inc()
+        self._deny(ttl_ms / 1000)
+
+    async def _lease(self, key: str, limit: int, wanted: int):
+        if self._script is None:
+            self._script = redis_manager.get_client(RedisRole.CACHE).register_script(LEASE_SCRIPT)
+        start_time = time.perf_counter()
+        granted, ttl_ms = await self._script(keys=[key], args=[limit, self.seconds * 1000, wanted])
+        RATE_LIMIT_REDIS_LATENCY.observe(time.perf_counter() - start_time)
+        return int(granted), int(ttl_ms)
+
+    @staticmethod
+    def _deny(retry_after: float):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too Many Requests",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
@@ -1,24 +1,132 @@
-import redis.asyncio as aioredis
-from typing import Optional
+# Redis connections, one pool per role
+## a blocking BRPOP or a pub/sub listener can never take the connections publishes and cache reads need
+import asyncio
+import enum
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+from redis.asyncio.connection import BlockingConnectionPool, parse_url
+from redis.exceptions import ConnectionError
+
+from app.monitoring import REDIS_POOL_MAX_CONNECTIONS, REDIS_POOL_IN_USE, REDIS_POOL_WAIT, REDIS_POOL_EXHAUSTED
+
+
+class RedisRole(str, enum.Enum):
+    QUEUE = "queue"                # task queue, BRPOP holds a connection for up to its timeout
+    PUBSUB = "pubsub"              # subscriptions, each holds a connection while subscribed
+    CACHE = "cache"                # task state, auth cache, rate limiter
+    NOTIFICATION = "notification"  # worker status and progress publishes
+
+
+# pool size, and socket timeout in seconds (None for connections that block by design)
+ROLE_DEFAULTS = {
+    RedisRole.QUEUE: (4, None),
+    RedisRole.PUBSUB: (4, None),
+    RedisRole.CACHE: (32, 5.0),
+    RedisRole.NOTIFICATION: (8, 5.0),
+}
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    '''
+    Blocking pool: when all connections are in use a command waits up to `timeout` seconds
+    for one instead of failing right away, with wait time, usage and exhaustion metrics.
+    '''
+    def __init__(self, role: RedisRole, **kwargs):
+        super().__init__(**kwargs)
+        self.role = role
+        self._checked_out = 0
+        REDIS_POOL_MAX_CONNECTIONS.labels(role=role.value).set(self.max_connections)
+
+    async def get_connection(self, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except ConnectionError as e:
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                REDIS_POOL_EXHAUSTED.labels(role=self.role.value).inc()
+            raise
+        REDIS_POOL_WAIT.labels(role=self.role.value).observe(time.perf_counter() - start_time)
+        self._checked_out += 1
+        REDIS_POOL_IN_USE.labels(role=self.role.value).set(self._checked_out)
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        self._checked_out = max(0, self._checked_out - 1)
+        REDIS_POOL_IN_USE.labels(role=self.role.value).set(self._checked_out)
+
+
+class RedisConnectionManager:
+    '''
+    One client per role, each on its own sized pool.
+    Connection from REDIS_URL, else REDIS_HOST / REDIS_PORT / REDIS_PASSWORD.
+    Per role overrides: REDIS_POOL_<ROLE> (pool size) and REDIS_<ROLE>_DB (database, default REDIS_QUEUE_DB).
+    '''
+    def __init__(self, pool_timeout: float = 5.0):
+        self.pool_timeout = pool_timeout
+        self._clients: Dict[RedisRole, aioredis.Redis] = {}
+
+    @staticmethod
+    def _connection_kwargs() -> dict:
+        if os.getenv("REDIS_URL"):
+            return parse_url(os.getenv("REDIS_URL"))
+        return {
+            'host': os.getenv("REDIS_HOST", "localhost"),
+            'port': int(os.getenv("REDIS_PORT", 6379)),
+            'password': os.getenv("REDIS_PASSWORD", None),
+        }
+
+    def _create_client(self, role: RedisRole) -> aioredis.Redis:
+        default_size, socket_timeout = ROLE_DEFAULTS[role]
+        kwargs = self._connection_kwargs()
+        kwargs['db'] = int(os.getenv(f"REDIS_{role.name}_DB", os.getenv("REDIS_QUEUE_DB", kwargs.get('db', 0))))
+        pool = InstrumentedConnectionPool(
+            role,
+            max_connections=int(os.getenv(f"REDIS_POOL_{role.name}", default_size)),
+            timeout=self.pool_timeout,
+            socket_timeout=socket_timeout,
+            encoding="utf-8",
+            decode_responses=True,
+            **kwargs,
+        )
+        return aioredis.Redis.from_pool(pool)
+
+    def get_client(self, role: RedisRole) -> aioredis.Redis:
+        '''
+        The client of a role, created on first use, connections are opened lazily
+        '''
+        client = self._clients.get(role)
+        if client is None:
+            client = self._clients[role] = self._create_client(role)
+        return client
+
+    @asynccontextmanager
+    async def pipeline(self, role: RedisRole, transaction: bool = False) -> AsyncIterator[Pipeline]:
+        '''
+        Queue commands on the yielded pipeline and send them with `await pipe.execute()`, one round trip.
+        transaction=True wraps them in MULTI/EXEC.
+        '''
+        async with self.get_client(role).pipeline(transaction=transaction) as pipe:
+            yield pipe
+
+    async def batch(self, role: RedisRole, commands: Iterable[Tuple], transaction: bool = False) -> list:
+        '''
+        Run commands given as tuples, e.g. ("hgetall", key), in one round trip, returns their results in order
+        '''
+        async with self.pipeline(role, transaction=transaction) as pipe:
+            for command, *args in commands:
+                getattr(pipe, command)(*args)
+            return await pipe.execute()
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
 
-class RedisClient:
-    _client: Optional[aioredis.Redis] = None
-    _redis_host: str = os.getenv("REDIS_HOST", "localhost")
-    _redis_port: int = int(os.getenv("REDIS_PORT", 6379))
-    _redis_password: str = os.getenv("REDIS_PASSWORD", None)
-    
-    @classmethod
-    async def get_client(cls, db: int = 0) -> aioredis.Redis:
-        if cls._client is None:
-            cls._client = await aioredis.from_url(
-                f"redis://{cls._redis_host}:{cls._redis_port}/{db}",
-                password=cls._redis_password,
-                encoding="utf-8",
-                decode_responses=True,
-                max_connections=20
-            )
-        return cls._client
-
-
-    
\ No newline at end of file
+redis_manager = RedisConnectionManager(pool_timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5.0)))
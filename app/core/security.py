@@ -1,37 +1,170 @@
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Callable, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
 from jose import JWTError, jwt
+import argon2
 from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
+
+from app.monitoring import (
+    PASSWORD_HASH_QUEUE_TIME,
+    PASSWORD_HASH_DURATION,
+    PASSWORD_HASH_REJECTED,
+    PASSWORD_HASH_IN_FLIGHT,
+)
 
 import os
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# embed the user principal in issued tokens, see app.core.auth_cache.principal_claims
+SELF_CONTAINED_TOKENS = os.getenv("AUTH_SELF_CONTAINED_TOKENS", "false").lower() == "true"
+
+# Argon2 parameters, tune with `python -m app.core.security --target-ms 250`
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", argon2.DEFAULT_TIME_COST))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", argon2.DEFAULT_MEMORY_COST))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", argon2.DEFAULT_PARALLELISM))
+
+# Dedicated executor so hashing never competes with the shared threadpool of sync dependencies
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))  # running + queued
+
+_password_hasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM,
+)
+
+T = TypeVar("T")
+
+
+class PasswordHashingBusy(Exception):
+    '''Raised when the password hashing executor is at capacity'''
+
+
+class PasswordHashingExecutor:
+    '''
+    Bounded thread pool for Argon2 work with admission control:
+    at most `max_pending` operations are running or queued, further ones are rejected right away.
+    '''
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self._max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    async def run(self, op: str, fn: Callable[..., T], *args) -> T:
+        with self._lock:
+            if self._pending >= self._max_pending:
+                PASSWORD_HASH_REJECTED.labels(op=op).inc()
+                raise PasswordHashingBusy(f"Password hashing executor is full ({self._max_pending} pending)")
+            self._pending += 1
+            PASSWORD_HASH_IN_FLIGHT.set(self._pending)
+
+        submitted_at = time.perf_counter()
+
+        def timed():
+            started_at = time.perf_counter()
+            PASSWORD_HASH_QUEUE_TIME.labels(op=op).observe(started_at - submitted_at)
+            try:
+                return fn(*args)
+            finally:
+                PASSWORD_HASH_DURATION.labels(op=op).observe(time.perf_counter() - started_at)
+
+        try:
+            future = self._executor.submit(timed)
+        except BaseException:
+            self._release()
+            raise
+        # released once the work is done, not when the caller stops waiting: a disconnected request's hash keeps running
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            PASSWORD_HASH_IN_FLIGHT.set(self._pending)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+password_hash_executor = PasswordHashingExecutor(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    ph = PasswordHasher()
     try:
-        return ph.verify(hashed_password, plain_password)
-    except VerifyMismatchError as e:
+        return _password_hasher.verify(hashed_password, plain_password)
+    except (VerifyMismatchError, InvalidHashError) as e:
         return False
 
 
 def get_password_hash(password: str) -> str:
-    ph = PasswordHasher()
-    return ph.hash(password)
+    return _password_hasher.hash(password)
+
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    '''True if the hash was made with other Argon2 parameters than the configured ones'''
+    return _password_hasher.check_needs_rehash(hashed_password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    '''verify_password on the password hashing executor, raises PasswordHashingBusy when full'''
+    return await password_hash_executor.run("verify", verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    '''get_password_hash on the password hashing executor, raises PasswordHashingBusy when full'''
+    return await password_hash_executor.run("hash", get_password_hash, password)
+
+
+def calibrate_argon2(target_ms: float, parallelism: int = ARGON2_PARALLELISM, memory_cost: int = ARGON2_MEMORY_COST, rounds: int = 5) -> dict:
+    '''
+    Find the largest time_cost whose median hash latency on this machine stays under target_ms,
+    halving memory_cost (down to 8 MiB) if even time_cost=1 is too slow.
+    '''
+    def median_ms(hasher: PasswordHasher) -> float:
+        samples = []
+        for _ in range(rounds):
+            start_time = time.perf_counter()
+            hasher.hash("calibration-password")
+            samples.append((time.perf_counter() - start_time) * 1000)
+        return sorted(samples)[len(samples) // 2]
+
+    while True:
+        time_cost = 1
+        latency = median_ms(PasswordHasher(time_cost=1, memory_cost=memory_cost, parallelism=parallelism))
+        if latency <= target_ms or memory_cost <= 8 * 1024:
+            break
+        memory_cost //= 2
+
+    while True:
+        candidate = median_ms(PasswordHasher(time_cost=time_cost + 1, memory_cost=memory_cost, parallelism=parallelism))
+        if candidate > target_ms:
+            break
+        time_cost += 1
+        latency = candidate
+
+    return {
+        "ARGON2_TIME_COST": time_cost,
+        "ARGON2_MEMORY_COST": memory_cost,
+        "ARGON2_PARALLELISM": parallelism,
+        "measured_ms": round(latency, 1),
+    }
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
-    
+
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    
+
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -42,4 +175,17 @@ def decode_access_token(token: str) -> Optional[dict]:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         return payload
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Tune Argon2 parameters against a latency target")
+    parser.add_argument("--target-ms", type=float, default=250.0)
+    args = parser.parse_args()
+
+    result = calibrate_argon2(args.target_ms)
+    print(f"# median hash latency {result.pop('measured_ms')} ms (target {args.target_ms} ms)")
+    for key, value in result.items():
+        print(f"{key}={value}")
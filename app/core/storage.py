@@ -2,18 +2,93 @@
 # app/core/storage.py
 
 import os
+import time
+import uuid
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, Set, Tuple
+
 import aiofiles
+import aiofiles.os
 import aioboto3
+from aiobotocore.config import AioConfig
 
 
 
 from app.logger_config import get_logger
+from app.monitoring import STORAGE_CACHE_REQUESTS, STORAGE_CACHE_EVICTIONS, STORAGE_CACHE_BYTES
 logger = get_logger(__name__)
 
+STREAM_CHUNK_SIZE = int(os.getenv("STORAGE_STREAM_CHUNK_SIZE", 256 * 1024))  # bytes per chunk of streamed reads
+LOCAL_STORAGE_SHARD_DEPTH = int(os.getenv("LOCAL_STORAGE_SHARD_DEPTH", 2))  # levels of 256 hash-prefix directories, see LocalStorage
+# local disk cache in front of S3, see CachedStorage
+STORAGE_CACHE_DIR = os.getenv("STORAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "photo_studio_storage_cache"))
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+class InvalidRangeError(ValueError):
+    '''The requested byte range starts past the end of the object'''
+    def __init__(self, size: int):
+        super().__init__(f"range not satisfiable, object size {size}")
+        self.size = size
+
+
+def resolve_range(size: int, start: int = 0, end: Optional[int] = None) -> Tuple[int, int]:
+    '''
+    Clamp an inclusive byte range to an object of `size` bytes, end None reads to the end.
+    A negative start with end None is a suffix range: the last -start bytes.
+    '''
+    if start < 0 and end is None:
+        start = max(0, size + start)
+    if start < 0 or (end is not None and end < start):
+        raise ValueError(f"invalid byte range {start}-{end}")
+    if start >= size and size > 0:
+        raise InvalidRangeError(size)
+    end = size - 1 if end is None else min(end, size - 1)
+    return start, end
+
+
+class ObjectStream:
+    '''
+    An opened read of bytes start..end (inclusive) of an object of `size` bytes.
+    `async for chunk in stream` yields the bytes, call aclose() if it is not read to the end.
+    '''
+    def __init__(self, chunks: AsyncIterator[bytes], size: int, start: int, end: int):
+        self._chunks = chunks
+        self.size = size
+        self.start = start
+        self.end = end
+
+    @property
+    def content_length(self) -> int:
+        return self.end - self.start + 1
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._chunks
+
+    async def aclose(self):
+        await self._chunks.aclose()
+
+
+async def _iter_bytes(content: bytes, chunk_size: int) -> AsyncIterator[bytes]:
+    view = memoryview(content)
+    for offset in range(0, len(view), chunk_size):
+        yield bytes(view[offset:offset + chunk_size])
+
 
 class StorageService:
     ''''Abstract storage service
     '''
+    async def start(self):
+        """open long-lived resources, e.g. clients, called on startup"""
+        pass
+
+    async def stop(self):
+        """release long-lived resources, called on shutdown"""
+        pass
+
     async def save(self, file_id: str, content: bytes) -> bool:
         """save file, return access path"""
         raise NotImplementedError("Not implemented")
@@ -26,10 +101,39 @@ class StorageService:
         """delete file"""
         raise NotImplementedError("Not implemented")
     
+    async def delete_many(self, file_ids: List[str]) -> Set[str]:
+        """delete files in a batch, returns the ids that could not be deleted, missing files count as deleted"""
+        failed = set()
+        for file_id in file_ids:
+            if await self.exists(file_id) and not await self.delete(file_id):
+                failed.add(file_id)
+        return failed
+
     async def exists(self, file_id: str) -> bool:
         """check if file exists"""
         raise NotImplementedError("Not implemented")
 
+    async def open_read(self, file_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Optional[ObjectStream]:
+        """open a streamed read of bytes start..end (inclusive), None if the file does not exist
+        a negative start with end None reads the last -start bytes
+        raises InvalidRangeError if start is past the end of the file
+        the default buffers the whole file, backends override it to stream"""
+        content = await self.read(file_id)
+        if content is None:
+            return None
+        start, end = resolve_range(len(content), start, end)
+        return ObjectStream(_iter_bytes(content[start:end + 1], chunk_size), len(content), start, end)
+
+    async def presign_read(self, file_id: str, expires_in: int, cache_control: Optional[str] = None) -> Optional[str]:
+        """URL clients can download the file from directly for `expires_in` seconds, None if the backend has none
+        cache_control is sent with the download where the backend supports it"""
+        return None
+
+    async def save_stream(self, file_id: str, chunks: AsyncIterable[bytes]) -> bool:
+        """save file from an async iterator of chunks
+        the default buffers the whole file, backends override it to stream"""
+        return await self.save(file_id, b''.join([chunk async for chunk in chunks]))
+
     @staticmethod
     def get_output_id(file_id: str) -> str:
         aaa = file_id.split(".")
@@ -38,62 +142,276 @@ class StorageService:
     
 
 class LocalStorage(StorageService):
-    def __init__(self):
+    '''
+    Files under UPLOAD_DIR in a hash-prefix fan-out, <UPLOAD_DIR>/3f/a2/<file_id> for the default depth 2,
+    i.e. spread over 65536 directories that each stay small. LOCAL_STORAGE_SHARD_DEPTH=0 keeps the flat layout.
+    Files of the flat layout are still found until moved with `python -m app.migrate_storage`.
+    Filesystem calls run in threads, off the event loop.
+    '''
+    def __init__(self, shard_depth: Optional[int] = None):
         self.base_dir = os.path.join(os.path.expanduser(os.getenv("ROOT_DIR")), os.getenv("UPLOAD_DIR"))
+        self.shard_depth = LOCAL_STORAGE_SHARD_DEPTH if shard_depth is None else shard_depth
         os.makedirs(self.base_dir, exist_ok=True)
+        self._known_dirs: Set[str] = {self.base_dir}  # shard directories known to exist
+        # lookups fall back to flat paths only while unmigrated files are left, checked once at startup
+        self._flat_fallback = self.shard_depth > 0 and self._has_flat_files()
+
+    def _has_flat_files(self) -> bool:
+        with os.scandir(self.base_dir) as entries:
+            return any(entry.is_file(follow_symlinks=False) for entry in entries)
 
     def get_local_file_path(self, file_id: str) -> str:
+        if self.shard_depth <= 0:
+            return os.path.join(self.base_dir, file_id)
+        digest = hashlib.sha1(file_id.encode()).hexdigest()
+        shards = [digest[2 * level:2 * level + 2] for level in range(self.shard_depth)]
+        return os.path.join(self.base_dir, *shards, file_id)
+
+    def get_flat_file_path(self, file_id: str) -> str:
+        '''Path of the file in the flat layout, before migration'''
         return os.path.join(self.base_dir, file_id)
 
+    def _candidate_paths(self, file_id: str) -> List[str]:
+        path = self.get_local_file_path(file_id)
+        if not self._flat_fallback:
+            return [path]
+        # sharded again last: a running migration may have moved the file in between
+        return [path, self.get_flat_file_path(file_id), path]
+
+    async def locate(self, file_id: str) -> Optional[str]:
+        '''
+        Path of an existing file, in the sharded or the flat layout, None if there is none
+        '''
+        for file_path in self._candidate_paths(file_id):
+            if await aiofiles.os.path.isfile(file_path):
+                return file_path
+        return None
+
+    async def _ensure_dir(self, file_path: str):
+        directory = os.path.dirname(file_path)
+        if directory not in self._known_dirs:
+            await aiofiles.os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+
     async def save(self, file_id: str, content: bytes) -> bool:
-        """save file, return access path"""
+        """save file via a temporary file renamed into place, like save_stream: readers,
+        also of other processes that found it by exists(), never see a partial file"""
+        file_path = self.get_local_file_path(file_id)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
         try:
-            file_path = self.get_local_file_path(file_id)
-            async with aiofiles.open(file_path, 'wb') as f:
+            await self._ensure_dir(file_path)
+            async with aiofiles.open(temp_path, 'wb') as f:
                 await f.write(content)
+            await aiofiles.os.replace(temp_path, file_path)
             return True
         except Exception as e:
             logger.error(f"LocalStorage: save file failed: {e}", exc_info=True)
+            try:
+                await aiofiles.os.remove(temp_path)
+            except FileNotFoundError:
+                pass
             return False
     
     async def read(self, file_id: str) -> bytes:
         """read file content"""
         try:
-            file_path = self.get_local_file_path(file_id)
-            async with aiofiles.open(file_path, 'rb') as f:
-                return await f.read()
-        except FileNotFoundError:
+            for file_path in self._candidate_paths(file_id):
+                try:
+                    async with aiofiles.open(file_path, 'rb') as f:
+                        return await f.read()
+                except FileNotFoundError:
+                    continue
             logger.error(f"LocalStorage: file not found: {file_id}")
             return None
         except Exception as e:
             logger.error(f"LocalStorage: read file failed: {e}", exc_info=True)
             return None
 
-    async def delete(self, file_id: str) -> bool:
+    async def open_read(self, file_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Optional[ObjectStream]:
+        for file_path in self._candidate_paths(file_id):
+            try:
+                size = (await aiofiles.os.stat(file_path)).st_size
+            except FileNotFoundError:
+                continue
+            start, end = resolve_range(size, start, end)
+            return ObjectStream(self._read_chunks(file_path, start, end - start + 1, chunk_size), size, start, end)
+        logger.error(f"LocalStorage: file not found: {file_id}")
+        return None
+
+    @staticmethod
+    async def _read_chunks(file_path: str, start: int, length: int, chunk_size: int) -> AsyncIterator[bytes]:
+        async with aiofiles.open(file_path, 'rb') as f:
+            await f.seek(start)
+            while length > 0:
+                chunk = await f.read(min(chunk_size, length))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+
+    async def save_stream(self, file_id: str, chunks: AsyncIterable[bytes]) -> bool:
+        """write to a temporary file renamed into place, readers never see a partial file"""
+        file_path = self.get_local_file_path(file_id)
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
         try:
-            file_path = self.get_local_file_path(file_id)
-            os.remove(file_path)
+            await self._ensure_dir(file_path)
+            async with aiofiles.open(temp_path, 'wb') as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+            await aiofiles.os.replace(temp_path, file_path)
             return True
+        except Exception as e:
+            logger.error(f"LocalStorage: save stream failed: {e}", exc_info=True)
+            try:
+                await aiofiles.os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            return False
+
+    async def delete(self, file_id: str) -> bool:
+        try:
+            for file_path in self._candidate_paths(file_id):
+                try:
+                    await aiofiles.os.remove(file_path)
+                    return True
+                except FileNotFoundError:
+                    continue
+            logger.error(f"LocalStorage: delete file failed, not found: {file_id}")
+            return False
         except Exception as e:
             logger.error(f"LocalStorage: delete file failed: {e}", exc_info=True)
             return False
     
     async def exists(self, file_id: str) -> bool:
-        file_path = self.get_local_file_path(file_id)
-        return os.path.exists(file_path)
+        return await self.locate(file_id) is not None
+
+    async def delete_many(self, file_ids: List[str]) -> Set[str]:
+        """one thread hop for the whole batch"""
+        return await asyncio.to_thread(self._delete_files, file_ids)
+
+    def _delete_files(self, file_ids: List[str]) -> Set[str]:
+        failed = set()
+        for file_id in file_ids:
+            for file_path in self._candidate_paths(file_id):
+                try:
+                    os.remove(file_path)
+                    break
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.error(f"LocalStorage: delete file failed: {e}", extra={'file_id': file_id})
+                    failed.add(file_id)
+                    break
+        return failed
+
+    async def file_sizes(self, file_ids: List[str]) -> Dict[str, int]:
+        """sizes of the existing files among file_ids, one thread hop for the whole batch"""
+        def stat_files():
+            sizes = {}
+            for file_id in file_ids:
+                for file_path in self._candidate_paths(file_id):
+                    try:
+                        sizes[file_id] = os.stat(file_path).st_size
+                        break
+                    except FileNotFoundError:
+                        continue
+            return sizes
+        return await asyncio.to_thread(stat_files)
+
+    async def disk_usage(self, stale_part_seconds: float = 86400) -> int:
+        """bytes of all files under the base directory, walked in a thread;
+        temporary .part files older than stale_part_seconds are left over by crashed writes and removed"""
+        def walk() -> int:
+            total = 0
+            stale_before = time.time() - stale_part_seconds
+            directories = [self.base_dir]
+            while directories:
+                with os.scandir(directories.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                            continue
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                            if entry.name.endswith('.part') and stat.st_mtime < stale_before:
+                                os.remove(entry.path)
+                                continue
+                        except FileNotFoundError:
+                            continue
+                        total += stat.st_size
+            return total
+        return await asyncio.to_thread(walk)
     
 
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all but the last part
+S3_DELETE_BATCH_SIZE = 1000  # S3 maximum keys per DeleteObjects request
+
+
 class S3Storage(StorageService): 
-    def __init__(self):
+    '''
+    One long-lived S3 client per instance, opened by start() (or on first use) and closed by stop(),
+    so operations reuse its pooled keep-alive connections instead of building a client,
+    credential chain and TLS connection each.
+    Pool size S3_MAX_POOL_CONNECTIONS (default 50), S3_ENDPOINT_URL for S3-compatible stores.
+    Large writes use multipart uploads with concurrent parts, reads can be streamed and ranged.
+    '''
+    def __init__(self, max_pool_connections: Optional[int] = None):
         self.session = aioboto3.Session()
         self.bucket_name = os.getenv("BUCKET_NAME")
         self.region = os.getenv("BUCKET_REGION", "us-east-2")
+        self.endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
+        self.client_config = AioConfig(
+            max_pool_connections=max_pool_connections or int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50)),
+            connect_timeout=float(os.getenv("S3_CONNECT_TIMEOUT", 5)),
+            read_timeout=float(os.getenv("S3_READ_TIMEOUT", 30)),
+            retries={'max_attempts': 3, 'mode': 'standard'},
+            tcp_keepalive=True,
+        )
+        # objects larger than the threshold are uploaded in parts, up to multipart_concurrency at once
+        self.multipart_threshold = int(os.getenv("S3_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+        self.multipart_chunk_size = max(S3_MIN_PART_SIZE, int(os.getenv("S3_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024)))
+        self.multipart_concurrency = int(os.getenv("S3_MULTIPART_CONCURRENCY", 4))
+
+        self._client = None
+        self._client_context = None
+        self._client_lock = asyncio.Lock()
+
+    async def start(self):
+        '''
+        Open the client, called by the app and worker startup hooks
+        '''
+        if self._client is not None:
+            return
+        async with self._client_lock:
+            if self._client is None:
+                self._client_context = self.session.client(
+                    's3', region_name=self.region, endpoint_url=self.endpoint_url, config=self.client_config
+                )
+                self._client = await self._client_context.__aenter__()
+                logger.info("S3Storage: client started", extra={'bucket': self.bucket_name, 'max_pool_connections': self.client_config.max_pool_connections})
+
+    async def stop(self):
+        '''
+        Close the client and its connection pool
+        '''
+        async with self._client_lock:
+            if self._client is None:
+                return
+            client_context, self._client, self._client_context = self._client_context, None, None
+            await client_context.__aexit__(None, None, None)
+
+    async def _get_client(self):
+        if self._client is None:
+            await self.start()
+        return self._client
 
     async def save(self, file_id: str, content: bytes) -> bool:
         """save file, return access path"""
+        if len(content) > self.multipart_threshold:
+            return await self._multipart_upload(file_id, _iter_bytes(content, self.multipart_chunk_size))
         try:
-            async with self.session.client('s3', region_name=self.region) as client:
-                await client.put_object(Bucket=self.bucket_name, Key=file_id, Body=content)
+            client = await self._get_client()
+            await client.put_object(Bucket=self.bucket_name, Key=file_id, Body=content)
             return True
         except Exception as e:
             logger.error(f"S3Storage: save file failed: {e}", exc_info=True)
@@ -102,27 +420,437 @@ class S3Storage(StorageService):
     async def read(self, file_id: str) -> bytes:
         """read file content"""
         try:
-            async with self.session.client('s3', region_name=self.region) as client:
-                response = await client.get_object(Bucket=self.bucket_name, Key=file_id)
-                return await response['Body'].read()
+            client = await self._get_client()
+            response = await client.get_object(Bucket=self.bucket_name, Key=file_id)
+            async with response['Body'] as body:
+                return await body.read()
         except Exception as e:
             logger.error(f"S3Storage: read file failed: {e}", exc_info=True)
             return None
     
+    async def save_stream(self, file_id: str, chunks: AsyncIterable[bytes]) -> bool:
+        """single PUT if the stream fits in one part, else a multipart upload, memory stays within
+        (multipart_concurrency + 1) parts whatever the object size"""
+        parts = self._rechunk(chunks, self.multipart_chunk_size)
+        first = await anext(parts, b'')
+        second = await anext(parts, None)
+        if second is None:
+            return await self.save(file_id, first)
+
+        async def all_parts():
+            yield first
+            yield second
+            async for part in parts:
+                yield part
+        return await self._multipart_upload(file_id, all_parts())
+
+    @staticmethod
+    async def _rechunk(chunks: AsyncIterable[bytes], part_size: int) -> AsyncIterator[bytes]:
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= part_size:
+                with memoryview(buffer) as view:
+                    part = bytes(view[:part_size])
+                del buffer[:part_size]
+                yield part
+        if buffer:
+            yield bytes(buffer)
+
+    async def _multipart_upload(self, file_id: str, parts: AsyncIterator[bytes]) -> bool:
+        semaphore = asyncio.Semaphore(self.multipart_concurrency)  # parts held in memory and in flight
+        uploads = []
+        upload_id = None
+        try:
+            client = await self._get_client()
+            upload_id = (await client.create_multipart_upload(Bucket=self.bucket_name, Key=file_id))['UploadId']
+
+            async def upload_part(part_number: int, body: bytes) -> dict:
+                try:
+                    response = await client.upload_part(
+                        Bucket=self.bucket_name, Key=file_id, UploadId=upload_id, PartNumber=part_number, Body=body
+                    )
+                    return {'PartNumber': part_number, 'ETag': response['ETag']}
+                finally:
+                    semaphore.release()
+
+            async for body in parts:
+                await semaphore.acquire()
+                for upload in uploads:
+                    if upload.done() and upload.exception() is not None:
+                        raise upload.exception()
+                uploads.append(asyncio.create_task(upload_part(len(uploads) + 1, body)))
+
+            completed = await asyncio.gather(*uploads)
+            await client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=file_id, UploadId=upload_id, MultipartUpload={'Parts': completed}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"S3Storage: multipart upload failed: {e}", exc_info=True, extra={'file_id': file_id, 'parts': len(uploads)})
+            for upload in uploads:
+                upload.cancel()
+            await asyncio.gather(*uploads, return_exceptions=True)
+            if upload_id is not None:
+                try:
+                    await client.abort_multipart_upload(Bucket=self.bucket_name, Key=file_id, UploadId=upload_id)
+                except Exception as abort_error:
+                    logger.warning(f"S3Storage: abort multipart upload failed: {abort_error}", extra={'file_id': file_id})
+            return False
+
+    async def open_read(self, file_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Optional[ObjectStream]:
+        client = await self._get_client()
+        params = {'Bucket': self.bucket_name, 'Key': file_id}
+        if start < 0 and end is None:
+            params['Range'] = f"bytes={start}"  # suffix range
+        elif start > 0 or end is not None:
+            if start < 0 or (end is not None and end < start):
+                raise ValueError(f"invalid byte range {start}-{end}")
+            params['Range'] = f"bytes={start}-{'' if end is None else end}"
+        try:
+            response = await client.get_object(**params)
+        except client.exceptions.NoSuchKey:
+            logger.error(f"S3Storage: file not found: {file_id}")
+            return None
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'InvalidRange':
+                head = await client.head_object(Bucket=self.bucket_name, Key=file_id)
+                raise InvalidRangeError(head['ContentLength'])
+            logger.error(f"S3Storage: read file failed: {e}", exc_info=True)
+            return None
+
+        if 'ContentRange' in response:  # bytes start-end/size
+            byte_range, size = response['ContentRange'].split(' ', 1)[1].split('/')
+            start, end = (int(value) for value in byte_range.split('-'))
+            size = int(size)
+        else:
+            size = response['ContentLength']
+            start, end = 0, size - 1
+        return ObjectStream(self._read_chunks(response['Body'], chunk_size), size, start, end)
+
+    @staticmethod
+    async def _read_chunks(body, chunk_size: int) -> AsyncIterator[bytes]:
+        async with body:
+            async for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+
     async def delete(self, file_id: str) -> bool:
         try:
-            async with self.session.client('s3', region_name=self.region) as client:
-                await client.delete_object(Bucket=self.bucket_name, Key=file_id)
+            client = await self._get_client()
+            await client.delete_object(Bucket=self.bucket_name, Key=file_id)
             return True
         except Exception as e:
             logger.error(f"S3Storage: delete file failed: {e}", exc_info=True)
             return False
     
+    async def delete_many(self, file_ids: List[str]) -> Set[str]:
+        """multi-object delete, up to S3_DELETE_BATCH_SIZE (1000) keys per request"""
+        failed = set()
+        for offset in range(0, len(file_ids), S3_DELETE_BATCH_SIZE):
+            batch = file_ids[offset:offset + S3_DELETE_BATCH_SIZE]
+            try:
+                client = await self._get_client()
+                response = await client.delete_objects(
+                    Bucket=self.bucket_name, Delete={'Objects': [{'Key': file_id} for file_id in batch], 'Quiet': True}
+                )
+            except Exception as e:
+                logger.error(f"S3Storage: delete objects failed: {e}", exc_info=True, extra={'file_count': len(batch)})
+                failed.update(batch)
+                continue
+            for error in response.get('Errors', []):
+                logger.error(f"S3Storage: delete object failed: {error.get('Message')}", extra={'file_id': error.get('Key'), 'code': error.get('Code')})
+                failed.add(error['Key'])
+        return failed
+
     async def exists(self, file_id: str) -> bool:
         try:
-            async with self.session.client('s3', region_name=self.region) as client:
-                await client.head_object(Bucket=self.bucket_name, Key=file_id)
+            client = await self._get_client()
+            await client.head_object(Bucket=self.bucket_name, Key=file_id)
             return True
         except Exception as e:
             logger.error(f"S3Storage: file not found: {file_id}", exc_info=True)
-            return False
\ No newline at end of file
+            return False
+
+    async def presign_read(self, file_id: str, expires_in: int, cache_control: Optional[str] = None) -> Optional[str]:
+        """presigned GET URL, signed locally without a request to S3"""
+        params = {'Bucket': self.bucket_name, 'Key': file_id}
+        if cache_control is not None:
+            params['ResponseCacheControl'] = cache_control
+        try:
+            client = await self._get_client()
+            return await client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+        except Exception as e:
+            logger.error(f"S3Storage: presign failed: {e}", extra={'file_id': file_id})
+            return None
+
+class CachedStorage(StorageService):
+    '''
+    Size-bounded LRU disk cache in front of another storage, usually S3Storage.
+    Saves write through: to the backend first, then to the cache. Reads are served from disk when cached,
+    concurrent misses of the same file share one backend fetch, files larger than the budget bypass the cache.
+    The LRU index is kept in memory and rebuilt from the directory on start;
+    processes sharing a directory each keep to their own budget.
+    '''
+    # outcome of making a file cached
+    CACHED, MISSING, BYPASS = "cached", "missing", "bypass"
+
+    def __init__(self, backend: StorageService, cache_dir: str, max_bytes: int, stale_part_seconds: float = 3600):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # .part files are writes in progress, possibly of another process sharing the directory,
+        # only ones older than this are left over by crashed writes
+        self.stale_part_seconds = stale_part_seconds
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._entries: OrderedDict[str, int] = OrderedDict()  # cache file name to size, least recently used first
+        self._size = 0
+        self._inflight: Dict[str, asyncio.Task] = {}  # cache file name to its running backend fetch
+        self._index_loaded = False
+
+    def _scan(self) -> list:
+        '''(mtime, name, size) of the cached files, removing stale .part files; blocking, run in a thread'''
+        files = []
+        stale_before = time.time() - self.stale_part_seconds
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if entry.name.endswith('.part'):
+                        if stat.st_mtime < stale_before:
+                            os.remove(entry.path)
+                        continue
+                except FileNotFoundError:
+                    continue  # evicted or renamed by another process meanwhile
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        return files
+
+    async def _load_index(self):
+        files = await asyncio.to_thread(self._scan)
+        for _, name, size in sorted(files):
+            if name not in self._entries:  # files cached since creation are more recent
+                self._admit(name, size)
+        self._index_loaded = True
+        logger.info("CachedStorage: index loaded", extra={'cache_dir': self.cache_dir, 'files': len(self._entries), 'bytes': self._size})
+
+    @staticmethod
+    def _key(file_id: str) -> str:
+        return hashlib.sha256(file_id.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _temp_path(self, key: str) -> str:
+        return f"{self._path(key)}.{uuid.uuid4().hex}.part"
+
+    def _admit(self, key: str, size: int):
+        '''Record a cached file as most recently used and evict the least recently used ones over budget'''
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        while self._size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            if oldest == key:
+                break
+            self._evict(oldest)
+            STORAGE_CACHE_EVICTIONS.inc()
+        STORAGE_CACHE_BYTES.set(self._size)
+
+    def _evict(self, key: str):
+        self._size -= self._entries.pop(key, 0)
+        STORAGE_CACHE_BYTES.set(self._size)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    async def start(self):
+        if not self._index_loaded:
+            await self._load_index()
+        await self.backend.start()
+
+    async def stop(self):
+        for fetch in list(self._inflight.values()):
+            fetch.cancel()
+        await self.backend.stop()
+
+    async def save(self, file_id: str, content: bytes) -> bool:
+        """write through: the backend, then the cache"""
+        key = self._key(file_id)
+        self._evict(key)
+        if not await self.backend.save(file_id, content):
+            return False
+        if len(content) <= self.max_bytes:
+            try:
+                temp_path = self._temp_path(key)
+                async with aiofiles.open(temp_path, 'wb') as f:
+                    await f.write(content)
+                await aiofiles.os.replace(temp_path, self._path(key))
+                self._admit(key, len(content))
+            except Exception as e:
+                logger.warning(f"CachedStorage: caching saved file failed: {e}", extra={'file_id': file_id})
+        return True
+
+    async def save_stream(self, file_id: str, chunks: AsyncIterable[bytes]) -> bool:
+        """
+        write through: chunks are written to the cache while they stream to the backend;
+        like in save, cache failures are logged and only stop the caching, never the upload
+        """
+        key = self._key(file_id)
+        self._evict(key)
+        temp_path = self._temp_path(key)
+        size = 0
+        caching = True  # until the file outgrows the budget or writing it to the cache fails
+        try:
+            f = await aiofiles.open(temp_path, 'wb')
+        except Exception as e:
+            logger.warning(f"CachedStorage: caching saved file failed: {e}", extra={'file_id': file_id})
+            f, caching = None, False
+
+        async def tee():
+            nonlocal size, caching
+            async for chunk in chunks:
+                size += len(chunk)
+                if caching and size > self.max_bytes:
+                    caching = False
+                if caching:
+                    try:
+                        await f.write(chunk)
+                    except Exception as e:
+                        logger.warning(f"CachedStorage: caching saved file failed: {e}", extra={'file_id': file_id})
+                        caching = False
+                yield chunk
+
+        saved = False
+        try:
+            saved = await self.backend.save_stream(file_id, tee())
+        finally:
+            # the temp file is always either moved into the cache or removed, also when the upload raised
+            cached = False
+            try:
+                if f is not None:
+                    await f.close()
+                if saved and caching:
+                    await aiofiles.os.replace(temp_path, self._path(key))
+                    self._admit(key, size)
+                    cached = True
+            except Exception as e:
+                logger.warning(f"CachedStorage: caching saved file failed: {e}", extra={'file_id': file_id})
+            if not cached and f is not None:
+                try:
+                    await aiofiles.os.remove(temp_path)
+                except OSError:
+                    pass
+        return saved
+
+    async def read(self, file_id: str) -> bytes:
+        """read file content, from the cache when possible"""
+        outcome = await self._ensure_cached(file_id)
+        if outcome == self.MISSING:
+            return None
+        if outcome == self.CACHED:
+            try:
+                async with aiofiles.open(self._path(self._key(file_id)), 'rb') as f:
+                    return await f.read()
+            except FileNotFoundError:
+                self._evict(self._key(file_id))  # removed under us, e.g. by another process
+        return await self.backend.read(file_id)
+
+    async def open_read(self, file_id: str, start: int = 0, end: Optional[int] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Optional[ObjectStream]:
+        outcome = await self._ensure_cached(file_id)
+        if outcome == self.MISSING:
+            return None
+        if outcome == self.CACHED:
+            key = self._key(file_id)
+            path = self._path(key)
+            try:
+                size = (await aiofiles.os.stat(path)).st_size
+            except FileNotFoundError:
+                self._evict(key)
+            else:
+                start, end = resolve_range(size, start, end)
+                return ObjectStream(LocalStorage._read_chunks(path, start, end - start + 1, chunk_size), size, start, end)
+        return await self.backend.open_read(file_id, start, end, chunk_size)
+
+    async def delete(self, file_id: str) -> bool:
+        self._evict(self._key(file_id))
+        return await self.backend.delete(file_id)
+
+    async def delete_many(self, file_ids: List[str]) -> Set[str]:
+        for file_id in file_ids:
+            self._evict(self._key(file_id))
+        return await self.backend.delete_many(file_ids)
+
+    async def exists(self, file_id: str) -> bool:
+        if self._key(file_id) in self._entries:
+            return True
+        return await self.backend.exists(file_id)
+
+    async def presign_read(self, file_id: str, expires_in: int, cache_control: Optional[str] = None) -> Optional[str]:
+        return await self.backend.presign_read(file_id, expires_in, cache_control)
+
+    async def _ensure_cached(self, file_id: str) -> str:
+        '''
+        Make the file cached, fetching it from the backend on a miss.
+        Returns CACHED, MISSING (not in the backend) or BYPASS (read it from the backend directly).
+        '''
+        key = self._key(file_id)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            STORAGE_CACHE_REQUESTS.labels(result="hit").inc()
+            return self.CACHED
+
+        fetch = self._inflight.get(key)
+        if fetch is None:
+            STORAGE_CACHE_REQUESTS.labels(result="miss").inc()
+            # a task of its own, so a cancelled caller does not cancel the fetch others wait on
+            fetch = self._inflight[key] = asyncio.create_task(self._fetch(file_id, key))
+            fetch.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            STORAGE_CACHE_REQUESTS.labels(result="coalesced").inc()
+        return await asyncio.shield(fetch)
+
+    async def _fetch(self, file_id: str, key: str) -> str:
+        temp_path = self._temp_path(key)
+        try:
+            stream = await self.backend.open_read(file_id)
+            if stream is None:
+                return self.MISSING
+            if stream.size > self.max_bytes:
+                await stream.aclose()
+                return self.BYPASS
+            async with aiofiles.open(temp_path, 'wb') as f:
+                async for chunk in stream:
+                    await f.write(chunk)
+            await aiofiles.os.replace(temp_path, self._path(key))
+            self._admit(key, stream.size)
+            return self.CACHED
+        except Exception as e:
+            logger.warning(f"CachedStorage: fetch failed, reading from the backend: {e}", extra={'file_id': file_id})
+            try:
+                await aiofiles.os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            return self.BYPASS
+
+
+def create_storage_service(storage_type: str) -> StorageService:
+    '''
+    Storage backend by name: local or s3, s3 behind the local disk cache unless STORAGE_CACHE_MAX_BYTES is 0
+    '''
+    storage_type = storage_type.lower()
+    if storage_type == "local":
+        return LocalStorage()
+    elif storage_type == "s3":
+        if STORAGE_CACHE_MAX_BYTES > 0:
+            return CachedStorage(S3Storage(), STORAGE_CACHE_DIR, STORAGE_CACHE_MAX_BYTES)
+        return S3Storage()
+    raise ValueError(f"Unsupported storage type: {storage_type}")
+
+
+def get_output_storage_type() -> str:
+    '''
+    Where task outputs are written by the worker and read by the API, OUTPUT_STORAGE_TYPE (default s3)
+    '''
+    return os.getenv("OUTPUT_STORAGE_TYPE", "s3").lower()
@@ -0,0 +1,210 @@
+# hot task status in Redis
+## the worker writes a snapshot next to every publish, readers check it before Postgres
+import os
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from app.models import TaskStatus
+from app.schemas import ProcessingTask
+from app.core.redis import redis_manager, RedisRole
+from app.logger_config import get_logger
+from app.monitoring import TASK_STATE_LOOKUPS
+
+logger = get_logger(__name__)
+
+TERMINAL_STATUSES = (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value)
+
+# worker progress stages, in order
+TASK_STAGES = ("queued", "decoding", "inferring", "encoding", "uploading", "done")
+
+
+class TaskStateStore:
+    '''
+    Per-task Redis hash task_state:{task_id}, its TTL is refreshed on every write
+        task          ProcessingTask JSON, cached by the API
+        status        latest status, written by the worker
+        file_id       input file id of the task
+        completed_at  ISO timestamp, once completed
+        stage         worker progress stage, one of TASK_STAGES
+        percent       progress of the task, empty if unknown
+        seq           event id, incremented on every worker update and sent as the SSE event id
+        updated_at    unix time of the last worker update
+    The worker writes here before its buffered DB update, so the snapshot status is never older than Postgres.
+    '''
+    KEY_PREFIX = "task_state:"
+
+    def __init__(self, ttl_seconds: int = 86400):
+        self.ttl_seconds = ttl_seconds
+
+    async def _get_redis(self):
+        return redis_manager.get_client(RedisRole.CACHE)
+
+    def key(self, task_id) -> str:
+        return f"{self.KEY_PREFIX}{task_id}"
+
+    async def get(self, task_id) -> Optional[dict]:
+        '''
+        The snapshot with seq as int, None if there is none or Redis is unavailable
+        '''
+        try:
+            redis = await self._get_redis()
+            snapshot = await redis.hgetall(self.key(task_id))
+        except Exception as e:
+            logger.warning(f"TaskStateStore: redis get failed: {e}", extra={'task_id': str(task_id)})
+            TASK_STATE_LOOKUPS.labels(result="error").inc()
+            return None
+        if not snapshot:
+            TASK_STATE_LOOKUPS.labels(result="miss").inc()
+            return None
+        TASK_STATE_LOOKUPS.labels(result="hit").inc()
+        return self._parse(snapshot)
+
+    async def get_many(self, task_ids) -> Dict[str, dict]:
+        '''
+        Snapshots of many tasks in one pipelined round trip, keyed by task id.
+        Tasks without a snapshot are left out, all of them if Redis is unavailable.
+        '''
+        task_ids = [str(task_id) for task_id in task_ids]
+        if not task_ids:
+            return {}
+        try:
+            results = await redis_manager.batch(RedisRole.CACHE, [("hgetall", self.key(task_id)) for task_id in task_ids])
+        except Exception as e:
+            logger.warning(f"TaskStateStore: redis get_many failed: {e}", extra={'task_count': len(task_ids)})
+            TASK_STATE_LOOKUPS.labels(result="error").inc(len(task_ids))
+            return {}
+
+        snapshots = {}
+        for task_id, snapshot in zip(task_ids, results):
+            if snapshot:
+                snapshots[task_id] = self._parse(snapshot)
+        TASK_STATE_LOOKUPS.labels(result="hit").inc(len(snapshots))
+        TASK_STATE_LOOKUPS.labels(result="miss").inc(len(task_ids) - len(snapshots))
+        return snapshots
+
+    async def put_task(self, task):
+        '''
+        Cache a task row loaded from or written to Postgres.
+        Status fields are only set if the worker has not written newer ones yet.
+        '''
+        await self.put_tasks([task])
+
+    async def put_tasks(self, tasks):
+        '''
+        put_task for many rows in one transaction, i.e. one connection and one round trip
+        '''
+        tasks = [ProcessingTask.model_validate(task) for task in tasks]
+        if not tasks:
+            return
+        try:
+            redis = await self._get_redis()
+            async with redis.pipeline(transaction=True) as pipe:
+                for task in tasks:
+                    key = self.key(task.id)
+                    pipe.hset(key, 'task', task.model_dump_json())
+                    pipe.hsetnx(key, 'status', task.status.value)
+                    pipe.hsetnx(key, 'file_id', task.input_image_s3_key)
+                    pipe.hsetnx(key, 'seq', 0)
+                    if task.completed_at is not None:
+                        pipe.hsetnx(key, 'completed_at', task.completed_at.isoformat())
+                    pipe.expire(key, self.ttl_seconds)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"TaskStateStore: redis put failed: {e}", extra={'task_ids': [str(task.id) for task in tasks]})
+
+    async def discard(self, task_ids):
+        '''
+        Drop the snapshots of finished tasks whose cached row went stale, e.g. once their files expired
+        '''
+        keys = [self.key(task_id) for task_id in task_ids]
+        if not keys:
+            return
+        try:
+            redis = await self._get_redis()
+            await redis.delete(*keys)
+        except Exception as e:
+            logger.warning(f"TaskStateStore: redis discard failed: {e}", extra={'task_count': len(keys)})
+
+    async def update(
+        self,
+        task_id,
+        status: str,
+        file_id: Optional[str] = None,
+        completed_at: Optional[datetime] = None,
+        stage: Optional[str] = None,
+        percent: Optional[int] = None,
+    ) -> int:
+        '''
+        Record a status change made by the worker, returns its event id (seq).
+        Raises on Redis errors.
+        '''
+        mapping = {'status': status, 'updated_at': time.time()}
+        if file_id is not None:
+            mapping['file_id'] = file_id
+        if completed_at is not None:
+            mapping['completed_at'] = completed_at.isoformat()
+        if stage is not None:
+            mapping['stage'] = stage
+            mapping['percent'] = '' if percent is None else percent
+
+        key = self.key(task_id)
+        redis = await self._get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(key, 'seq', 1)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self.ttl_seconds)
+            seq, _, _ = await pipe.execute()
+        return int(seq)
+
+    async def update_progress(self, progress: Dict[str, Tuple[str, Optional[int]]]) -> Dict[str, Tuple[int, str, Optional[str]]]:
+        '''
+        Record the stage and percent of many tasks in one round trip, their status is left as is.
+        progress: task id to (stage, percent)
+        Returns task id to (seq, status, file_id). Raises on Redis errors.
+        '''
+        updated_at = time.time()
+        redis = await self._get_redis()
+        async with redis.pipeline(transaction=True) as pipe:
+            for task_id, (stage, percent) in progress.items():
+                key = self.key(task_id)
+                pipe.hincrby(key, 'seq', 1)
+                pipe.hset(key, mapping={'stage': stage, 'percent': '' if percent is None else percent, 'updated_at': updated_at})
+                pipe.hmget(key, 'status', 'file_id')
+                pipe.expire(key, self.ttl_seconds)
+            results = await pipe.execute()
+
+        updated = {}
+        for i, task_id in enumerate(progress):
+            seq, _, (status, file_id), _ = results[4 * i:4 * i + 4]
+            updated[task_id] = (int(seq), status or TaskStatus.PENDING.value, file_id)
+        return updated
+
+    @staticmethod
+    def _parse(snapshot: dict) -> dict:
+        snapshot['seq'] = int(snapshot.get('seq', 0))
+        snapshot['percent'] = int(snapshot['percent']) if snapshot.get('percent') else None
+        return snapshot
+
+    @staticmethod
+    def to_task(snapshot: Optional[dict], task=None) -> Optional[ProcessingTask]:
+        '''
+        The task with the snapshot's status applied.
+        Without `task` the cached row of the snapshot is used, None if it has none.
+        '''
+        if task is None:
+            if not snapshot or 'task' not in snapshot:
+                return None
+            task = ProcessingTask.model_validate_json(snapshot['task'])
+        else:
+            task = ProcessingTask.model_validate(task)
+        if not snapshot or 'status' not in snapshot:
+            return task
+
+        update = {'status': TaskStatus(snapshot['status'])}
+        if snapshot.get('completed_at'):
+            update['completed_at'] = datetime.fromisoformat(snapshot['completed_at'])
+        return task.model_copy(update=update)
+
+
+task_state_store = TaskStateStore(ttl_seconds=int(os.getenv("TASK_STATE_TTL_SECONDS", 86400)))
@@ -0,0 +1,246 @@
+# resized and re-encoded variants of task outputs, e.g. list view thumbnails
+## rendered once in a bounded thread pool, stored next to the output under a key derived from the variant,
+## common thumbnails are rendered eagerly by the worker when a task completes
+import asyncio
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, TypeVar
+
+from PIL import Image
+
+from app.core.storage import StorageService
+from app.core.output_encoding import composite_mask
+from app.logger_config import get_logger
+from app.monitoring import VARIANT_REQUESTS, VARIANT_RENDER_SECONDS
+
+logger = get_logger(__name__)
+
+
+class VariantFormat(NamedTuple):
+    pillow_format: str
+    media_type: str
+    extension: str
+    lossy: bool
+
+
+VARIANT_FORMATS = {
+    "png": VariantFormat("PNG", "image/png", "png", False),
+    "webp": VariantFormat("WEBP", "image/webp", "webp", True),
+    "jpeg": VariantFormat("JPEG", "image/jpeg", "jpg", True),
+}
+# variants fit in a square box of one of these sizes, requests are rounded up to the next one;
+# the sizes and qualities are few so the variants of a task can be enumerated, e.g. to delete them
+VARIANT_SIZES = sorted(int(size) for size in os.getenv("VARIANT_SIZES", "64,128,256,512,1024,2048").split(","))
+VARIANT_QUALITIES = sorted(int(quality) for quality in os.getenv("VARIANT_QUALITIES", "50,75,90").split(","))
+VARIANT_DEFAULT_QUALITY = int(os.getenv("VARIANT_DEFAULT_QUALITY", 75))
+VARIANT_WORKERS = int(os.getenv("VARIANT_WORKERS", min(4, os.cpu_count() or 1)))
+VARIANT_MAX_PENDING = int(os.getenv("VARIANT_MAX_PENDING", 32))  # running + queued
+
+T = TypeVar("T")
+
+
+class VariantSpec(NamedTuple):
+    size: int  # bound of the longest edge, 0 keeps the output's size
+    format: str  # key of VARIANT_FORMATS
+    quality: Optional[int]  # None for lossless formats
+
+
+def variant_spec(width: Optional[int] = None, height: Optional[int] = None, image_format: str = "webp", quality: Optional[int] = None) -> VariantSpec:
+    '''
+    Normalize a requested variant: the box is rounded up to the next of VARIANT_SIZES (capped at the largest),
+    the quality up to the next of VARIANT_QUALITIES. Raises ValueError for an unknown format or out of range values.
+    '''
+    image_format = {"jpg": "jpeg"}.get(image_format.lower(), image_format.lower())
+    if image_format not in VARIANT_FORMATS:
+        raise ValueError(f"unsupported format {image_format}, expected one of {', '.join(VARIANT_FORMATS)}")
+    if (width is not None and width < 1) or (height is not None and height < 1):
+        raise ValueError("width and height must be positive")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+
+    requested = max(width or 0, height or 0)
+    size = 0 if requested == 0 else next((s for s in VARIANT_SIZES if s >= requested), VARIANT_SIZES[-1])
+    if not VARIANT_FORMATS[image_format].lossy:
+        return VariantSpec(size, image_format, None)
+    quality = quality or VARIANT_DEFAULT_QUALITY
+    return VariantSpec(size, image_format, next((q for q in VARIANT_QUALITIES if q >= quality), VARIANT_QUALITIES[-1]))
+
+
+def parse_variant_list(value: str) -> List[VariantSpec]:
+    '''Specs of a "size:format,..." list, e.g. THUMBNAIL_VARIANTS'''
+    specs = []
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        size, _, image_format = entry.partition(":")
+        specs.append(variant_spec(int(size), None, image_format or "webp"))
+    return specs
+
+
+# rendered by the worker next to every output, so list views find them ready
+THUMBNAIL_VARIANTS = parse_variant_list(os.getenv("THUMBNAIL_VARIANTS", "256:webp"))
+
+
+def variant_id(output_id: str, spec: VariantSpec) -> str:
+    '''Storage key of a variant, derived from the output's: <input>.output.<size|full>[.q<quality>].<ext>'''
+    base = output_id.rsplit(".", 1)[0]
+    quality = f".q{spec.quality}" if spec.quality is not None else ""
+    return f"{base}.{spec.size or 'full'}{quality}.{VARIANT_FORMATS[spec.format].extension}"
+
+
+def all_variant_ids(output_id: str) -> List[str]:
+    '''Every key a variant of the output can have'''
+    variant_ids = []
+    for size in [0, *VARIANT_SIZES]:
+        for image_format, fmt in VARIANT_FORMATS.items():
+            for quality in (VARIANT_QUALITIES if fmt.lossy else [None]):
+                variant_ids.append(variant_id(output_id, VariantSpec(size, image_format, quality)))
+    return variant_ids
+
+
+def render_variant(content: bytes, spec: VariantSpec) -> bytes:
+    '''
+    Resize encoded image bytes to fit the spec's box, never upscaling, and encode them in its format.
+    CPU bound, Pillow releases the GIL while resampling and encoding, so it runs in threads.
+    '''
+    fmt = VARIANT_FORMATS[spec.format]
+    with Image.open(io.BytesIO(content)) as image:
+        image.load()
+        if spec.size:
+            image.thumbnail((spec.size, spec.size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if fmt.pillow_format == "JPEG" and image.mode != "RGB":
+            # no alpha in JPEG, cut-outs go on white
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            rgba = image.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            image = background
+
+        options = {"quality": spec.quality} if fmt.lossy else {"compress_level": 6}
+        if fmt.pillow_format == "WEBP":
+            options["method"] = 4
+        elif fmt.pillow_format == "JPEG":
+            options["optimize"] = True
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.pillow_format, **options)
+        return buffer.getvalue()
+
+
+class VariantRenderingBusy(Exception):
+    '''Raised when the variant render executor is at capacity'''
+
+
+class VariantRenderExecutor:
+    '''
+    Bounded thread pool for rendering variants with admission control, like PasswordHashingExecutor:
+    at most `max_pending` renders are running or queued, further ones are rejected right away.
+    '''
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="variant-render")
+        self._max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        with self._lock:
+            if self._pending >= self._max_pending:
+                VARIANT_REQUESTS.labels(result="rejected").inc()
+                raise VariantRenderingBusy(f"Variant render executor is full ({self._max_pending} pending)")
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # released once the render is done, not when the caller stops waiting, like PasswordHashingExecutor
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class VariantService:
+    '''
+    Makes sure a variant is in storage, rendering it from the output on the first request.
+    Concurrent requests of the same variant share one render, variants known to be stored skip the storage check.
+    '''
+    def __init__(self, executor: VariantRenderExecutor, max_known: int = 100000):
+        self.executor = executor
+        self.max_known = max_known
+        self._known: OrderedDict[str, None] = OrderedDict()  # variant ids known to be stored
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def ensure(
+        self, storage: StorageService, output_id: str, spec: VariantSpec, load_source: Optional[Callable[[], Awaitable[Optional[bytes]]]] = None
+    ) -> Optional[str]:
+        '''
+        The variant's storage key, None if the output does not exist. Rendered from the output `output_id`,
+        or from the bytes of `load_source` if given, e.g. the composite of a mask-only output.
+        Raises VariantRenderingBusy when it has to be rendered and the executor is full.
+        '''
+        key = variant_id(output_id, spec)
+        if key in self._known:
+            self._known.move_to_end(key)
+            VARIANT_REQUESTS.labels(result="known").inc()
+            return key
+
+        render = self._inflight.get(key)
+        if render is None:
+            # a task of its own, so a cancelled caller does not cancel the render others wait on
+            render = self._inflight[key] = asyncio.create_task(self._ensure(storage, output_id, key, spec, load_source))
+            render.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            VARIANT_REQUESTS.labels(result="coalesced").inc()
+        return key if await asyncio.shield(render) else None
+
+    async def composite(self, output_storage: StorageService, input_storage: StorageService, input_id: str, mask_id: str) -> Optional[bytes]:
+        '''
+        The image of a mask-only output composited onto its input, None if either is gone.
+        Raises VariantRenderingBusy when the executor is full.
+        '''
+        mask, content = await asyncio.gather(output_storage.read(mask_id), input_storage.read(input_id))
+        if mask is None or content is None:
+            return None
+        start_time = time.perf_counter()
+        data = await self.executor.run(composite_mask, content, mask)
+        VARIANT_RENDER_SECONDS.labels(format="composite").observe(time.perf_counter() - start_time)
+        VARIANT_REQUESTS.labels(result="composited").inc()
+        return data
+
+    def forget(self, key: str):
+        '''Drop a variant that turned out to be gone from storage'''
+        self._known.pop(key, None)
+
+    async def _ensure(self, storage: StorageService, output_id: str, key: str, spec: VariantSpec, load_source) -> bool:
+        if await storage.exists(key):
+            VARIANT_REQUESTS.labels(result="stored").inc()
+            self._remember(key)
+            return True
+        content = await (load_source() if load_source is not None else storage.read(output_id))
+        if content is None:
+            return False
+
+        start_time = time.perf_counter()
+        data = await self.executor.run(render_variant, content, spec)
+        VARIANT_RENDER_SECONDS.labels(format=spec.format).observe(time.perf_counter() - start_time)
+        if not await storage.save(key, data):
+            raise RuntimeError(f"failed to save variant {key}")
+        VARIANT_REQUESTS.labels(result="rendered").inc()
+        logger.info("VariantService: rendered variant", extra={'file_id': key, 'bytes': len(data), 'source_bytes': len(content)})
+        self._remember(key)
+        return True
+
+    def _remember(self, key: str):
+        self._known[key] = None
+        self._known.move_to_end(key)
+        while len(self._known) > self.max_known:
+            self._known.popitem(last=False)
+
+
+variant_service = VariantService(VariantRenderExecutor(VARIANT_WORKERS, VARIANT_MAX_PENDING))
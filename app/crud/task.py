@@ -1,8 +1,11 @@
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from sqlalchemy import text, tuple_, literal, any_, and_, or_, func
+from sqlalchemy.dialects.postgresql import ARRAY
 from typing import Optional
 from uuid import UUID
-from typing import List
+from typing import Dict, List, Sequence, Tuple
+from datetime import datetime
 
 from app.models import ProcessingTask, TaskStatus
 from app.schemas import ProcessingTaskCreate, ProcessingTaskUpdate
@@ -49,8 +52,146 @@ def update_task(
     return db_task
 
 
+def bulk_update_task_status(db: Session, updates: List[dict]) -> int:
+    '''
+    Apply many status updates with a single UPDATE ... FROM (VALUES ...), no read-before-write.
+    updates: dicts with keys id, status and optionally completed_at
+    Returns the number of rows updated.
+    '''
+    if not updates:
+        return 0
+
+    rows = []
+    params = {}
+    for i, update in enumerate(updates):
+        rows.append(
+            f"(CAST(:id_{i} AS uuid), CAST(:status_{i} AS task_status_type), CAST(:completed_at_{i} AS timestamptz))"
+        )
+        params[f"id_{i}"] = str(update['id'])
+        params[f"status_{i}"] = TaskStatus(update['status']).value
+        params[f"completed_at_{i}"] = update.get('completed_at')
+
+    stmt = text(
+        "UPDATE processing_tasks AS t "
+        "SET status = v.status, completed_at = COALESCE(v.completed_at, t.completed_at) "
+        f"FROM (VALUES {', '.join(rows)}) AS v(id, status, completed_at) "
+        "WHERE t.id = v.id"
+    )
+    result = db.execute(stmt, params)
+    db.commit()
+    return result.rowcount
+
+
 def get_task(db: Session, task_id: UUID) -> Optional[ProcessingTask]:
     return db.query(ProcessingTask).filter(ProcessingTask.id == task_id).first()
 
 def get_tasks_by_user(db: Session, user_id: UUID) -> List[ProcessingTask]:
     return db.query(ProcessingTask).filter(ProcessingTask.user_id == user_id).order_by(ProcessingTask.created_at.desc()).all()
+
+def get_user_tasks_by_ids(db: Session, user_id: UUID, task_ids: Sequence[UUID]) -> List[ProcessingTask]:
+    '''
+    Tasks among task_ids owned by user_id, in one query with a single array parameter (id = ANY(:ids)).
+    Unknown ids and tasks of other users are left out.
+    '''
+    if not task_ids:
+        return []
+    ids = literal(list(dict.fromkeys(task_ids)), ARRAY(ProcessingTask.id.type))
+    return db.query(ProcessingTask).filter(ProcessingTask.id == any_(ids), ProcessingTask.user_id == user_id).all()
+
+
+
+def get_tasks_with_expired_files(db: Session, cutoffs: Dict[TaskStatus, datetime], limit: int) -> List[Tuple[UUID, str]]:
+    '''
+    Oldest tasks whose files are still there and whose status has a cutoff it finished (or, without
+    completed_at, was created) before. Returns (id, input_image_s3_key) pairs.
+    '''
+    if not cutoffs:
+        return []
+    finished_at = func.coalesce(ProcessingTask.completed_at, ProcessingTask.created_at)
+    expired = or_(*[and_(ProcessingTask.status == status, finished_at < cutoff) for status, cutoff in cutoffs.items()])
+    rows = (
+        db.query(ProcessingTask.id, ProcessingTask.input_image_s3_key)
+        .filter(ProcessingTask.files_expired_at.is_(None), expired)
+        .order_by(ProcessingTask.created_at, ProcessingTask.id)
+        .limit(limit)
+        .all()
+    )
+    return [tuple(row) for row in rows]
+
+
+def get_oldest_tasks_with_files(
+    db: Session,
+    statuses: Sequence[TaskStatus],
+    limit: int,
+    after: Optional[Tuple[datetime, UUID]] = None,
+) -> List[Tuple[UUID, str, datetime]]:
+    '''
+    Tasks in the given statuses whose files are still there, oldest first, served by idx_tasks_files_live.
+    after: (created_at, id) of the last task of the previous batch
+    Returns (id, input_image_s3_key, created_at) rows.
+    '''
+    query = db.query(ProcessingTask.id, ProcessingTask.input_image_s3_key, ProcessingTask.created_at).filter(
+        ProcessingTask.files_expired_at.is_(None), ProcessingTask.status.in_(statuses)
+    )
+    if after is not None:
+        after_created_at, after_id = after
+        query = query.filter(
+            tuple_(ProcessingTask.created_at, ProcessingTask.id)
+            > tuple_(literal(after_created_at, ProcessingTask.created_at.type), literal(after_id, ProcessingTask.id.type))
+        )
+    rows = query.order_by(ProcessingTask.created_at, ProcessingTask.id).limit(limit).all()
+    return [tuple(row) for row in rows]
+
+
+def mark_task_files_expired(db: Session, task_ids: Sequence[UUID], expired_at: datetime) -> int:
+    '''
+    Record that the files of the tasks were deleted, one UPDATE with a single array parameter.
+    Returns the number of rows updated.
+    '''
+    if not task_ids:
+        return 0
+    ids = literal(list(dict.fromkeys(task_ids)), ARRAY(ProcessingTask.id.type))
+    updated = (
+        db.query(ProcessingTask)
+        .filter(ProcessingTask.id == any_(ids), ProcessingTask.files_expired_at.is_(None))
+        .update({ProcessingTask.files_expired_at: expired_at}, synchronize_session=False)
+    )
+    db.commit()
+    return updated
+
+
+TASK_LIST_FIELDS = (
+    "id", "user_id", "task_type", "status", "input_image_s3_key", "parameters",
+    "processing_time_ms", "model_version", "created_at", "completed_at",
+)
+
+
+def get_tasks_by_user_page(
+    db: Session,
+    user_id: UUID,
+    limit: int,
+    after: Optional[Tuple[datetime, UUID]] = None,
+    status: Optional[TaskStatus] = None,
+    task_type: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> List[dict]:
+    '''
+    Keyset-paginated listing of a user's tasks, newest first, served by idx_tasks_user_created.
+    after: (created_at, id) of the last task of the previous page
+    fields: columns to load, id and created_at are always included since the cursor needs them
+    '''
+    fields = dict.fromkeys(["id", "created_at", *(fields or TASK_LIST_FIELDS)])
+    query = db.query(*[getattr(ProcessingTask, field) for field in fields]).filter(ProcessingTask.user_id == user_id)
+    if status is not None:
+        query = query.filter(ProcessingTask.status == status)
+    if task_type is not None:
+        query = query.filter(ProcessingTask.task_type == task_type)
+    if after is not None:
+        after_created_at, after_id = after
+        query = query.filter(
+            tuple_(ProcessingTask.created_at, ProcessingTask.id)
+            < tuple_(literal(after_created_at, ProcessingTask.created_at.type), literal(after_id, ProcessingTask.id.type))
+        )
+
+    rows = query.order_by(ProcessingTask.created_at.desc(), ProcessingTask.id.desc()).limit(limit).all()
+    return [dict(row._mapping) for row in rows]
@@ -29,12 +29,15 @@ def create_user(db: Session, user: UserCreate, password_hash: str) -> User:
     return db_user
 
 
-def update_last_login(db: Session, user_id: UUID) -> Optional[User]:
+def update_last_login(db: Session, user_id: UUID, password_hash: Optional[str] = None) -> Optional[User]:
+    '''password_hash: replaces the stored hash, used to upgrade hashes made with old Argon2 parameters'''
     db_user = get_user(db, user_id)
     if not db_user:
         return None
     
     db_user.last_login = datetime.utcnow()
+    if password_hash is not None:
+        db_user.password_hash = password_hash
     db.commit()
     db.refresh(db_user)
     return db_user
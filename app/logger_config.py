@@ -1,10 +1,15 @@
+import atexit
 import json
 import logging
+import os
+import queue
+import random
 import sys
+import threading
 from contextvars import ContextVar
 from pathlib import Path
 from typing import Any, Dict, Optional
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 
 LOG_DIR = Path("./logs")
@@ -19,6 +24,19 @@ ERROR_LOG_BACKUP_COUNT = 10
 UVICORN_ACCESS_LEVEL = "WARNING"
 UVICORN_ERROR_LEVEL = "INFO"
 
+# Async mode: callers only enqueue records, a listener thread formats and writes them.
+# When the queue is full records are dropped and counted, see dropped_log_records().
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Fraction of records below WARNING kept per logger, for high-volume INFO lines, as "logger=rate,..."
+# the default samples the per-message logs of stream_task_status
+LOG_SAMPLE_RATES: Dict[str, float] = {
+    name.strip(): float(rate)
+    for name, _, rate in (
+        entry.partition("=") for entry in os.getenv("LOG_SAMPLE_RATES", "app.router.api.tasks.stream=0.1").split(",") if entry.strip()
+    )
+}
+
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -70,6 +88,10 @@ def _coerce_json_value(value: Any) -> Any:
         return repr(value)
 
 
+def _json_default(value: Any) -> Any:
+    return repr(value)
+
+
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         log_entry: Dict[str, Any] = {
@@ -84,14 +106,20 @@ class JsonFormatter(logging.Formatter):
 
         if record.exc_info:
             log_entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:  # already formatted by DroppingQueueHandler.prepare
+            log_entry["exc_info"] = record.exc_text
         if record.stack_info:
             log_entry["stack_info"] = record.stack_info
 
         for key, value in record.__dict__.items():
             if key not in _RESERVED_ATTRS:
-                log_entry[key] = _coerce_json_value(value)
+                log_entry[key] = value
 
-        return json.dumps(log_entry, ensure_ascii=False)
+        # single serialization pass, values json can't handle are written as repr()
+        try:
+            return json.dumps(log_entry, ensure_ascii=False, default=_json_default)
+        except (TypeError, ValueError):  # e.g. circular reference or non-str dict keys, fall back to checking every field
+            return json.dumps({key: _coerce_json_value(value) for key, value in log_entry.items()}, ensure_ascii=False)
 
 
 class ContextFilter(logging.Filter):
@@ -100,6 +128,65 @@ class ContextFilter(logging.Filter):
         return True
 
 
+class SamplingFilter(logging.Filter):
+    """Keep only `rate` of the records below WARNING"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Enqueue records for the listener thread without blocking the caller.
+    Runs in the caller's context, so the trace id is captured here.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only merge the message args here, JSON formatting happens on the listener thread
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class LogQueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)  # wait for room instead of raising queue.Full on a busy queue
+
+
+_queue_handler: Optional[DroppingQueueHandler] = None
+_queue_listener: Optional[LogQueueListener] = None
+
+
+def dropped_log_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def stop_logging() -> None:
+    """Flush and stop the listener thread, registered with atexit"""
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
 
 def _build_formatter() -> logging.Formatter:
     if LOG_STRUCTURED:
@@ -108,6 +195,9 @@ def _build_formatter() -> logging.Formatter:
 
 
 def setup_logger() -> None:
+    global _queue_handler, _queue_listener
+    stop_logging()
+
     root_logger = logging.getLogger()
     root_logger.setLevel(ROOT_LOG_LEVEL)
     root_logger.handlers.clear()
@@ -138,12 +228,23 @@ def setup_logger() -> None:
     error_handler.setLevel(logging.ERROR)
     error_handler.setFormatter(formatter)
     
-    for handler in (console_handler, file_handler, error_handler):
-        handler.addFilter(ContextFilter())
-
-    root_logger.addHandler(console_handler)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(error_handler)
+    handlers = (console_handler, file_handler, error_handler)
+    if LOG_ASYNC:
+        _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        _queue_handler.addFilter(ContextFilter())
+        _queue_listener = LogQueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _queue_listener.start()
+        root_logger.addHandler(_queue_handler)
+    else:
+        _queue_handler = None
+        for handler in handlers:
+            handler.addFilter(ContextFilter())
+            root_logger.addHandler(handler)
+
+    for logger_name, rate in LOG_SAMPLE_RATES.items():
+        sampled_logger = logging.getLogger(logger_name)
+        sampled_logger.filters = [f for f in sampled_logger.filters if not isinstance(f, SamplingFilter)]
+        sampled_logger.addFilter(SamplingFilter(rate))
 
     logging.getLogger("uvicorn.access").setLevel(UVICORN_ACCESS_LEVEL)
     logging.getLogger("uvicorn.error").setLevel(UVICORN_ERROR_LEVEL)
@@ -154,6 +255,7 @@ def get_logger(name: str) -> logging.Logger:
 
 
 setup_logger()
+atexit.register(stop_logging)
 
 
 if __name__ == "__main__":
@@ -3,13 +3,17 @@ import json
 import os
 from dotenv import load_dotenv
 import uuid
-from fastapi import FastAPI, Depends, Request
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi.responses import Response
-from fastapi_limiter import FastAPILimiter
-import redis.asyncio as aioredis
+from fastapi import FastAPI, Depends
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from app.monitoring import MetricsMiddleware
+from app.monitoring import MetricsMiddleware, MetricsPusher, metrics_endpoint, METRICS_MODE
+from app.core.security import password_hash_executor
+from app.core.variants import variant_service
+from app.core.pubsub import task_event_dispatcher
+from app.core.redis import redis_manager
+from app.core.dependencies import start_storage_services, close_storage_services, get_storage_service, get_output_storage_service
+from app.core.lifecycle import storage_lifecycle, STORAGE_LIFECYCLE_ENABLED
 
 load_dotenv()
 
@@ -19,14 +23,26 @@ from app.logger_config import get_logger, set_trace_id, clear_trace_id
 logger = get_logger(__name__)
 
 
-class TraceIdMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+class TraceIdMiddleware:
+    """Pure ASGI middleware: the trace id stays set for the whole request, including streamed bodies"""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = Headers(scope=scope).get("X-Request-ID") or uuid.uuid4().hex
         set_trace_id(trace_id)
+
+        async def send_with_trace_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Request-ID", trace_id)
+            await send(message)
+
         try:
-            response: Response = await call_next(request)
-            response.headers["X-Request-ID"] = trace_id
-            return response
+            await self.app(scope, receive, send_with_trace_id)
         finally:
             clear_trace_id()
 
@@ -40,10 +56,29 @@ app.add_middleware(MetricsMiddleware)
 from app.router import router as main_router
 app.include_router(main_router)
 
+# metrics: scraped from /metrics, or pushed in the background
+metrics_pusher = MetricsPusher(job="fastapi_app") if METRICS_MODE == "push" else None
+if metrics_pusher is None:
+    app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
 
-# set up api limiter
 @app.on_event("startup")
 async def startup():
-    redis = aioredis.from_url(os.getenv("REDIS_URL"), encoding="utf-8", decode_responses=True)
-    await FastAPILimiter.init(redis)
+    if metrics_pusher is not None:
+        await metrics_pusher.start()
+    await start_storage_services()
+    if STORAGE_LIFECYCLE_ENABLED:
+        await storage_lifecycle.start(await get_storage_service(), await get_output_storage_service())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    password_hash_executor.shutdown()
+    variant_service.executor.shutdown()
+    await task_event_dispatcher.stop()
+    if metrics_pusher is not None:
+        await metrics_pusher.stop()
+    await storage_lifecycle.stop()
+    await close_storage_services()
+    await redis_manager.close()
 
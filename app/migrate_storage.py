@@ -0,0 +1,65 @@
+# move the files of the flat UPLOAD_DIR layout into LocalStorage's hash-prefix directories
+## safe while the app and worker are running: every move is an atomic rename and LocalStorage
+## still finds files at their flat path until they are moved
+##   python -m app.migrate_storage [--dry-run]
+import argparse
+import os
+import time
+
+from dotenv import load_dotenv
+
+from app.core.storage import LocalStorage
+from app.logger_config import get_logger
+
+logger = get_logger(__name__)
+
+
+def migrate_flat_layout(storage: LocalStorage, dry_run: bool = False, progress_every: int = 100000) -> dict:
+    '''
+    Move every file directly under the base directory to its sharded path, returns counts by outcome.
+    A file that already exists at its sharded path is newer and is kept, the flat copy is left in place.
+    '''
+    counts = {'moved': 0, 'conflicts': 0, 'skipped': 0}
+    if storage.shard_depth <= 0:
+        raise ValueError("LOCAL_STORAGE_SHARD_DEPTH is 0, there is no sharded layout to migrate to")
+
+    created_dirs = set()
+    with os.scandir(storage.base_dir) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or entry.name.endswith('.part'):
+                counts['skipped'] += 1  # shard directories and writes in progress
+                continue
+            target = storage.get_local_file_path(entry.name)
+            if os.path.exists(target):
+                logger.warning("migrate_storage: sharded file exists, keeping it", extra={'file_id': entry.name})
+                counts['conflicts'] += 1
+                continue
+            if not dry_run:
+                directory = os.path.dirname(target)
+                if directory not in created_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                    created_dirs.add(directory)
+                os.replace(entry.path, target)
+            counts['moved'] += 1
+            if counts['moved'] % progress_every == 0:
+                logger.info("migrate_storage: progress", extra=counts)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move flat UPLOAD_DIR files into the sharded LocalStorage layout")
+    parser.add_argument("--dry-run", action="store_true", help="count the files to move without moving them")
+    args = parser.parse_args()
+
+    load_dotenv()
+    storage = LocalStorage()
+    start_time = time.perf_counter()
+    counts = migrate_flat_layout(storage, dry_run=args.dry_run)
+    elapsed = time.perf_counter() - start_time
+    logger.info("migrate_storage: done", extra={**counts, 'dry_run': args.dry_run, 'seconds': round(elapsed, 1)})
+    print(f"{'would move' if args.dry_run else 'moved'} {counts['moved']} files, "
+          f"{counts['conflicts']} conflicts, {counts['skipped']} skipped in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
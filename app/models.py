@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Text, Enum as SQLEnum
+from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, Text, Index, Enum as SQLEnum
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -58,4 +58,11 @@ class ProcessingTask(Base):
     
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     completed_at = Column(DateTime(timezone=True))
+    files_expired_at = Column(DateTime(timezone=True))  # input and output files deleted by the storage lifecycle sweeper
 
+    __table_args__ = (
+        # keyset pagination of a user's tasks, see crud.task.get_tasks_by_user_page
+        Index("idx_tasks_user_created", user_id, created_at.desc(), id.desc()),
+        # tasks whose files still exist, oldest first, see app.core.lifecycle
+        Index("idx_tasks_files_live", created_at, id, postgresql_where=files_expired_at.is_(None)),
+    )
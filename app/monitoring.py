@@ -1,10 +1,25 @@
+import asyncio
+import os
+import socket
 import time
-from starlette.middleware.base import BaseHTTPMiddleware
-from prometheus_client import Counter, Histogram, CollectorRegistry, push_to_gateway
+from typing import Optional
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, push_to_gateway, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily
 from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from app.logger_config import get_logger, dropped_log_records
+
+logger = get_logger(__name__)
 
 registry = CollectorRegistry()
 
+# "scrape": expose /metrics, "push": push the registry to the Pushgateway from a background task
+METRICS_MODE = os.getenv("METRICS_MODE", "scrape").lower()
+PUSHGATEWAY_URL = os.getenv("PUSHGATEWAY_URL", "pushgateway:9091")
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", 15))
+
 # Metrics 
 REQUEST_COUNT = Counter(
     "fastapi_http_requests_total",
@@ -15,35 +30,358 @@ REQUEST_COUNT = Counter(
 
 REQUEST_LATENCY = Histogram(
     "fastapi_http_request_duration_seconds",
-    "HTTP request latency",
+    "HTTP request latency, until the last body chunk is sent (whole stream for SSE)",
+    ["method", "path"],
+    registry=registry,
+)
+
+REQUEST_TTFB = Histogram(
+    "fastapi_http_request_ttfb_seconds",
+    "HTTP time to first byte, until the response headers are sent",
     ["method", "path"],
     registry=registry,
 )
 
+# Worker: batched task status writer
+TASK_STATUS_BATCH_SIZE = Histogram(
+    "worker_task_status_batch_size",
+    "Number of task status updates written per bulk UPDATE",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+    registry=registry,
+)
+
+TASK_STATUS_FLUSH_LATENCY = Histogram(
+    "worker_task_status_flush_duration_seconds",
+    "Latency of one bulk task status UPDATE",
+    registry=registry,
+)
+
+TASK_STATUS_FLUSH_FAILURES = Counter(
+    "worker_task_status_flush_failures_total",
+    "Task status updates lost because the bulk UPDATE failed",
+    registry=registry,
+)
+
+TASK_STATUS_PENDING = Gauge(
+    "worker_task_status_pending",
+    "Task status updates buffered and waiting for the next flush",
+    registry=registry,
+)
+
+# Auth: cached principals
+AUTH_CACHE_LOOKUPS = Counter(
+    "auth_cache_lookups_total",
+    "Authenticated principal lookups by cache layer (token, local, redis) and result",
+    ["layer", "result"],
+    registry=registry,
+)
+
+# Auth: password hashing executor
+PASSWORD_HASH_QUEUE_TIME = Histogram(
+    "password_hash_queue_seconds",
+    "Time a password hash/verify waited for a hashing thread",
+    ["op"],
+    registry=registry,
+)
+
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds",
+    "Time spent computing a password hash/verify",
+    ["op"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0),
+    registry=registry,
+)
+
+PASSWORD_HASH_REJECTED = Counter(
+    "password_hash_rejected_total",
+    "Password hash/verify requests rejected because the hashing executor was full",
+    ["op"],
+    registry=registry,
+)
+
+PASSWORD_HASH_IN_FLIGHT = Gauge(
+    "password_hash_in_flight",
+    "Password hash/verify requests running or queued",
+    registry=registry,
+)
 
-class MetricsMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        """Record metrics for every request"""
+# Pub/Sub: task event dispatcher
+TASK_EVENT_SUBSCRIBERS = Gauge(
+    "task_event_subscribers",
+    "Local subscribers (SSE streams, WebSockets) attached to the task event dispatcher",
+    registry=registry,
+)
 
-        method = request.method
-        path = request.url.path
+TASK_EVENT_MESSAGES = Counter(
+    "task_event_messages_total",
+    "Task events received from the task:* pattern subscription",
+    registry=registry,
+)
 
-        start_time = time.time()
+TASK_EVENT_DROPPED = Counter(
+    "task_event_dropped_total",
+    "Task events dropped for a subscriber: its queue was full, a newer event replaced it (coalesced) or it was reaped as idle",
+    ["reason"],
+    registry=registry,
+)
 
-        response = await call_next(request)
-        status_code = response.status_code
+# Task state snapshot in Redis, see app.core.task_state
+TASK_STATE_LOOKUPS = Counter(
+    "task_state_lookups_total",
+    "Task status reads served from the Redis snapshot (hit) or falling back to Postgres (miss, error)",
+    ["result"],
+    registry=registry,
+)
 
-        duration = time.time() - start_time
+# Worker progress events, see worker.db.notification_client
+TASK_PROGRESS_PUBLISHED = Counter(
+    "task_progress_published_total",
+    "Task progress events published to Redis",
+    registry=registry,
+)
 
-        # record metrics
-        REQUEST_COUNT.labels(method=method, path=path, status=status_code).inc()
-        REQUEST_LATENCY.labels(method=method, path=path).observe(duration)
+TASK_PROGRESS_COALESCED = Counter(
+    "task_progress_coalesced_total",
+    "Task progress reports replaced by a newer one of the same task before they were published",
+    registry=registry,
+)
 
-        # push registry to pushgateway
-        push_to_gateway(
-            "pushgateway:9091",
-            job="fastapi_app",
-            registry=registry
+# Redis connection pools, one per role, see app.core.redis
+REDIS_POOL_MAX_CONNECTIONS = Gauge(
+    "redis_pool_max_connections",
+    "Size of the Redis connection pool of a role",
+    ["role"],
+    registry=registry,
+)
+
+REDIS_POOL_IN_USE = Gauge(
+    "redis_pool_connections_in_use",
+    "Redis connections checked out of the pool of a role",
+    ["role"],
+    registry=registry,
+)
+
+REDIS_POOL_WAIT = Histogram(
+    "redis_pool_wait_seconds",
+    "Time spent waiting for a free connection of a role's pool",
+    ["role"],
+    buckets=[0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0],
+    registry=registry,
+)
+
+REDIS_POOL_EXHAUSTED = Counter(
+    "redis_pool_exhausted_total",
+    "Commands that gave up waiting for a connection because the pool of their role stayed full",
+    ["role"],
+    registry=registry,
+)
+
+# Rate limiting, see app.core.rate_limit
+RATE_LIMIT_DECISIONS = Counter(
+    "rate_limit_decisions_total",
+    "Rate limit decisions, from the local leased permits or a Redis call",
+    ["source", "result"],
+    registry=registry,
+)
+
+RATE_LIMIT_REDIS_LATENCY = Histogram(
+    "rate_limit_redis_seconds",
+    "Latency of the atomic Redis lease call of the rate limiter",
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1],
+    registry=registry,
+)
+
+# Storage disk cache, see app.core.storage.CachedStorage
+STORAGE_CACHE_REQUESTS = Counter(
+    "storage_cache_requests_total",
+    "Reads of the storage disk cache: hit, miss (fetched from the backend) or coalesced (waited on another fetch)",
+    ["result"],
+    registry=registry,
+)
+
+STORAGE_CACHE_EVICTIONS = Counter(
+    "storage_cache_evictions_total",
+    "Files evicted from the storage disk cache to stay within its size budget",
+    registry=registry,
+)
+
+STORAGE_CACHE_BYTES = Gauge(
+    "storage_cache_bytes",
+    "Bytes held by the storage disk cache",
+    registry=registry,
+)
+
+# Storage lifecycle, see app.core.lifecycle
+STORAGE_LIFECYCLE_TASKS_EXPIRED = Counter(
+    "storage_lifecycle_tasks_expired_total",
+    "Tasks whose files were deleted by the lifecycle sweeper, by age (ttl) or to meet the local disk budget (budget)",
+    ["reason"],
+    registry=registry,
+)
+
+STORAGE_LIFECYCLE_DELETE_FAILURES = Counter(
+    "storage_lifecycle_delete_failures_total",
+    "Files the lifecycle sweeper failed to delete, their tasks are retried by the next sweep",
+    registry=registry,
+)
+
+STORAGE_LIFECYCLE_SWEEP_SECONDS = Histogram(
+    "storage_lifecycle_sweep_seconds",
+    "Duration of a lifecycle sweep",
+    buckets=[0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0],
+    registry=registry,
+)
+
+LOCAL_STORAGE_BYTES = Gauge(
+    "local_storage_bytes",
+    "Bytes under the local storage directory, measured by the lifecycle sweeper",
+    registry=registry,
+)
+
+# Image endpoints, see app.router.api.images
+IMAGE_RESPONSES = Counter(
+    "image_responses_total",
+    "Image responses by kind: full, partial (206), not_modified (304), unsatisfiable (416) or redirect (307 to a signed URL)",
+    ["result"],
+    registry=registry,
+)
+
+DOWNLOAD_URL_REQUESTS = Counter(
+    "download_url_requests_total",
+    "Signed download URLs handed out: cached (reused), signed (new) or unsupported (the storage cannot sign, proxied)",
+    ["result"],
+    registry=registry,
+)
+
+VARIANT_REQUESTS = Counter(
+    "image_variant_requests_total",
+    "Image variant lookups: known (stored, no check), stored (found in storage), rendered, coalesced (waited on a render) or rejected (render pool full)",
+    ["result"],
+    registry=registry,
+)
+
+VARIANT_RENDER_SECONDS = Histogram(
+    "image_variant_render_seconds",
+    "Time to render an image variant in the render pool, by format",
+    ["format"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5],
+    registry=registry,
+)
+
+# In-process image byte cache, see app.core.object_cache
+OBJECT_CACHE_REQUESTS = Counter(
+    "image_memory_cache_requests_total",
+    "Reads of the in-memory image cache: hit, miss (read from storage), coalesced (waited on another read), "
+    "oversized (too large to cache, streamed) or bypass (known oversized)",
+    ["result"],
+    registry=registry,
+)
+
+OBJECT_CACHE_BYTES_SAVED = Counter(
+    "image_memory_cache_bytes_saved_total",
+    "Image bytes served from the in-memory cache instead of a storage read",
+    registry=registry,
+)
+
+OBJECT_CACHE_BYTES = Gauge(
+    "image_memory_cache_bytes",
+    "Bytes held by the in-memory image cache",
+    registry=registry,
+)
+
+# Logging: records dropped by the async logging queue, counted in app.logger_config
+class LogDropCollector:
+    def collect(self):
+        yield CounterMetricFamily(
+            "log_records_dropped",
+            "Log records dropped because the logging queue was full",
+            value=dropped_log_records(),
         )
 
-        return response
+registry.register(LogDropCollector())
+
+
+def route_template(scope) -> str:
+    """Path template of the matched route (e.g. /api/tasks/{task_id}), keeps label cardinality bounded"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Record metrics for every request, as a pure ASGI middleware so streaming responses pass through untouched.
+    Time to first byte ends at http.response.start, duration ends when the app returns after the last body chunk.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500  # if the app fails before starting a response
+        start_time = time.perf_counter()
+        first_byte_time = None
+
+        async def send_with_metrics(message: Message):
+            nonlocal status_code, first_byte_time
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                first_byte_time = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            duration = time.perf_counter() - start_time
+
+            # record metrics, the router has put the matched route into the scope by now
+            path = route_template(scope)
+            REQUEST_COUNT.labels(method=method, path=path, status=status_code).inc()
+            REQUEST_LATENCY.labels(method=method, path=path).observe(duration)
+            if first_byte_time is not None:
+                REQUEST_TTFB.labels(method=method, path=path).observe(first_byte_time - start_time)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Prometheus scrape endpoint"""
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsPusher:
+    """
+    Push the registry to the Pushgateway every `interval` seconds from a background task,
+    so no request ever waits on the Pushgateway.
+    """
+    def __init__(self, job: str, gateway: str = PUSHGATEWAY_URL, interval: float = METRICS_PUSH_INTERVAL):
+        self.job = job
+        self.gateway = gateway
+        self.interval = interval
+        # one group per process, otherwise processes of the same job overwrite each other
+        self.grouping_key = {"instance": f"{socket.gethostname()}-{os.getpid()}"}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.push()  # last values before exit
+
+    async def push(self):
+        try:
+            await asyncio.to_thread(push_to_gateway, self.gateway, job=self.job, registry=registry, grouping_key=self.grouping_key)
+        except Exception as e:
+            logger.warning(f"MetricsPusher: push to {self.gateway} failed: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.push()
+
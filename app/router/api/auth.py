@@ -1,16 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from datetime import timedelta
 
 from app.database import get_db
 from app.schemas import UserCreate, User, UserLogin, TokenResponse
 from app.crud import user as user_crud
 from app.core.security import (
-    verify_password, 
-    get_password_hash, 
+    verify_password_async, 
+    get_password_hash_async, 
+    password_needs_rehash,
+    PasswordHashingBusy,
     create_access_token,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    SELF_CONTAINED_TOKENS
 )
+from app.core.auth_cache import auth_cache, principal_claims
 from app.core.dependencies import get_current_user, get_strict_rate_limiter, get_moderate_rate_limiter
 
 
@@ -19,11 +24,27 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 from app.logger_config import get_logger
 logger = get_logger(__name__)
 
+
+def _token_data(user) -> dict:
+    data = {"sub": str(user.id)}
+    if SELF_CONTAINED_TOKENS:
+        data.update(principal_claims(user))
+    return data
+
+
+def _hashing_busy_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Authentication service busy, please retry",
+        headers={"Retry-After": "1"},
+    )
+
+
 @router.post("/register", response_model=TokenResponse, status_code=status.HTTP_201_CREATED, dependencies=[get_strict_rate_limiter()])
-def register(user_in: UserCreate, db: Session = Depends(get_db)):
+async def register(user_in: UserCreate, db: Session = Depends(get_db)):
     logger.info(f"Registration attempt", extra={'email': user_in.email})
     
-    existing_user = user_crud.get_user_by_email(db, user_in.email)
+    existing_user = await run_in_threadpool(user_crud.get_user_by_email, db, user_in.email)
     if existing_user:
         logger.warning(f"Email already registered", extra={'email': user_in.email})
         raise HTTPException(
@@ -31,13 +52,17 @@ def register(user_in: UserCreate, db: Session = Depends(get_db)):
             detail="Email already registered"
         )
     
-    password_hash = get_password_hash(user_in.password)
-    user = user_crud.create_user(db, user_in, password_hash)
+    try:
+        password_hash = await get_password_hash_async(user_in.password)
+    except PasswordHashingBusy:
+        logger.warning(f"Registration rejected: password hashing busy", extra={'email': user_in.email})
+        raise _hashing_busy_exception()
+    user = await run_in_threadpool(user_crud.create_user, db, user_in, password_hash)
     logger.info(f"User successfully created", extra={'email': user_in.email, 'ID': user.id})
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id)},
+        data=_token_data(user),
         expires_delta=access_token_expires
     )
     
@@ -45,10 +70,10 @@ def register(user_in: UserCreate, db: Session = Depends(get_db)):
 
 
 @router.post("/login", response_model=TokenResponse, dependencies=[get_strict_rate_limiter()])
-def login(user_login: UserLogin, db: Session = Depends(get_db)):
+async def login(user_login: UserLogin, db: Session = Depends(get_db)):
     logger.info(f"Login attempt", extra={'email': user_login.email})
     
-    user = user_crud.get_user_by_email(db, user_login.email)
+    user = await run_in_threadpool(user_crud.get_user_by_email, db, user_login.email)
     if not user:
         logger.warning(f"Login failed: user not found", extra={'email': user_login.email})
         raise HTTPException(
@@ -57,7 +82,13 @@ def login(user_login: UserLogin, db: Session = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    if not verify_password(user_login.password, user.password_hash):
+    try:
+        password_ok = await verify_password_async(user_login.password, user.password_hash)
+    except PasswordHashingBusy:
+        logger.warning(f"Login rejected: password hashing busy", extra={'email': user_login.email})
+        raise _hashing_busy_exception()
+
+    if not password_ok:
         logger.warning(f"Login failed: incorrect password for email", extra={'email': user_login.email})
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -65,15 +96,24 @@ def login(user_login: UserLogin, db: Session = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    user_crud.update_last_login(db, user.id)
+    # upgrade hashes made with older Argon2 parameters, best effort
+    new_password_hash = None
+    if password_needs_rehash(user.password_hash):
+        try:
+            new_password_hash = await get_password_hash_async(user_login.password)
+        except PasswordHashingBusy:
+            pass
+
+    user = await run_in_threadpool(user_crud.update_last_login, db, user.id, new_password_hash)
+    await auth_cache.invalidate(user.id)  # last_login changed, drop cached principal
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.id)},
+        data=_token_data(user),
         expires_delta=access_token_expires
     )
     
-    logger.info(f"Login successful", extra={'email': user_in.email, 'ID': user.id})
+    logger.info(f"Login successful", extra={'email': user_login.email, 'ID': user.id})
     return TokenResponse(access_token=access_token)
 
 
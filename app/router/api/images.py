@@ -1,14 +1,24 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import FileResponse, Response
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
+from functools import partial
+from typing import Awaitable, Callable, Optional, Tuple
+import hashlib
 import os
 
 from app.database import get_db
-from app.models import User
+from app.models import User, TaskStatus
+from app.schemas import ProcessingTask
 from app.crud import task as task_crud
-from app.core.dependencies import get_current_user, get_storage_service, get_s3_storage_service
+from app.core.dependencies import get_current_user, get_output_storage_service, get_storage_service
+from app.core.task_state import task_state_store, TaskStateStore
+from app.core.download_urls import download_url_cache, verify_local_download, IMAGE_DELIVERY_MODE
+from app.core.object_cache import image_object_cache
+from app.core.variants import variant_service, variant_spec, variant_id, VariantRenderingBusy, VARIANT_FORMATS
+from app.core.output_encoding import output_encoding, output_file_id, composite_file_id, OUTPUT_FORMATS
 from app.logger_config import get_logger
-from app.core.storage import StorageService
+from app.core.storage import StorageService, ObjectStream, InvalidRangeError
+from app.monitoring import IMAGE_RESPONSES
 
 
 
@@ -16,74 +26,288 @@ logger = get_logger(__name__)
 
 router = APIRouter(prefix="/images", tags=["images"])
 
-@router.get("/preview/{task_id}/{filename}")
-async def get_preview_image(
-    task_id: str,
-    filename: str,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db),
-    storage_service: StorageService = Depends(get_storage_service)
-):
-    logger.info("get_preview_image", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+# seconds browsers may reuse an output without revalidating, outputs of completed tasks never change
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", 365 * 86400))
+
+
+def output_etag(task: ProcessingTask, file_id: Optional[str] = None) -> str:
+    '''
+    Strong ETag of a task's output, or of its variant `file_id`. The output is written once, before the task completes,
+    under a key derived from the task's unique input file id, so the task and key identify the bytes.
+    '''
+    file_id = file_id or StorageService.get_output_id(task.input_image_s3_key)
+    return '"' + hashlib.sha256(f"{task.id}:{file_id}".encode()).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    '''If-None-Match uses the weak comparison: W/ prefixes are ignored'''
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def parse_range(range_header: Optional[str]) -> Optional[Tuple[int, Optional[int]]]:
+    '''
+    (start, end) of a single `bytes=` range, a negative start for a suffix range (bytes=-N).
+    None serves the whole image: no header, another unit, several ranges or a malformed one.
+    '''
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    first, dash, last = spec.strip().partition("-")
+    if unit.strip().lower() != "bytes" or not dash or "," in spec:
+        return None
+    if not first:
+        return (-int(last), None) if last.isdigit() and int(last) > 0 else None
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    start, end = int(first), int(last) if last else None
+    if end is not None and end < start:
+        return None
+    return start, end
+
+
+async def _get_authorized_task(task_id: str, filename: str, current_user: User, db: Session) -> ProcessingTask:
+    '''
+    The task the image belongs to, the Redis status snapshot is tried before Postgres.
+    Raises 400/404/403/410 like the endpoints always have.
+    '''
+    log_extra = {"task_id": task_id, "upload_filename": filename, "user_id": current_user.id}
     # Security: prevent path traversal
     if ".." in filename or "/" in filename:
-        logger.warning("Invalid filename", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+        logger.warning("Invalid filename", extra=log_extra)
         raise HTTPException(status_code=400, detail="Invalid filename")
-    
+
     # Verify task ownership
-    # import pdb; pdb.set_trace()
-    task = task_crud.get_task(db, task_id)
+    snapshot = await task_state_store.get(task_id)
+    task = TaskStateStore.to_task(snapshot)
+    if task is None:
+        db_task = task_crud.get_task(db, task_id)
+        if db_task is not None:
+            await task_state_store.put_task(db_task)
+            task = TaskStateStore.to_task(snapshot, db_task)
     if not task:
-        logger.warning("Task not found", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+        logger.warning("Task not found", extra=log_extra)
         raise HTTPException(status_code=404, detail="Task not found")
-    
+
     if task.user_id != current_user.id or filename != task.input_image_s3_key:
-        logger.warning("User access to file denied", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+        logger.warning("User access to file denied", extra=log_extra)
         raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Infer preview/output filename from input_image_s3_key
-    expected_preview_id = StorageService.get_output_id(task.input_image_s3_key)
-    preview_content = await storage_service.read(expected_preview_id)
-    # logger.info(f"get_preview_image: preview_content: {len(preview_content)} bytes")
 
-    if not preview_content:
+    if task.files_expired_at is not None:
+        raise HTTPException(status_code=410, detail="Task files have expired")
+    return task
+
+
+def _task_output(task: ProcessingTask) -> Tuple[str, str]:
+    '''(storage key, format) of the task's output, in the encoding pinned into its parameters at creation'''
+    try:
+        encoding = output_encoding(task.parameters)
+    except ValueError:
+        encoding = output_encoding(None)  # such tasks failed in the worker, they have no output
+    return output_file_id(task.input_image_s3_key, encoding), encoding.format
+
+
+def _rendering_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Image variants are busy, try again", headers={"Retry-After": "1"})
+
+
+def _caching_headers(task: ProcessingTask, file_id: str) -> Tuple[dict, Optional[str]]:
+    '''
+    Headers and ETag of a file of the task. Outputs of completed tasks and their variants are immutable:
+    they get a strong ETag and a long Cache-Control, others are never reused unvalidated and have no ETag.
+    '''
+    headers = {"Accept-Ranges": "bytes"}
+    if task.status != TaskStatus.COMPLETED:
+        headers["Cache-Control"] = "private, no-cache"  # may still be written
+        return headers, None
+    etag = output_etag(task, file_id)
+    headers["ETag"] = etag
+    headers["Cache-Control"] = f"private, max-age={IMAGE_CACHE_MAX_AGE}, immutable"
+    return headers, etag
+
+
+def _not_modified(request: Request, headers: dict, etag: Optional[str]) -> Optional[Response]:
+    '''304 if the client holds the current bytes, answered without touching storage'''
+    if etag is None or not etag_matches(request.headers.get("if-none-match"), etag):
+        return None
+    IMAGE_RESPONSES.labels(result="not_modified").inc()
+    return Response(status_code=304, headers=headers)
+
+
+async def _deliver(request: Request, storage_service: StorageService, file_id: str, headers: dict, etag: Optional[str], media_type: str) -> Optional[Response]:
+    '''
+    The file, None if it does not exist. In redirect mode immutable files are delivered
+    by a 307 to a signed URL of the storage instead of through the API.
+    '''
+    if etag is not None and IMAGE_DELIVERY_MODE == "redirect":
+        signed = await download_url_cache.get(storage_service, file_id, headers["Cache-Control"])
+        if signed is not None:
+            url, reusable_for = signed
+            IMAGE_RESPONSES.labels(result="redirect").inc()
+            # the browser may follow the cached redirect as long as the URL is handed out
+            return RedirectResponse(url, status_code=307, headers={"Cache-Control": f"private, max-age={int(reusable_for)}"})
+    # hot images from memory, one storage read for concurrent requests; larger ones streamed, never buffered whole
+    open_range = partial(image_object_cache.open_read, storage_service, file_id)
+    return await _stream_response(request, open_range, headers, etag, media_type)
+
+
+async def _image_response(request: Request, task: ProcessingTask, storage_service: StorageService, input_storage: StorageService) -> Optional[Response]:
+    '''The task's output, None if it does not exist. Mask-only outputs are served composited onto the input.'''
+    output_id, image_format = _task_output(task)
+    if image_format != "mask":
+        headers, etag = _caching_headers(task, output_id)
+        return _not_modified(request, headers, etag) or await _deliver(request, storage_service, output_id, headers, etag, OUTPUT_FORMATS[image_format].media_type)
+
+    # never stored, so never redirected: composited once and kept in memory while hot
+    key = composite_file_id(task.input_image_s3_key)
+    headers, etag = _caching_headers(task, key)
+    not_modified = _not_modified(request, headers, etag)
+    if not_modified is not None:
+        return not_modified
+    composite = partial(variant_service.composite, storage_service, input_storage, task.input_image_s3_key, output_id)
+    try:
+        return await _stream_response(request, partial(image_object_cache.open_computed, key, composite), headers, etag, "image/png")
+    except VariantRenderingBusy:
+        raise _rendering_busy()
+
+
+async def _stream_response(
+    request: Request, open_range: Callable[[int, Optional[int]], Awaitable[Optional[ObjectStream]]], headers: dict, etag: Optional[str], media_type: str = "image/png"
+) -> Optional[Response]:
+    '''
+    Stream the bytes of `open_range(start, end)` through the API, None if they do not exist.
+    A single Range is served as 206, honouring If-Range.
+    '''
+    byte_range = parse_range(request.headers.get("range"))
+    if_range = request.headers.get("if-range")
+    if byte_range is not None and if_range is not None and if_range != etag:
+        byte_range = None  # the client's partial copy is of other bytes, send them all
+
+    try:
+        stream = await open_range(*(byte_range or (0, None)))
+    except InvalidRangeError as e:
+        IMAGE_RESPONSES.labels(result="unsatisfiable").inc()
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{e.size}"})
+    if stream is None:
+        return None
+
+    headers["Content-Length"] = str(stream.content_length)
+    if byte_range is None:
+        IMAGE_RESPONSES.labels(result="full").inc()
+        return StreamingResponse(stream, media_type=media_type, headers=headers)
+    headers["Content-Range"] = f"bytes {stream.start}-{stream.end}/{stream.size}"
+    IMAGE_RESPONSES.labels(result="partial").inc()
+    return StreamingResponse(stream, status_code=206, media_type=media_type, headers=headers)
+
+
+@router.get("/preview/{task_id}/{filename}")
+async def get_preview_image(
+    task_id: str,
+    filename: str,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    storage_service: StorageService = Depends(get_output_storage_service),
+    input_storage: StorageService = Depends(get_storage_service)
+):
+    logger.info("get_preview_image", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+    task = await _get_authorized_task(task_id, filename, current_user, db)
+
+    # the preview is the output of the task
+    response = await _image_response(request, task, storage_service, input_storage)
+    if response is None:
         logger.warning("Preview image not found", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
         raise HTTPException(status_code=404, detail="Preview image not found")
-    
-    return Response(content=preview_content, media_type="image/png")
+    return response
 
 @router.get("/output/{task_id}/{filename}")
 async def get_output_image(
     task_id: str,
     filename: str,
+    request: Request,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
-    storage_service: StorageService = Depends(get_s3_storage_service)
+    storage_service: StorageService = Depends(get_output_storage_service),
+    input_storage: StorageService = Depends(get_storage_service)
 ):
     logger.info("get_output_image", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+    task = await _get_authorized_task(task_id, filename, current_user, db)
 
-    # Security: prevent path traversal
-    if ".." in filename or "/" in filename:
-        logger.warning("Invalid filename", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
-        raise HTTPException(status_code=400, detail="Invalid filename")
+    response = await _image_response(request, task, storage_service, input_storage)
+    if response is None:
+        logger.warning("Output image not found", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+        raise HTTPException(status_code=404, detail="Output image not found")
+    return response
 
-    # Verify task ownership
-    task = task_crud.get_task(db, task_id)
-    if not task:
-        logger.warning("Task not found", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
-        raise HTTPException(status_code=404, detail="Task not found")
-    
-    if task.user_id != current_user.id or filename != task.input_image_s3_key:
-        logger.warning("User access to file denied", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    # Infer output filename from input_image_s3_key
-    output_id = StorageService.get_output_id(task.input_image_s3_key)
-    
-    output_content = await storage_service.read(output_id)
-    # logger.info(f"get_output_image: output_content: {len(output_content)} bytes")
-    if not output_content:
+# resized / re-encoded output, rendered on first request and kept in storage, e.g. list view thumbnails
+@router.get("/variant/{task_id}/{filename}")
+async def get_image_variant(
+    task_id: str,
+    filename: str,
+    request: Request,
+    width: Optional[int] = Query(None, ge=1, description="rounded up to the next of VARIANT_SIZES"),
+    height: Optional[int] = Query(None, ge=1, description="rounded up to the next of VARIANT_SIZES"),
+    image_format: str = Query("webp", alias="format", description="png, webp or jpeg"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="lossy formats, rounded up to the next of VARIANT_QUALITIES"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    storage_service: StorageService = Depends(get_output_storage_service),
+    input_storage: StorageService = Depends(get_storage_service)
+):
+    logger.info("get_image_variant", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
+    task = await _get_authorized_task(task_id, filename, current_user, db)
+    try:
+        spec = variant_spec(width, height, image_format, quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if task.status != TaskStatus.COMPLETED:
+        raise HTTPException(status_code=404, detail="Output image not found")
+
+    # variants are keyed off the PNG output key whatever the output's format, and rendered from the actual output
+    png_output_id = StorageService.get_output_id(task.input_image_s3_key)
+    key = variant_id(png_output_id, spec)
+    headers, etag = _caching_headers(task, key)
+    not_modified = _not_modified(request, headers, etag)
+    if not_modified is not None:
+        return not_modified
+
+    output_id, image_format = _task_output(task)
+    if image_format == "mask":
+        load_source = partial(variant_service.composite, storage_service, input_storage, task.input_image_s3_key, output_id)
+    else:
+        load_source = partial(storage_service.read, output_id)
+    try:
+        found = await variant_service.ensure(storage_service, png_output_id, spec, load_source)
+    except VariantRenderingBusy:
+        raise _rendering_busy()
+    response = await _deliver(request, storage_service, key, headers, etag, VARIANT_FORMATS[spec.format].media_type) if found else None
+    if response is None:
+        variant_service.forget(key)
         logger.warning("Output image not found", extra={"task_id": task_id, "upload_filename": filename, "user_id": current_user.id})
         raise HTTPException(status_code=404, detail="Output image not found")
-    
-    return Response(content=output_content, media_type="image/png")
+    return response
+
+# LocalStorage files behind a signed URL of redirect mode, the signature stands in for the ownership check
+@router.get("/signed/{file_id}")
+async def get_signed_image(
+    file_id: str,
+    request: Request,
+    expires: int = Query(...),
+    signature: str = Query(...),
+    storage_service: StorageService = Depends(get_output_storage_service)
+):
+    if ".." in file_id or "/" in file_id or not verify_local_download(file_id, expires, signature):
+        logger.warning("Invalid or expired download signature", extra={"file_id": file_id})
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    etag = '"' + hashlib.sha256(file_id.encode()).hexdigest()[:32] + '"'  # file ids are unique and their files write-once
+    headers = {"Accept-Ranges": "bytes", "ETag": etag, "Cache-Control": f"private, max-age={IMAGE_CACHE_MAX_AGE}, immutable"}
+    not_modified = _not_modified(request, headers, etag)
+    if not_modified is not None:
+        return not_modified
+    media_type = next((fmt.media_type for fmt in VARIANT_FORMATS.values() if file_id.endswith(f".{fmt.extension}")), "image/png")
+    response = await _stream_response(request, partial(image_object_cache.open_read, storage_service, file_id), headers, etag, media_type)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return response
@@ -1,26 +1,34 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Query, Header, Response, WebSocket, WebSocketDisconnect
 from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from uuid import UUID
 from app.models import User, TaskStatus
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict
+from datetime import datetime
 import os
 import uuid
 import aiofiles
 import asyncio
 import json
+import base64
 
-from app.database import get_db
-from app.schemas import ProcessingTaskCreate, ProcessingTask, ProcessingTaskUpdate
+from app.database import get_db, SessionLocal
+from app.schemas import ProcessingTaskCreate, ProcessingTask, ProcessingTaskUpdate, ProcessingTaskPage, ProcessingTaskSummary
+from app.schemas import TaskStatusQuery, TaskStatusEntry, TaskStatusBatch
 from app.crud import task as task_crud
-from app.core.dependencies import get_strict_rate_limiter, get_moderate_rate_limiter, get_current_user, get_current_user_from_query
+from app.core.dependencies import get_strict_rate_limiter, get_moderate_rate_limiter, get_current_user, get_current_user_from_query, get_current_user_from_websocket
 from app.logger_config import get_logger
 from app.core.queue import BaseTaskQueueService, QueueTaskPayload
 from app.core.dependencies import get_queue_service, get_storage_service
-from app.core.redis import RedisClient
-from app.core.storage import StorageService
+from app.core.pubsub import task_event_dispatcher, TaskSetSubscription
+from app.core.task_state import task_state_store, TaskStateStore, TERMINAL_STATUSES
+from app.core.storage import StorageService, STREAM_CHUNK_SIZE
+from app.core.variants import THUMBNAIL_VARIANTS
+from app.core.output_encoding import pin_output_encoding
 
 logger = get_logger(__name__)
+stream_logger = get_logger(f"{__name__}.stream")  # high volume, sampled, see LOG_SAMPLE_RATES
 
 router = APIRouter(prefix="/tasks", tags=["tasks"])
 
@@ -30,6 +38,18 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
 MAX_FILE_SIZE = 10 * 1024 * 1024
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+WS_BATCH_INTERVAL = float(os.getenv("WS_BATCH_INTERVAL", 0.25))  # seconds to gather status deltas into one frame
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", 20))  # seconds without updates before a heartbeat
+WS_MAX_TASKS = int(os.getenv("WS_MAX_TASKS", 500))  # tasks subscribed per connection
+
+
+async def _iter_upload(file: UploadFile, chunk_size: int = STREAM_CHUNK_SIZE):
+    while chunk := await file.read(chunk_size):
+        yield chunk
+
 
 @router.post("/create", response_model=ProcessingTask, status_code=status.HTTP_201_CREATED, dependencies=[get_strict_rate_limiter()])
 async def create_task(
@@ -55,26 +75,34 @@ async def create_task(
     
     try:
         # step 1: validate file and store it locally
-        content = await file.read()
-        
-        if len(content) > MAX_FILE_SIZE:
+        # the upload is already spooled by the form parser, its size is known before reading it
+        if file.size is None or file.size > MAX_FILE_SIZE:
             logger.warning('file too large', extra={'file': file.filename, 'task_type': task_type, 'current_user': current_user.id, })
             raise HTTPException(
                 status_code=400, 
                 detail=f"File too large. Max size: {MAX_FILE_SIZE // (1024*1024)}MB"
             )
         
-        file_id = f"{str(uuid.uuid4())}{file_ext}"
-        
-        await storage_service.save(file_id, content)
-        
         if parameters:
             try:
                 params_dict = json.loads(parameters)
             except json.JSONDecodeError:
                 raise HTTPException(status_code=400, detail="Invalid parameters format, must be valid JSON")
+            if not isinstance(params_dict, dict):
+                raise HTTPException(status_code=400, detail="Invalid parameters format, must be a JSON object")
         else:
             params_dict = None
+        try:
+            # validated before the upload is stored, the worker would only fail the task
+            params_dict = pin_output_encoding(params_dict)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        file_id = f"{str(uuid.uuid4())}{file_ext}"
+        
+        # streamed in chunks instead of read into memory whole
+        if not await storage_service.save_stream(file_id, _iter_upload(file)):
+            raise HTTPException(status_code=500, detail="Failed to store the uploaded file")
         # step 2: store file in S3
 
         task_id = uuid.uuid4()
@@ -105,15 +133,79 @@ async def create_task(
             task=task_in, 
             model_version="v1.0"
         )
+        await task_state_store.put_task(task)  # the worker may already have updated the status, it is kept
         return task
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Task creation failed", exc_info=True, stack_info=True)
         raise HTTPException(status_code=500, detail="Task creation failed")
 
 
-# get task by user id
-@router.get("/all-tasks", response_model=List[ProcessingTask], status_code=status.HTTP_200_OK, dependencies=[get_strict_rate_limiter()])
+def encode_task_cursor(created_at: datetime, task_id: UUID) -> str:
+    raw = json.dumps([created_at.isoformat(), str(task_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_task_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    '''raises ValueError on malformed cursors'''
+    try:
+        created_at, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), UUID(task_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+# paginated task listing of current user, newest first
+@router.get("/list", response_model=ProcessingTaskPage, response_model_exclude_unset=True, status_code=status.HTTP_200_OK, dependencies=[get_strict_rate_limiter()])
+async def list_tasks(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    task_status: Optional[TaskStatus] = Query(None, alias="status"),
+    task_type: Optional[str] = Query(None),
+    fields: Optional[str] = Query(None, description="Comma separated task fields to return, id and created_at are always included"),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    try:
+        after = decode_task_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    field_list = None
+    if fields:
+        field_list = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(field_list) - set(task_crud.TASK_LIST_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    rows = task_crud.get_tasks_by_user_page(
+        db,
+        user_id=current_user.id,
+        limit=limit + 1,  # one extra row tells whether there is a next page
+        after=after,
+        status=task_status,
+        task_type=task_type,
+        fields=field_list,
+    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_task_cursor(rows[-1]['created_at'], rows[-1]['id'])
+
+    items = []
+    for row in rows:
+        item = ProcessingTaskSummary(**row)
+        if row.get('status') == TaskStatus.COMPLETED and row.get('input_image_s3_key'):
+            # list views show the eagerly rendered thumbnail, kilobytes instead of the full output
+            item.thumbnail_url = generate_thumbnail_url(item.id, item.input_image_s3_key)
+        items.append(item)
+    logger.info("list_tasks", extra={'user_id': current_user.id, 'task_count': len(rows), 'has_more': next_cursor is not None})
+    return ProcessingTaskPage(items=items, next_cursor=next_cursor)
+
+
+# get task by user id, deprecated: loads the user's whole history, use /list instead
+@router.get("/all-tasks", response_model=List[ProcessingTask], status_code=status.HTTP_200_OK, dependencies=[get_strict_rate_limiter()], deprecated=True)
 async def get_tasks_by_user(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
@@ -134,14 +226,72 @@ async def get_tasks_by_user(
 
 
 
-# get task by task id
+def _load_user_tasks(user_id: UUID, task_ids: List[UUID]) -> list:
+    db = SessionLocal()
+    try:
+        return task_crud.get_user_tasks_by_ids(db, user_id, task_ids)
+    finally:
+        db.close()
+
+async def _load_task_states(user_id: UUID, task_ids: List[str]) -> Dict[str, Tuple[ProcessingTask, dict]]:
+    '''
+    Current state of the user's tasks among task_ids: one pipelined read of the Redis snapshots,
+    then one Postgres query for the tasks without a cached row.
+    Returns task id to (task, snapshot), the snapshot is empty if there was none.
+    Unknown tasks and tasks of other users are left out.
+    '''
+    snapshots = await task_state_store.get_many(task_ids)
+
+    states = {}
+    missing = []
+    for task_id in task_ids:
+        task = TaskStateStore.to_task(snapshots.get(task_id))
+        if task is None:
+            missing.append(UUID(task_id))
+        elif task.user_id == user_id:
+            states[task_id] = (task, snapshots[task_id])
+
+    if missing:
+        db_tasks = await run_in_threadpool(_load_user_tasks, user_id, missing)
+        await task_state_store.put_tasks(db_tasks)
+        for db_task in db_tasks:
+            snapshot = snapshots.get(str(db_task.id))
+            states[str(db_task.id)] = (TaskStateStore.to_task(snapshot, db_task), snapshot or {})
+    return states
+
+# status of many tasks at once, from the Redis snapshots with one Postgres query for the rest
+@router.post("/status", response_model=TaskStatusBatch, response_model_exclude_none=True, status_code=status.HTTP_200_OK, dependencies=[get_moderate_rate_limiter()])
+async def get_task_statuses(
+    query: TaskStatusQuery,
+    current_user: User = Depends(get_current_user),
+):
+    task_ids = list(dict.fromkeys(str(task_id) for task_id in query.task_ids))
+    states = await _load_task_states(current_user.id, task_ids)
+
+    entries = [
+        TaskStatusEntry(id=task.id, status=task.status, completed_at=task.completed_at, stage=snapshot.get('stage'), percent=snapshot.get('percent'))
+        for task, snapshot in states.values()
+    ]
+    not_found = [UUID(task_id) for task_id in task_ids if task_id not in states]
+    logger.info("get_task_statuses", extra={'user_id': current_user.id, 'task_count': len(task_ids), 'not_found': len(not_found)})
+    return TaskStatusBatch(tasks=entries, not_found=not_found)
+
+
+# get task by task id, the Redis status snapshot is tried before Postgres
 @router.get("/{task_id}", response_model=ProcessingTask, status_code=status.HTTP_200_OK, dependencies=[get_strict_rate_limiter()])
 async def get_task(
     task_id: UUID,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    task = task_crud.get_task(db, task_id)
+    snapshot = await task_state_store.get(task_id)
+    task = TaskStateStore.to_task(snapshot)
+    if task is None:
+        db_task = task_crud.get_task(db, task_id)
+        if db_task is not None:
+            await task_state_store.put_task(db_task)
+            task = TaskStateStore.to_task(snapshot, db_task)
+
     if task is None or task.user_id != current_user.id:
         if task is not None:
             logger.warning('User access denied', extra={'task_id': task_id, 'user_id': current_user.id, 'task_owner_id': task.user_id})
@@ -156,69 +306,110 @@ def generate_preview_url(task_id: UUID, filename: str):
 def generate_output_url(task_id: UUID, filename: str):
     return f"/api/images/output/{task_id}/{filename}"
 
+def generate_thumbnail_url(task_id: UUID, filename: str) -> Optional[str]:
+    '''URL of the first eagerly rendered thumbnail, None if there are none'''
+    if not THUMBNAIL_VARIANTS:
+        return None
+    spec = THUMBNAIL_VARIANTS[0]
+    return f"/api/images/variant/{task_id}/{filename}?width={spec.size}&format={spec.format}"
+
+def build_stream_event(task_id: UUID, task_status: str, file_id: Optional[str], stage: Optional[str] = None, percent: Optional[int] = None) -> dict:
+    '''
+    Payload of an SSE status event, keys expected by the frontend:
+    status, preview_ready, preview_url, output_ready, output_url, thumbnail_url, and the worker progress: stage, percent
+    '''
+    data = {
+        'status': task_status,
+        'preview_ready': False,
+        'preview_url': None,
+        'output_ready': False,
+        'output_url': None,
+        'thumbnail_url': None,
+        'stage': stage,
+        'percent': percent,
+    }
+    if task_status in ('PROCESSING', 'COMPLETED') and file_id:
+        data['preview_ready'] = True
+        data['preview_url'] = generate_preview_url(task_id, file_id)
+    if task_status == 'COMPLETED' and file_id:
+        data['output_ready'] = True
+        data['output_url'] = generate_output_url(task_id, file_id)
+        data['thumbnail_url'] = generate_thumbnail_url(task_id, file_id)
+    return data
+
+def format_sse(data: dict, event_id: Optional[int] = None) -> str:
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def parse_last_event_id(last_event_id: Optional[str]) -> int:
+    '''seq of the last event the client received, -1 for none or a malformed id'''
+    try:
+        return int(last_event_id) if last_event_id is not None else -1
+    except ValueError:
+        return -1
+
 # use Redis Pub/Sub to mobnitor task progress
 # use Server-Sent Events (SSE) to stream task progress
+# events carry the snapshot seq as id, a reconnecting EventSource sends it back as Last-Event-ID
 @router.get("/{task_id}/stream", dependencies=[get_strict_rate_limiter()])
 async def stream_task_status(
     task_id: UUID,
     current_user: User = Depends(get_current_user_from_query),
+    last_event_id: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
-    # Verify task ownership
-    task = task_crud.get_task(db, task_id)
+    last_seen = parse_last_event_id(last_event_id)
+
+    # Verify task ownership, from the Redis snapshot when possible
+    snapshot = await task_state_store.get(task_id)
+    task = TaskStateStore.to_task(snapshot)
+    if task is None:
+        db_task = task_crud.get_task(db, task_id)
+        if db_task is not None:
+            await task_state_store.put_task(db_task)
+            task = TaskStateStore.to_task(snapshot, db_task)
+    db.close()  # release the DB connection now rather than holding it for the lifetime of the stream
     if not task or task.user_id != current_user.id:
         async def error_generator():
             yield f"data: {json.dumps({'error': 'Task not found'})}\n\n"
         return StreamingResponse(error_generator(), media_type="text/event-stream")
-    
+
+    # resumed stream of a finished task the client has fully seen: 204 makes EventSource stop reconnecting
+    if snapshot and snapshot.get('status') in TERMINAL_STATUSES and snapshot['seq'] <= last_seen:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
 
     async def event_generator():
         try:
-            # Get Redis client
-            redis_client = await RedisClient.get_client(db=int(os.getenv("REDIS_QUEUE_DB", 0)))
-            pubsub = redis_client.pubsub()
-            await pubsub.subscribe(f"task:{str(task_id)}")
-            
-            # frontend expected keys: status, preview_ready, preview_url, output_ready, output_url
-            # statusL COMPLETED, FAILED, PROCESSING, PENDING
-
-            # Send initial state immediately
-            initial_data = {
-                'status': 'PENDING',
-                'preview_ready': False,
-                'preview_url': None,
-                'output_ready': False,
-                'output_url': None,
-            }
-            logger.info(f"Initial stream_task_status sent", extra={'task_id': str(task_id)})
-            yield f"data: {json.dumps(initial_data)}\n\n"
-            
-            # Listen for updates
-            response_data = {}
-            async for message in pubsub.listen():  # data is a JSON string, keys: status, preview_local_path, final_output_path
-                if message['type'] == 'message':
-                    message_data = json.loads(message['data'])
-                    if message_data['status'] == 'COMPLETED':
-                        response_data['status'] = 'COMPLETED'
-                        response_data['preview_ready'] = True
-                        response_data['preview_url'] = generate_preview_url(task_id, message_data['file_id'])
-                        response_data['output_ready'] = True
-                        response_data['output_url'] = generate_output_url(task_id, message_data['file_id'])
-                    
-                    elif message_data['status'] == 'PROCESSING':
-                        response_data['status'] = 'PROCESSING'
-                        response_data['preview_ready'] = True
-                        response_data['preview_url'] = generate_preview_url(task_id, message_data['file_id'])
-
-                    elif message_data['status'] == 'FAILED':
-                        response_data['status'] = 'FAILED'
-
-
-                    logger.info("stream_task_status update", extra={'task_id': str(task_id), 'redis_msg': message, 'response_data': response_data})
-                    yield f"data: {json.dumps(response_data)}\n\n"
-
-                    if response_data.get('status') in ['COMPLETED', 'FAILED']:
-                        await pubsub.unsubscribe()
+            # shared per-process pattern subscription, no Redis connection per client
+            async with task_event_dispatcher.subscribe(str(task_id)) as subscription:
+                # read the snapshot after subscribing, so no event can fall in between
+                current = await task_state_store.get(task_id) or {
+                    'status': task.status.value,
+                    'file_id': task.input_image_s3_key,
+                    'seq': 0,
+                }
+                last_sent = last_seen
+                if current['seq'] > last_seen or last_seen < 0:
+                    stream_logger.info(f"Initial stream_task_status sent", extra={'task_id': str(task_id), 'status': current['status'], 'seq': current['seq']})
+                    yield format_sse(build_stream_event(task_id, current['status'], current.get('file_id'), current.get('stage'), current.get('percent')), current['seq'])
+                    last_sent = current['seq']
+                if current['status'] in TERMINAL_STATUSES:
+                    return
+
+                # Listen for updates
+                async for message in subscription:  # data is a JSON string, keys: status, file_id, stage, percent, seq
+                    message_data = json.loads(message)
+                    seq = message_data.get('seq')
+                    if seq is not None and seq <= last_sent:
+                        continue  # already sent as part of the snapshot or before the reconnect
+                    if seq is not None:
+                        last_sent = seq
+
+                    response_data = build_stream_event(task_id, message_data['status'], message_data.get('file_id'), message_data.get('stage'), message_data.get('percent'))
+                    stream_logger.info("stream_task_status update", extra={'task_id': str(task_id), 'redis_msg': message, 'response_data': response_data})
+                    yield format_sse(response_data, seq)
+
+                    if response_data['status'] in TERMINAL_STATUSES:
                         break
 
         except Exception as e:
@@ -234,3 +425,138 @@ async def stream_task_status(
             "X-Accel-Buffering": "no",
         }
     )
+
+
+async def _subscribe_tasks(subscription: TaskSetSubscription, user_id: UUID, task_ids: List[str]) -> List[str]:
+    '''
+    Attach the user's tasks among task_ids to the subscription and queue their current state.
+    Returns the rejected ids: unknown tasks and tasks of other users.
+    '''
+    # attach first and read the state second, so no event can fall in between;
+    # events are held until ownership is confirmed, so none of another user's task is sent meanwhile
+    subscription.hold(task_ids)
+    task_event_dispatcher.add_tasks(subscription, task_ids)
+    states = await _load_task_states(user_id, task_ids)
+
+    rejected = [task_id for task_id in task_ids if task_id not in states]
+    task_event_dispatcher.remove_tasks(subscription, rejected)
+    subscription.confirm(states)
+    for task_id, (task, snapshot) in states.items():
+        subscription.put_if_absent(task_id, json.dumps({
+            'status': task.status.value,
+            'file_id': task.input_image_s3_key,
+            'stage': snapshot.get('stage'),
+            'percent': snapshot.get('percent'),
+            'seq': snapshot.get('seq', 0),
+        }))
+    return rejected
+
+# status updates of many tasks over one connection, shares the task event dispatcher with the SSE streams
+@router.websocket("/ws")
+async def task_updates_websocket(
+    websocket: WebSocket,
+    current_user: User = Depends(get_current_user_from_websocket),
+):
+    '''
+    client -> server:
+        {"action": "subscribe" | "unsubscribe", "task_ids": [...]}
+        {"action": "ping"}
+    server -> client:
+        {"type": "tasks", "tasks": [{"task_id", "seq", "status", "preview_ready", "preview_url", "output_ready", "output_url", "thumbnail_url", "stage", "percent"}, ...]}
+            status deltas batched over WS_BATCH_INTERVAL, the first entry of a task is its current state,
+            finished tasks are unsubscribed after their last entry
+        {"type": "heartbeat"} after WS_HEARTBEAT_INTERVAL seconds without updates
+        {"type": "pong"}, {"type": "error", "detail": ..., "task_ids": [...]}
+    '''
+    await websocket.accept()
+    send_lock = asyncio.Lock()  # frames are sent by both loops below
+
+    async def send(data: dict):
+        async with send_lock:
+            await websocket.send_json(data)
+
+    try:
+        async with task_event_dispatcher.subscribe_many() as subscription:
+            last_seq: Dict[str, int] = {}  # task id to seq of the last entry sent
+
+            async def receive_commands():
+                while True:
+                    try:
+                        command = await websocket.receive_json()
+                    except ValueError:
+                        await send({'type': 'error', 'detail': 'Invalid JSON'})
+                        continue
+                    action = command.get('action') if isinstance(command, dict) else None
+                    if action == 'ping':
+                        await send({'type': 'pong'})
+                        continue
+                    if action not in ('subscribe', 'unsubscribe'):
+                        await send({'type': 'error', 'detail': f"Unknown action: {action}"})
+                        continue
+                    try:
+                        task_ids = list(dict.fromkeys(str(UUID(str(task_id))) for task_id in command.get('task_ids') or []))
+                    except ValueError:
+                        await send({'type': 'error', 'detail': 'Invalid task id'})
+                        continue
+
+                    if action == 'unsubscribe':
+                        task_event_dispatcher.remove_tasks(subscription, task_ids)
+                        for task_id in task_ids:
+                            last_seq.pop(task_id, None)
+                        continue
+
+                    task_ids = [task_id for task_id in task_ids if task_id not in subscription.task_ids]
+                    if len(subscription.task_ids) + len(task_ids) > WS_MAX_TASKS:
+                        await send({'type': 'error', 'detail': f"At most {WS_MAX_TASKS} tasks per connection", 'task_ids': task_ids})
+                        continue
+                    rejected = await _subscribe_tasks(subscription, current_user.id, task_ids)
+                    if rejected:
+                        await send({'type': 'error', 'detail': 'Task not found', 'task_ids': rejected})
+
+            async def send_updates():
+                while not subscription.closed:
+                    batch = await subscription.next_batch(timeout=WS_HEARTBEAT_INTERVAL, linger=WS_BATCH_INTERVAL)
+                    if subscription.closed:
+                        break
+                    if not batch:
+                        await send({'type': 'heartbeat'})
+                        continue
+
+                    updates, finished = [], []
+                    for task_id, message in batch.items():
+                        message_data = json.loads(message)  # keys: status, file_id, stage, percent, seq
+                        seq = message_data.get('seq')
+                        if seq is not None:
+                            if seq <= last_seq.get(task_id, -1):
+                                continue  # already sent as part of the snapshot
+                            last_seq[task_id] = seq
+                        updates.append({
+                            'task_id': task_id,
+                            'seq': seq,
+                            **build_stream_event(UUID(task_id), message_data['status'], message_data.get('file_id'), message_data.get('stage'), message_data.get('percent')),
+                        })
+                        if message_data['status'] in TERMINAL_STATUSES:
+                            finished.append(task_id)
+
+                    task_event_dispatcher.remove_tasks(subscription, finished)
+                    for task_id in finished:
+                        last_seq.pop(task_id, None)
+                    if updates:
+                        stream_logger.info("task_updates_websocket batch", extra={'user_id': current_user.id, 'task_count': len(updates)})
+                        await send({'type': 'tasks', 'tasks': updates})
+
+            receiver = asyncio.create_task(receive_commands())
+            sender = asyncio.create_task(send_updates())
+            done, pending = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                task.result()  # re-raise what ended the connection
+            await websocket.close(code=status.WS_1001_GOING_AWAY)  # the dispatcher dropped the subscription
+
+    except WebSocketDisconnect:
+        logger.info("task_updates_websocket disconnected", extra={'user_id': current_user.id})
+    except Exception as e:
+        logger.error(f"task_updates_websocket error: {str(e)}", extra={'user_id': current_user.id}, exc_info=True)
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
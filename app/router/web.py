@@ -1,7 +1,6 @@
 from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from fastapi_limiter.depends import RateLimiter
 from fastapi import Depends
 from app.core.dependencies import get_strict_rate_limiter, get_moderate_rate_limiter
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 from uuid import UUID
 from app.models import SubscriptionTier, TaskStatus
@@ -53,10 +53,51 @@ class ProcessingTask(ProcessingTaskBase):
     model_version: Optional[str] = None
     created_at: datetime
     completed_at: Optional[datetime] = None
+    files_expired_at: Optional[datetime] = None  # files deleted by the storage lifecycle
     
     model_config = ConfigDict(from_attributes=True)
 
 
+class ProcessingTaskSummary(BaseModel):
+    '''Projected task row, only the requested fields are set'''
+    id: UUID
+    created_at: datetime
+    user_id: Optional[UUID] = None
+    task_type: Optional[str] = None
+    status: Optional[TaskStatus] = None
+    input_image_s3_key: Optional[str] = None
+    parameters: Optional[Dict[str, Any]] = None
+    processing_time_ms: Optional[int] = None
+    model_version: Optional[str] = None
+    completed_at: Optional[datetime] = None
+    thumbnail_url: Optional[str] = None  # completed tasks, when status and input_image_s3_key are among the fields
+
+
+class ProcessingTaskPage(BaseModel):
+    items: List[ProcessingTaskSummary]
+    next_cursor: Optional[str] = None  # pass back as `cursor` to get the next page, None on the last page
+
+
+MAX_STATUS_BATCH = 200  # task ids per bulk status lookup
+
+
+class TaskStatusQuery(BaseModel):
+    task_ids: List[UUID] = Field(..., min_length=1, max_length=MAX_STATUS_BATCH)
+
+
+class TaskStatusEntry(BaseModel):
+    id: UUID
+    status: TaskStatus
+    completed_at: Optional[datetime] = None
+    stage: Optional[str] = None  # worker progress, see app.core.task_state.TASK_STAGES
+    percent: Optional[int] = None
+
+
+class TaskStatusBatch(BaseModel):
+    tasks: List[TaskStatusEntry]
+    not_found: List[UUID] = []  # unknown ids and tasks of other users
+
+
 class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
@@ -0,0 +1,116 @@
+# benchmark: LocalStorage at a large file count, flat layout vs hash-prefix shards
+## populates a flat UPLOAD_DIR, measures it, migrates it with app.migrate_storage and measures again
+##   python -m benchmarks.local_storage --files 1000000 --dir /tmp/local_storage_bench
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import statistics
+import time
+import uuid
+
+from app.core.storage import LocalStorage
+from app.migrate_storage import migrate_flat_layout
+
+
+def populate(base_dir: str, count: int) -> list:
+    file_ids = [f"{uuid.uuid4()}.jpg" for _ in range(count)]
+    for file_id in file_ids:
+        with open(os.path.join(base_dir, file_id), 'wb'):
+            pass
+    return file_ids
+
+
+async def timed(calls) -> list:
+    latencies = []
+    for call in calls:
+        start_time = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+async def run_workers(calls, concurrency: int = 32):
+    queue = list(calls)
+
+    async def worker():
+        while queue:
+            await queue.pop()()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+async def max_loop_stall(work) -> float:
+    '''Longest the event loop went without running a 1 ms ticker while `work` ran'''
+    stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            stall = max(stall, now - last - 0.001)
+            last = now
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    await work()
+    done = True
+    await ticker_task
+    return stall
+
+
+async def measure(name: str, storage: LocalStorage, file_ids: list, lookups: int):
+    sample = random.sample(file_ids, lookups)
+    misses = [f"{uuid.uuid4()}.jpg" for _ in range(lookups)]
+    new_ids = [f"{uuid.uuid4()}.png" for _ in range(lookups)]
+    results = {
+        'exists hit': await timed([lambda f=f: storage.exists(f) for f in sample]),
+        'exists miss': await timed([lambda f=f: storage.exists(f) for f in misses]),
+        'read': await timed([lambda f=f: storage.read(f) for f in sample]),
+        'save': await timed([lambda f=f: storage.save(f, b'x' * 1024) for f in new_ids]),
+        'delete': await timed([lambda f=f: storage.delete(f) for f in new_ids]),
+    }
+    for operation, values in results.items():
+        print(f"{name:>8} {operation:>12}: mean {statistics.mean(values) * 1e6:8.1f} us  p99 {sorted(values)[int(len(values) * 0.99) - 1] * 1e6:8.1f} us")
+
+    directory = os.path.dirname(storage.get_local_file_path(sample[0]))
+    start_time = time.perf_counter()
+    entries = len(os.listdir(directory))
+    print(f"{name:>8} {'listdir':>12}: {entries} entries in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    async def blocking_exists(file_id):
+        return os.path.exists(storage.get_local_file_path(file_id))  # the previous exists(), on the event loop
+    for label, call in (('blocking', blocking_exists), ('threaded', storage.exists)):
+        stall = await max_loop_stall(lambda: run_workers([lambda f=f: call(f) for f in sample]))
+        print(f"{name:>8} {'loop stall':>12}: {stall * 1000:6.1f} ms max, {label} exists, 32 concurrent callers")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="LocalStorage latency at a large file count, flat vs sharded")
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--dir", default="/tmp/local_storage_bench")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+    os.makedirs(args.dir)
+    os.environ['ROOT_DIR'], os.environ['UPLOAD_DIR'] = os.path.split(os.path.abspath(args.dir))
+
+    start_time = time.perf_counter()
+    file_ids = populate(args.dir, args.files)
+    print(f"populated {args.files} flat files in {time.perf_counter() - start_time:.1f}s")
+    await measure("flat", LocalStorage(shard_depth=0), file_ids, args.lookups)
+
+    start_time = time.perf_counter()
+    counts = migrate_flat_layout(LocalStorage(shard_depth=2))
+    print(f"migrated {counts['moved']} files in {time.perf_counter() - start_time:.1f}s")
+    await measure("sharded", LocalStorage(shard_depth=2), file_ids, args.lookups)
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
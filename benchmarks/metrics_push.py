@@ -0,0 +1,55 @@
+# benchmark: per-request metrics cost with a synchronous push (the old behaviour) vs. recording only
+## pushes to a local stub gateway, a real Pushgateway adds a network round trip on top
+##   python -m benchmarks.metrics_push --requests 2000
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prometheus_client import push_to_gateway
+
+from app.monitoring import REQUEST_COUNT, REQUEST_LATENCY, registry
+
+
+class GatewayStub(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def record():
+    REQUEST_COUNT.labels(method="GET", path="/api/tasks/{task_id}", status=200).inc()
+    REQUEST_LATENCY.labels(method="GET", path="/api/tasks/{task_id}").observe(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request metrics cost, synchronous push vs recording only")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GatewayStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    gateway = f"127.0.0.1:{server.server_address[1]}"
+
+    start_time = time.perf_counter()
+    for _ in range(args.requests):
+        record()
+        push_to_gateway(gateway, job="benchmark", registry=registry)
+    with_push = (time.perf_counter() - start_time) / args.requests
+
+    start_time = time.perf_counter()
+    for _ in range(args.requests):
+        record()
+    record_only = (time.perf_counter() - start_time) / args.requests
+
+    server.shutdown()
+    print(f"record + push_to_gateway (localhost stub): {with_push * 1e6:9.1f} us/request")
+    print(f"record only:                               {record_only * 1e6:9.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
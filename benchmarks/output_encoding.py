@@ -0,0 +1,92 @@
+# benchmark: encoding a background removal output, time and size per output format
+## a synthetic photo-like image with a feathered mask, or --image with a mask derived from its luminance
+##   python -m benchmarks.output_encoding --size 2048x1536 --runs 5
+import argparse
+import io
+import statistics
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from app.core.output_encoding import OutputEncoding, encode_image, composite_mask
+
+
+def synthetic_input(width: int, height: int) -> Image.Image:
+    '''Smooth gradients with noise and a few edges, compresses like a photo rather than like a flat fill'''
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = [
+        128 + 90 * np.sin(x / width * 6 + phase) * np.cos(y / height * 4 - phase) + rng.normal(0, 12, (height, width))
+        for phase in (0.0, 1.3, 2.6)
+    ]
+    image = Image.fromarray(np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8), mode="RGB")
+    return image.filter(ImageFilter.GaussianBlur(0.8))
+
+
+def feathered_mask(width: int, height: int) -> Image.Image:
+    '''An ellipse subject with a soft edge, as the model predicts'''
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    distance = ((x - width / 2) / (width * 0.35)) ** 2 + ((y - height / 2) / (height * 0.42)) ** 2
+    return Image.fromarray((np.clip((1.15 - distance) * 4, 0, 1) * 255).astype(np.uint8), mode="L")
+
+
+def compose(image: Image.Image, mask: Image.Image) -> Image.Image:
+    '''The output as the worker composes it, on white'''
+    return Image.composite(image, Image.new("RGB", image.size, (255, 255, 255)), mask)
+
+
+def measure(fn, runs: int):
+    timings, result = [], None
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode time and size of the output formats")
+    parser.add_argument("--size", default="2048x1536", help="WIDTHxHEIGHT of the synthetic input")
+    parser.add_argument("--image", help="encode this image instead of the synthetic one")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image:
+        image = Image.open(args.image).convert("RGB")
+        mask = image.convert("L").point(lambda value: 255 if value > 96 else 0).filter(ImageFilter.GaussianBlur(3))
+    else:
+        width, height = (int(value) for value in args.size.split("x"))
+        image, mask = synthetic_input(width, height), feathered_mask(width, height)
+    output = compose(image, mask)
+    print(f"{output.size[0]}x{output.size[1]}, median of {args.runs} runs")
+
+    cases = [
+        ("png level 6 (previous default)", output, OutputEncoding("png", 90, 6, False)),
+        ("png level 1 (fast)", output, OutputEncoding("png", 90, 1, False)),
+        ("webp lossless", output, OutputEncoding("webp", 90, 1, True)),
+        ("webp q90", output, OutputEncoding("webp", 90, 6, False)),
+        ("webp q75", output, OutputEncoding("webp", 75, 6, False)),
+        ("jpeg q90", output, OutputEncoding("jpeg", 90, 6, False)),
+        ("mask png level 9", mask, OutputEncoding("mask", 90, 9, False)),
+        ("mask png level 1", mask, OutputEncoding("mask", 90, 1, False)),
+    ]
+    baseline = None
+    for name, source, encoding in cases:
+        seconds, data = measure(lambda: encode_image(source, encoding), args.runs)
+        baseline = baseline or (seconds, len(data))
+        print(
+            f"{name:>32}: {seconds * 1000:8.1f} ms  {len(data) / 1024:9.1f} KiB"
+            f"  ({seconds / baseline[0]:5.2f}x time, {len(data) / baseline[1]:5.2f}x size)"
+        )
+
+    # what serving a mask-only output costs the API on a cache miss
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    input_content, mask_content = buffer.getvalue(), encode_image(mask, OutputEncoding("mask", 90, 9, False))
+    seconds, data = measure(lambda: composite_mask(input_content, mask_content), args.runs)
+    print(f"{'composite of mask + jpeg input':>32}: {seconds * 1000:8.1f} ms  {len(data) / 1024:9.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# benchmark: per-operation latency of S3Storage, pooled client vs a new client per operation
+## run against any S3-compatible endpoint, e.g. a local stand-in:
+##   moto_server -p 5000   (pip install "moto[server]")   or   MinIO
+##   S3_ENDPOINT_URL=http://localhost:5000 BUCKET_NAME=bench AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x \
+##       python -m benchmarks.s3_storage --operations 200 --size 65536
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from app.core.storage import S3Storage
+
+
+class PerOperationClientS3Storage(S3Storage):
+    '''
+    The previous behaviour: a new client (credential chain, connection pool, TLS handshake) for every operation
+    '''
+    async def save(self, file_id: str, content: bytes) -> bool:
+        async with self.session.client('s3', region_name=self.region, endpoint_url=self.endpoint_url) as client:
+            await client.put_object(Bucket=self.bucket_name, Key=file_id, Body=content)
+        return True
+
+    async def read(self, file_id: str) -> bytes:
+        async with self.session.client('s3', region_name=self.region, endpoint_url=self.endpoint_url) as client:
+            response = await client.get_object(Bucket=self.bucket_name, Key=file_id)
+            return await response['Body'].read()
+
+    async def exists(self, file_id: str) -> bool:
+        async with self.session.client('s3', region_name=self.region, endpoint_url=self.endpoint_url) as client:
+            await client.head_object(Bucket=self.bucket_name, Key=file_id)
+        return True
+
+
+async def measure(storage: S3Storage, operations: int, content: bytes) -> dict:
+    await storage.start()
+    latencies = {'save': [], 'read': [], 'exists': []}
+    try:
+        for i in range(operations):
+            file_id = f"benchmark/{i}.png"
+            for operation, call in (
+                ('save', lambda: storage.save(file_id, content)),
+                ('read', lambda: storage.read(file_id)),
+                ('exists', lambda: storage.exists(file_id)),
+            ):
+                start_time = time.perf_counter()
+                await call()
+                latencies[operation].append(time.perf_counter() - start_time)
+    finally:
+        await storage.stop()
+    return latencies
+
+
+def report(name: str, latencies: dict):
+    for operation, values in latencies.items():
+        values = sorted(values)
+        p50 = statistics.median(values) * 1000
+        p99 = values[int(len(values) * 0.99) - 1] * 1000
+        print(f"{name:>14} {operation:>6}: p50 {p50:7.2f} ms  p99 {p99:7.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="S3Storage per-operation latency, pooled client vs a client per operation")
+    parser.add_argument("--operations", type=int, default=200)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="object size in bytes")
+    args = parser.parse_args()
+
+    content = os.urandom(args.size)
+    pooled = S3Storage()
+    client = await pooled._get_client()
+    try:
+        await client.create_bucket(Bucket=pooled.bucket_name, CreateBucketConfiguration={'LocationConstraint': pooled.region})
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    report("per-operation", await measure(PerOperationClientS3Storage(), args.operations, content))
+    report("pooled", await measure(pooled, args.operations, content))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -34,7 +34,8 @@ CREATE TABLE processing_tasks (
     model_version VARCHAR(50), -- model version for A/B testing
         
     created_at TIMESTAMP DEFAULT NOW(),
-    completed_at TIMESTAMP
+    completed_at TIMESTAMP,
+    files_expired_at TIMESTAMP -- input and output files deleted by the storage lifecycle sweeper
 );
 
 -- indices
@@ -42,5 +43,7 @@ CREATE INDEX idx_users_email ON users(email);
 CREATE INDEX idx_users_username ON users(username);
 CREATE INDEX idx_tasks_user_status ON processing_tasks(user_id, status);
 CREATE INDEX idx_tasks_created ON processing_tasks(created_at DESC);
+CREATE INDEX idx_tasks_user_created ON processing_tasks(user_id, created_at DESC, id DESC); -- keyset pagination of task listing
 CREATE INDEX idx_tasks_type ON processing_tasks(task_type);
+CREATE INDEX idx_tasks_files_live ON processing_tasks(created_at, id) WHERE files_expired_at IS NULL; -- storage lifecycle sweeps, oldest first
 
@@ -0,0 +1,10 @@
+-- upgrade a database created from an earlier db/init/schema.sql, safe to run more than once:
+--   psql -v ON_ERROR_STOP=1 --username "$APP_USER" --dbname "$APP_DB" -f db/migrations/001_task_listing_and_file_expiry.sql
+-- run it before deploying the API and workers, they select files_expired_at on every task query;
+-- indices are built CONCURRENTLY so task writes are not blocked, psql runs each statement in its own transaction
+
+-- storage lifecycle: when the task's input and output files were deleted
+ALTER TABLE processing_tasks ADD COLUMN IF NOT EXISTS files_expired_at TIMESTAMP;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_user_created ON processing_tasks(user_id, created_at DESC, id DESC); -- keyset pagination of task listing
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_files_live ON processing_tasks(created_at, id) WHERE files_expired_at IS NULL; -- storage lifecycle sweeps, oldest first
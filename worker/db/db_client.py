@@ -2,38 +2,166 @@
 
 ## use crud defined in app/crud/task.py
 
-from app.schemas import ProcessingTaskUpdate
-from app.models import TaskStatus
+import asyncio
+import time
 from datetime import datetime
+from typing import Dict, Optional
+from uuid import UUID
+
+from app.models import TaskStatus
 from app.crud import task as task_crud
-from app.database import get_db
+from app.database import SessionLocal
 from app.logger_config import get_logger
+from app.monitoring import (
+    TASK_STATUS_BATCH_SIZE,
+    TASK_STATUS_FLUSH_LATENCY,
+    TASK_STATUS_FLUSH_FAILURES,
+    TASK_STATUS_PENDING,
+)
 
 logger = get_logger(__name__)
 
 class DBClient:
     '''
     DB client to update the database
+
+    Status updates are buffered per task (latest update wins) and written by a
+    background flusher as a single bulk UPDATE every `flush_interval` seconds,
+    or earlier once `max_batch_size` tasks are pending.
+    The buffer holds at most `max_pending` tasks; callers wait for a flush beyond that.
+    A failed write puts its updates back and is retried with exponential backoff up to `max_retry_delay` seconds.
     '''
-    def __init__(self):
-        # self.db = get_db()
-        pass
+    def __init__(self, flush_interval: float = 0.2, max_batch_size: int = 200, max_pending: int = 2000, max_retry_delay: float = 5.0, stop_attempts: int = 5):
+        self._flush_interval = flush_interval
+        self._max_batch_size = max_batch_size
+        self._max_pending = max_pending
+        self._max_retry_delay = max_retry_delay
+        self._stop_attempts = stop_attempts  # writes tried per batch on stop before its updates are given up
+
+        self._pending: Dict[UUID, dict] = {}  # task_id to row of changed columns
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()  # guards _pending, notified whenever a batch is taken out
+        self._flusher: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+
+    async def start(self):
+        '''
+        Start the background flusher
+        '''
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        '''
+        Stop the background flusher once its current write is done, then write everything still buffered
+        '''
+        if self._flusher is not None:
+            # not cancelled: a cancelled flush would lose the batch it has taken out of the buffer
+            self._stopping.set()
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+            self._stopping.clear()
+        failures = 0
+        while self._pending:
+            if await self.flush():
+                failures = 0
+                continue
+            failures += 1
+            if failures >= self._stop_attempts:
+                logger.error("DBClient: giving up on buffered status updates", extra={'task_ids': [str(task_id) for task_id in self._pending]})
+                self._pending.clear()
+                TASK_STATUS_PENDING.set(0)
+                break
+            await asyncio.sleep(self._retry_delay(failures))
 
     async def update_task_status(self, task_id, changed_fields: dict):
         '''
-        Update the task status in the database
+        Buffer a task status update, it is written to the database by the next flush.
+        Without a running flusher (see start) the update is written immediately.
         '''
-        db = next(get_db())
-        try:
-            # TODO: should add validation for changed_fields
-            task_update = ProcessingTaskUpdate()
-            if 'todb_status' in changed_fields:
-                task_update.status = TaskStatus(changed_fields['todb_status'].upper())
+        task_id = UUID(str(task_id))
+        # TODO: should add validation for changed_fields
+        row = {}
+        if 'todb_status' in changed_fields:
+            row['status'] = TaskStatus(changed_fields['todb_status'].upper())
 
             # preview_local_path and output_image_s3_key removed - paths are now inferred from input_image_s3_ke
-            if changed_fields['todb_status'] == 'COMPLETED':
-                task_update.completed_at = datetime.now()
-                
-            task_crud.update_task(db, task_id, task_update)
+            if row['status'] == TaskStatus.COMPLETED:
+                row['completed_at'] = datetime.now()
+        if not row:
+            return
+
+        async with self._space:
+            while task_id not in self._pending and len(self._pending) >= self._max_pending:
+                self._wakeup.set()
+                await self._space.wait()
+            self._pending.setdefault(task_id, {}).update(row)
+            TASK_STATUS_PENDING.set(len(self._pending))
+            if len(self._pending) >= self._max_batch_size:
+                self._wakeup.set()
+
+        if self._flusher is None:
+            await self.flush()
+
+    async def flush(self) -> bool:
+        '''
+        Write up to max_batch_size buffered updates in one statement.
+        Returns False if the write failed, its updates are buffered again unless newer ones came in meanwhile.
+        '''
+        async with self._space:
+            if not self._pending:
+                return True
+            task_ids = list(self._pending)[:self._max_batch_size]
+            batch = [{'id': task_id, **self._pending.pop(task_id)} for task_id in task_ids]
+            TASK_STATUS_PENDING.set(len(self._pending))
+            self._space.notify_all()
+
+        start_time = time.perf_counter()
+        try:
+            updated = await asyncio.to_thread(self._write_batch, batch)  # keep the blocking DB call off the event loop
+        except Exception as e:
+            TASK_STATUS_FLUSH_FAILURES.inc(len(batch))
+            logger.error(f"DBClient: bulk status update failed, will retry: {e}", extra={'task_ids': [str(row['id']) for row in batch]}, exc_info=True)
+            async with self._space:
+                for row in batch:
+                    task_id = row.pop('id')
+                    self._pending.setdefault(task_id, row)  # an update buffered meanwhile is newer
+                TASK_STATUS_PENDING.set(len(self._pending))
+            return False
+        duration = time.perf_counter() - start_time
+
+        TASK_STATUS_BATCH_SIZE.observe(len(batch))
+        TASK_STATUS_FLUSH_LATENCY.observe(duration)
+        if updated != len(batch):
+            logger.warning("DBClient: some tasks were not found while updating status", extra={'batch_size': len(batch), 'updated': updated})
+        return True
+
+    def _retry_delay(self, failures: int) -> float:
+        return min(self._max_retry_delay, self._flush_interval * 2 ** failures)
+
+    @staticmethod
+    def _write_batch(batch: list) -> int:
+        db = SessionLocal()
+        try:
+            return task_crud.bulk_update_task_status(db, batch)
         finally:
-            db.close()
\ No newline at end of file
+            db.close()
+
+    async def _flush_loop(self):
+        failures = 0
+        while not self._stopping.is_set():
+            try:
+                if failures:
+                    # backing off, a full buffer does not cut it short, only stop does
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self._retry_delay(failures))
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending and not self._stopping.is_set():
+                if not await self.flush():
+                    failures += 1
+                    break
+                failures = 0
@@ -1,31 +1,109 @@
-# notification client to notify the task completion for frontend 
+# notification client to notify the task completion for frontend
 
 
-import os
+import json
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional, Tuple
 
-from app.core.redis import RedisClient
+from app.core.redis import redis_manager, RedisRole
+from app.core.task_state import task_state_store
 from app.logger_config import get_logger
+from app.monitoring import TASK_PROGRESS_PUBLISHED, TASK_PROGRESS_COALESCED
 
 logger = get_logger(__name__)
 
 class NotificationClient:
     '''
     Notification client to notify the task completion for frontend by redis pub/sub
+
+    Progress reports are coalesced per task (latest wins) and published by a background flusher
+    every `progress_interval` seconds, all pending tasks in two pipelined round trips,
+    so a task publishes at most one progress event per interval however often it reports.
     '''
-    def __init__(self, timeout: float = 60.0):
+    def __init__(self, timeout: float = 60.0, progress_interval: float = 0.5):
         self.redis = None
         self.timeout = timeout
+        self._progress_interval = progress_interval
+
+        self._progress: Dict[str, Tuple[str, Optional[int]]] = {}  # task_id to latest (stage, percent)
+        self._flusher: Optional[asyncio.Task] = None
+        # a flush in flight and a final status are serialized, so no progress event follows the final status
+        self._publish_lock = asyncio.Lock()
 
     async def _init_redis(self):
-        # not very necessary to use separate db for notification, but just in case
-        self.redis = await RedisClient.get_client(db=int(os.getenv("REDIS_QUEUE_DB", 0)))  
+        # own pool, so publishes never wait behind the queue's blocking BRPOP
+        self.redis = redis_manager.get_client(RedisRole.NOTIFICATION)
+
+    async def start(self):
+        '''
+        Start the background progress publisher, progress reports are dropped until then
+        '''
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        '''
+        Stop the background progress publisher and publish what is still pending
+        '''
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush_progress()
 
-    async def notify_task_status(self, task_id: str, message: str):
+    def report_progress(self, task_id, stage: str, percent: Optional[int] = None):
+        '''
+        Record the progress of a task, non-blocking, see TASK_STAGES for the stages
+        Only the latest report per task is published by the next flush
+        '''
+        if self._flusher is None:
+            return
+        task_id = str(task_id)
+        if task_id in self._progress:
+            TASK_PROGRESS_COALESCED.inc()
+        self._progress[task_id] = (stage, percent)
+
+    async def notify_task_status(self, task_id: str, status: str, file_id: str):
         '''
         Notify the task status for frontend
-        message: JSON string
+        Writes the Redis status snapshot first, then publishes a JSON message with keys status, file_id, stage, percent, seq
         Use one api for both task completion and failure
         '''
-        if self.redis is None:
-            await self._init_redis()
-        await self.redis.publish(f"task:{task_id}", message)    
\ No newline at end of file
+        async with self._publish_lock:
+            self._progress.pop(str(task_id), None)  # superseded by the final status
+            completed_at = datetime.now() if status == 'COMPLETED' else None
+            seq = await task_state_store.update(task_id, status, file_id=file_id, completed_at=completed_at, stage="done", percent=100)
+
+            if self.redis is None:
+                await self._init_redis()
+            message = json.dumps({'status': status, 'file_id': file_id, 'stage': "done", 'percent': 100, 'seq': seq})
+            await self.redis.publish(f"task:{task_id}", message)
+
+    async def flush_progress(self):
+        '''
+        Publish the pending progress reports
+        '''
+        async with self._publish_lock:
+            if not self._progress:
+                return
+            batch, self._progress = self._progress, {}
+            try:
+                updated = await task_state_store.update_progress(batch)
+                if self.redis is None:
+                    await self._init_redis()
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for task_id, (stage, percent) in batch.items():
+                        seq, status, file_id = updated[task_id]
+                        message = {'status': status, 'file_id': file_id, 'stage': stage, 'percent': percent, 'seq': seq}
+                        pipe.publish(f"task:{task_id}", json.dumps(message))
+                    await pipe.execute()
+            except Exception as e:
+                logger.warning(f"NotificationClient: publishing progress failed: {e}", extra={'task_count': len(batch)})
+                return
+            TASK_PROGRESS_PUBLISHED.inc(len(batch))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            await self.flush_progress()
@@ -3,6 +3,8 @@ from worker.models.model_orchestrator import ModelOrchestrator
 from worker.models.bgrm import BackgroundRemovalModel
 from app.logger_config import get_logger
 from worker.worker_config import get_worker_config
+from app.monitoring import MetricsPusher
+from app.core.redis import redis_manager
 
 logger = get_logger(__name__)
 config = get_worker_config()
@@ -17,8 +19,16 @@ async def main():
     # Register all model types
     orchestrator.register_model("background_removal", BackgroundRemovalModel)
     
+    # Worker has no HTTP server, so its metrics are pushed in the background
+    metrics_pusher = MetricsPusher(job="worker")
+    await metrics_pusher.start()
+
     # Run orchestrator
-    await orchestrator.run(max_concurrent_tasks=5)
+    try:
+        await orchestrator.run(max_concurrent_tasks=5)
+    finally:
+        await metrics_pusher.stop()
+        await redis_manager.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,5 +1,5 @@
 # provide base inference framework for all tasks
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Optional
 import threading
 import time
 import asyncio
@@ -29,6 +29,9 @@ class BaseModel:
         self._model = None
         self._model_lock = asyncio.Lock()  # DO need a lock to protect the model from being used and unloaded at the same time
 
+        # progress reporting, set by the orchestrator, called as (task_id, stage, percent)
+        self._progress_reporter: Optional[Callable[[Any, str, Optional[int]], None]] = None
+
         # stats
         self.stats = {
             'total_tasks_processed': 0,
@@ -50,6 +53,17 @@ class BaseModel:
         '''
         self._running = False
 
+    def set_progress_reporter(self, reporter: Callable[[Any, str, Optional[int]], None]):
+        self._progress_reporter = reporter
+
+    def _report_progress(self, task: QueueTaskPayload, stage: str, percent: Optional[int] = None):
+        '''
+        Report the stage of a task (see app.core.task_state.TASK_STAGES), must not block.
+        Models working in tiles or chunks should report the stage repeatedly with the percent done.
+        '''
+        if self._progress_reporter is not None:
+            self._progress_reporter(task.task_id, stage, percent)
+
     async def predict_async(self, task: QueueTaskPayload):
         '''
         Wrapper of inference method for all models
@@ -67,7 +81,11 @@ class BaseModel:
             return result
             
 
-    async def _inference(self, input: Any) -> Any:
+    async def _inference(self, input: Any) -> Optional[bytes]:
+        '''
+        Run the task and return the encoded output, the orchestrator writes it to the output storage.
+        None or empty bytes mark the task as failed.
+        '''
         raise NotImplementedError("Not implemented")
 
     async def _lazy_load_model(self):   # need IO, so async
@@ -1,18 +1,19 @@
 # background removal model
 
 import os
+import asyncio
 import torch
-from typing import Any
 from torchvision import transforms
 from skimage import io
 
 from app.logger_config import get_logger
 
 from worker.models.u2net.u2net import U2NET, U2NETP
-from worker.models.u2net.transform import normPRED, RescaleT, ToTensorLab, save_output
+from worker.models.u2net.transform import normPRED, RescaleT, ToTensorLab, encode_output
 from worker.models.base import BaseModel
 from app.core.queue import QueueTaskPayload
-from app.core.storage import LocalStorage, S3Storage
+from app.core.storage import LocalStorage
+from app.core.output_encoding import output_encoding
 # ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 logger = get_logger(__name__)
 
@@ -29,13 +30,12 @@ class BackgroundRemovalModel(BaseModel):
             ToTensorLab(flag=0),
         ])
 
-        self.storage_service = LocalStorage()  
-        self.storage_service_s3 = S3Storage()
+        self.storage_service = LocalStorage()  # input images
 
     def _use_cuda(self) -> bool:
         return torch.cuda.is_available() and self.config['MODEL_DEVICE'] == 'cuda'
 
-    async def _inference(self, task: QueueTaskPayload) -> Any:   # do not implement batch processing here
+    async def _inference(self, task: QueueTaskPayload) -> bytes:   # do not implement batch processing here
         await self._lazy_load_model()
         # import pdb; pdb.set_trace()
         # preprocess the input image
@@ -50,9 +50,13 @@ class BackgroundRemovalModel(BaseModel):
 
         logger.info(f"Doing inference", extra={"task_id": task.task_id, 'task_type': 'BackgroundRemoval', 'file_path': task_path})
         # import pdb; pdb.set_trace()
-        input_image_path = self.storage_service.get_local_file_path(task_path)
-        input_image = io.imread(input_image_path)
-        input_image = self._model_transform({'image': input_image})['image']
+        input_image_path = await self.storage_service.locate(task_path)  # sharded, or flat before migration
+        if input_image_path is None:
+            raise FileNotFoundError(f"Input image not found: {task_path}")
+        # decoding and the forward pass run in threads, so the event loop keeps publishing progress and heartbeats
+        self._report_progress(task, "decoding", 10)
+        original_image = await asyncio.to_thread(io.imread, input_image_path)
+        input_image = (await asyncio.to_thread(self._model_transform, {'image': original_image}))['image']
 
         input_image = input_image.type(torch.FloatTensor)
 
@@ -64,7 +68,8 @@ class BackgroundRemovalModel(BaseModel):
         # inference
         # import pdb; pdb.set_trace()  
         input_image = input_image.unsqueeze(0)  # add batch dimension
-        d1,d2,d3,d4,d5,d6,d7 = self._model(input_image)
+        self._report_progress(task, "inferring", 30)  # single forward pass, no finer progress available
+        d1,d2,d3,d4,d5,d6,d7 = await asyncio.to_thread(self._model, input_image)
         del input_image, d2,d3,d4,d5,d6,d7
         
         pred = d1[:,0,:,:]
@@ -73,12 +78,9 @@ class BackgroundRemovalModel(BaseModel):
         # postprocess the output
         logger.info('Finish inference', extra={"task_id": task.task_id, 'task_type': 'BackgroundRemoval', 'file_path': task_path})
         
-        output_id = LocalStorage.get_output_id(task_path)  # Use static method
-        output_image_path = self.storage_service.get_local_file_path(output_id)
-        
-        await save_output(input_image_path, pred, output_image_path)  # save to local
-        output_img_content = await self.storage_service.read(output_id)  # Use file_id not path
-        await self.storage_service_s3.save(output_id, output_img_content)  # save to s3
+        self._report_progress(task, "encoding", 70)
+        # encoded in memory as the task's parameters ask, the orchestrator writes it to the output storage
+        return await asyncio.to_thread(encode_output, original_image, pred, output_encoding(task.parameters))
 
 
     async def _lazy_load_model(self):   # need IO, so async
@@ -1,6 +1,6 @@
 from __future__ import annotations  # for type hints
 import asyncio
-from typing import Dict, Type, Any, List
+from typing import Dict, Type, Any, List, Optional
 import os
 import json
 
@@ -14,7 +14,9 @@ from worker.models.base import BaseModel
 from app.logger_config import get_logger
 from app.core.queue import QueueTaskPayload
 from worker.worker_config import get_worker_config
-from app.core.storage import LocalStorage, S3Storage
+from app.core.storage import StorageService, create_storage_service, get_output_storage_type
+from app.core.variants import THUMBNAIL_VARIANTS, render_variant, variant_id
+from app.core.output_encoding import output_encoding, output_file_id
 
 logger = get_logger(__name__)
 
@@ -32,8 +34,7 @@ class ModelOrchestrator:
         self._running = False        
         self._background_tasks = []
 
-        self.storage_service = LocalStorage()
-        self.storage_service_s3 = S3Storage()
+        self.output_storage: StorageService = create_storage_service(get_output_storage_type())  # outputs are written here once
     
     def register_model(self, model_type: str, model_class: Type[BaseModel]):
         '''
@@ -53,6 +54,7 @@ class ModelOrchestrator:
             
             logger.info(f"Initializing model: {model_type}")
             model = self.model_classes[model_type]()  # call model's init method to create instance
+            model.set_progress_reporter(self._notification_client.report_progress)
             self.models[model_type] = model
             
             # Start idle detection for this model (non-blocking)
@@ -62,19 +64,56 @@ class ModelOrchestrator:
         return self.models[model_type]
 
 
-    async def _process_task(self, task: QueueTaskPayload):
+    async def _process_task(self, task: QueueTaskPayload) -> bool:
         '''
         Process a single task
+        Returns whether the output was produced and stored
         '''
         model_type = task.task_type  # task type is the model type        
+        try:
+            output_encoding(task.parameters)
+        except ValueError as e:
+            logger.error(f"task_id: {task.task_id}, ModelOrchestrator: invalid output parameters: {e}")
+            return False  # no retry, it would fail the same way
         try:
             model = await self._get_or_create_model(model_type)
             result = await model.predict_async(task)
-            return result
-            
         except Exception as e:
             logger.error(f"Task processing error: {e}", exc_info=True)
             raise
+        return await self._save_output(task, result)
+
+    async def _save_output(self, task: QueueTaskPayload, result: Optional[bytes]) -> bool:
+        '''
+        Write the encoded output of a task to the output storage, the only write of the output
+        '''
+        if not result:
+            logger.error(f"task_id: {task.task_id}, ModelOrchestrator: model returned no output")
+            return False
+        self._notification_client.report_progress(task.task_id, "uploading", 90)
+        encoding = output_encoding(task.parameters)
+        output_id = output_file_id(task.input_image_s3_key, encoding)
+        saved = await self.output_storage.save(output_id, result)
+        if not saved:
+            logger.error(f"task_id: {task.task_id}, ModelOrchestrator: failed to save output {output_id}")
+            return False
+        if encoding.format != 'mask':  # a mask alone has no thumbnail, the API renders it from the composite on demand
+            await self._save_thumbnails(task, StorageService.get_output_id(task.input_image_s3_key), result)
+        return True
+
+    async def _save_thumbnails(self, task: QueueTaskPayload, output_id: str, result: bytes):
+        '''
+        Render THUMBNAIL_VARIANTS from the output still in memory, so list views never wait on a render.
+        Variant keys derive from the PNG output key `output_id` whatever the output's format.
+        A missing thumbnail is rendered by the API on first request, failures here do not fail the task.
+        '''
+        for spec in THUMBNAIL_VARIANTS:
+            try:
+                thumbnail = await asyncio.to_thread(render_variant, result, spec)
+                if not await self.output_storage.save(variant_id(output_id, spec), thumbnail):
+                    logger.warning(f"task_id: {task.task_id}, ModelOrchestrator: failed to save thumbnail {spec}")
+            except Exception as e:
+                logger.warning(f"task_id: {task.task_id}, ModelOrchestrator: thumbnail {spec} failed: {e}")
 
     async def run(self, max_concurrent_tasks: int = 5):
         """
@@ -84,6 +123,9 @@ class ModelOrchestrator:
         self._running = True
         semaphore = asyncio.Semaphore(max_concurrent_tasks)
         active_tasks = set()
+        await self._db_client.start()  # background writer for batched status updates
+        await self._notification_client.start()  # background publisher for progress events
+        await self.output_storage.start()  # long-lived storage client, e.g. the pooled S3 client
         
         logger.info(f"Orchestrator started with max {max_concurrent_tasks} concurrent tasks")
         
@@ -98,15 +140,17 @@ class ModelOrchestrator:
                         async def process_with_semaphore(t):
                             async with semaphore:
                                 try:
-                                    await self._process_task(t) 
+                                    return await self._process_task(t) 
                                 except Exception as e:
                                     logger.error(f"Task failed: {e}, retrying...", exc_info=True)
                                     await self._queue_client.enqueue_retry(t)  # 
+                                    return False
 
                         logger.info(f"ModelOrchestrator: processing task: {task}")
+                        self._notification_client.report_progress(task.task_id, "queued", 0)
                         task_coro = asyncio.create_task(process_with_semaphore(task))
                         active_tasks.add(task_coro)
-                        task_coro.add_done_callback(lambda f: self._handle_task_completion(f, task))
+                        task_coro.add_done_callback(lambda f, t=task: self._handle_task_completion(f, t))  # bind this task, not the loop variable
                         task_coro.add_done_callback(active_tasks.discard)
                         
                 except Exception as e:
@@ -143,6 +187,11 @@ class ModelOrchestrator:
         for model_type, model in list(self.models.items()):
             logger.info(f"Unloading model: {model_type}")
             await model.stop()
+
+        # Flush buffered status updates and progress events
+        await self._db_client.stop()
+        await self._notification_client.stop()
+        await self.output_storage.stop()
         
         logger.info("Orchestrator shutdown complete")
     
@@ -156,26 +205,18 @@ class ModelOrchestrator:
     def _handle_task_completion(self, task_future: asyncio.Future, task: QueueTaskPayload):
         '''
         Handle the task completion:
-            (1) Check if the task is successful
+            (1) Check if the task is successful, i.e. its output was stored
             (2) Notify the task completion for frontend
             (3) database update
         '''
+        succeeded = not task_future.cancelled() and task_future.exception() is None and bool(task_future.result())
         # Create async task for post-processing
-        asyncio.create_task(self._process_task_completion(task))
+        asyncio.create_task(self._process_task_completion(task, succeeded))
     
-    async def _process_task_completion(self, task: QueueTaskPayload):
+    async def _process_task_completion(self, task: QueueTaskPayload, succeeded: bool):
         '''Async handler for task completion'''
-        # Step 1: check if the task is successful
-        output_id = LocalStorage.get_output_id(task.input_image_s3_key)  # Use static method
-        output_ready_locally = await self.storage_service.exists(output_id)
-        output_ready_s3 = await self.storage_service_s3.exists(output_id)
-
-        if output_ready_s3:
-            TASK_STATUS = 'COMPLETED'
-        elif output_ready_locally:
-            TASK_STATUS = 'PROCESSING'
-        else:
-            TASK_STATUS = 'FAILED'
+        # Step 1: the result of processing decides, no storage probes needed
+        TASK_STATUS = 'COMPLETED' if succeeded else 'FAILED'
 
         # Step 2: notify the task completion for frontend by redis pub/sub
         message = {
@@ -184,17 +225,13 @@ class ModelOrchestrator:
         }
 
         asyncio.create_task(
-            self._notification_client.notify_task_status(str(task.task_id), message=json.dumps(message))
-        )  # non-blocking
+            self._notification_client.notify_task_status(str(task.task_id), status=TASK_STATUS, file_id=task.input_image_s3_key)
+        )  # non-blocking, also refreshes the Redis status snapshot
         logger.info(f"task_id: {task.task_id}, ModelOrchestrator: notified task completion for frontend, message: {message}")
 
         
         # Step 3: update to database
-        if TASK_STATUS == 'PROCESSING':
-            updated_fields = {
-                'todb_status': 'PROCESSING'
-            }
-        elif TASK_STATUS == 'COMPLETED':
+        if TASK_STATUS == 'COMPLETED':
             updated_fields = {
                 'todb_status': 'COMPLETED',
             }
@@ -204,7 +241,6 @@ class ModelOrchestrator:
             }
         
         if updated_fields:
-            asyncio.create_task(
-                self._db_client.update_task_status(task.task_id, changed_fields=updated_fields)
-            )  # non-blocking
+            # buffered, written by the db client's background flusher
+            await self._db_client.update_task_status(task.task_id, changed_fields=updated_fields)
             logger.info(f"task_id: {task.task_id}, ModelOrchestrator: updated database, updated_fields: {updated_fields}")
\ No newline at end of file
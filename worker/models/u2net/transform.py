@@ -4,6 +4,8 @@ import os
 import torch
 from PIL import Image
 
+from app.core.output_encoding import OutputEncoding, encode_image
+
 #==========================dataset load==========================
 class RescaleT(object):
 
@@ -124,11 +126,10 @@ def normPRED(d):
     return dn
 
 
-async def save_output(original_image_path, pred, output_image_path):
-	# load image
-    original_image = io.imread(original_image_path)
-
-	# load pred
+def _resize_mask(original_image, pred) -> np.ndarray:
+    '''
+    The predicted mask (0..1 floats) resized to the original image (ndarray)
+    '''
     pred = pred.squeeze()
     predict_np = pred.cpu().data.numpy()
     # im = Image.fromarray(predict_np*255).convert('RGB')
@@ -136,7 +137,14 @@ async def save_output(original_image_path, pred, output_image_path):
 
     # resize mask to original image size
     mask = im.resize((original_image.shape[1], original_image.shape[0]), resample=Image.BILINEAR)
-    mask_np = np.array(mask)
+    return np.array(mask)
+
+
+def compose_output(original_image, pred) -> Image.Image:
+    '''
+    Apply the predicted mask to the original image (ndarray), background turned white
+    '''
+    mask_np = _resize_mask(original_image, pred)
 
     # 
     if len(original_image.shape) == 2:  # 灰度图
@@ -147,7 +155,30 @@ async def save_output(original_image_path, pred, output_image_path):
         result = result + (1 - mask_3d) * 255
 
     result = result.astype(np.uint8)
-    result_image = Image.fromarray(result)
+    return Image.fromarray(result)
+
+
+def compose_mask(original_image, pred) -> Image.Image:
+    '''
+    The predicted mask at the original image's size as a single-channel 8-bit image, for mask-only outputs
+    '''
+    mask_np = _resize_mask(original_image, pred)
+    return Image.fromarray(np.clip(np.rint(mask_np * 255), 0, 255).astype(np.uint8), mode='L')
+
+
+def encode_output(original_image, pred, encoding: OutputEncoding) -> bytes:
+    '''
+    The output encoded in memory as the task asked for, nothing is written to disk:
+    the composed image, or for the "mask" format only the mask
+    '''
+    if encoding.format == 'mask':
+        return encode_image(compose_mask(original_image, pred), encoding)
+    return encode_image(compose_output(original_image, pred), encoding)
+
+
+async def save_output(original_image_path, pred, output_image_path):
+    original_image = io.imread(original_image_path)
+    result_image = compose_output(original_image, pred)
     # aaa = image_path.split(".")  # 
     # # suffix = aaa[-1]
     # output_path = '.'.join(aaa[:-1]) + '.output' + '.png'